@@ -1,25 +1,32 @@
 import streamlit as st
-from streamlit_webrtc import webrtc_streamer
-import av
-import cv2
-import folium
-from streamlit_folium import folium_static
-from datetime import datetime, date
-import random
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, ForeignKey
-from sqlalchemy.orm import declarative_base, sessionmaker, relationship
+import streamlit.components.v1 as components
+from datetime import datetime, timedelta, timezone
 import time
-import sqlalchemy
-from dataclasses import dataclass
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderServiceError
+import math
 import os
-from dotenv import load_dotenv
-from functools import lru_cache
-import stripe
+import functools
 import threading
+from contextlib import contextmanager
+from dotenv import load_dotenv
 import logging
 
+# Video (cv2, av, streamlit_webrtc), maps (folium), payments (stripe) and geocoding (geopy) are imported
+# where they are used, so a new server process only loads them once a page or bootstrap needs them
+import db
+import instrumentation
+from models import Subscription
+from spatial import merchant_index
+from catalog import Provider, get_catalog
+import bootstrap
+from ids import new_id, new_order_id, new_subscription_id
+from scheduling import SlotUnavailable, due_window, format_slot, get_schedule, service_now
+from orders import create_order, claim_order, cancel_order, update_order_status, cached_order_page_for_user, cached_order_page_by_status, get_order_page_for_user, get_order_page_by_status, get_order_rows_by_ids, get_order_rows_due, get_order_rows_for_driver, order_cache
+from lifecycle import PENDING, PREPARING, ON_THE_WAY, DELIVERED, CANCELLED, PROGRESS_STATUSES, InvalidTransition, StatusConflict, next_statuses, status_histories
+from dispatch import cached_dispatch_board
+from events import order_events
+from routing import load_route_orders, plan_runs
+from chat import ASSOCIATE, ASSOCIATE_USER_TYPE, CUSTOMER, NotAnAssociate, RoomCursor, active_rooms, chat_role, send_message
+
 # Logging setup for debugging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -46,168 +53,72 @@ except KeyError as e:
     st.error(f"Missing secret: {e}. Please set it in .env or Streamlit Cloud secrets.")
     st.stop()
 
-# Initialize Stripe
-stripe.api_key = STRIPE_SECRET_KEY
-
-# SQLAlchemy setup with connection pooling
-Base = sqlalchemy.orm.declarative_base()
-engine = create_engine(
-    DATABASE_URL,
-    echo=False,
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30
-)
-Session = sessionmaker(bind=engine)
+# For payments, which sets up Stripe from the environment when it is first imported
+os.environ["STRIPE_SECRET_KEY"] = STRIPE_SECRET_KEY
 
-# Reuse session for speed
+# SQLAlchemy setup with connection pooling; one engine (and pool) per server process
 @st.cache_resource
+def get_engine():
+    engine = db.make_engine(DATABASE_URL)
+    db.bind_engine(engine)
+    instrumentation.instrument(engine)
+    return engine
+
+engine = get_engine()
+
+# Session scoped to the current rerun, see rerun_context()
 def get_db_session():
-    return Session()
-
-# SQLAlchemy models
-class User(Base):
-    __tablename__ = 'users'
-    id = Column(String, primary_key=True)
-    name = Column(String, nullable=False)
-    email = Column(String, unique=True, nullable=False)
-    type = Column(String, nullable=False)
-    address = Column(String)
-
-class Merchant(Base):
-    __tablename__ = 'merchants'
-    id = Column(Integer, primary_key=True)
-    name = Column(String, nullable=False)
-    type = Column(String, nullable=False)
-    latitude = Column(Float, nullable=False)
-    longitude = Column(Float, nullable=False)
-    website = Column(String)
-
-class Order(Base):
-    __tablename__ = 'orders'
-    id = Column(String, primary_key=True)
-    user_id = Column(String, ForeignKey('users.id'))
-    merchant_id = Column(Integer, ForeignKey('merchants.id'), nullable=True)
-    service = Column(String)
-    date = Column(DateTime, nullable=False)
-    time = Column(String, nullable=False)
-    address = Column(String, nullable=False)
-    status = Column(String, nullable=False)
-    payment_status = Column(String, default="Pending")
-    payment_method = Column(String, default="Online")
-    total_amount = Column(Float, default=0.0)
-    user = relationship("User")
-    merchant = relationship("Merchant")
-
-class Subscription(Base):
-    __tablename__ = 'subscriptions'
-    id = Column(Integer, primary_key=True)
-    user_id = Column(String, ForeignKey('users.id'))
-    partner_name = Column(String, nullable=False)
-    subscription_id = Column(String, nullable=False)
-    status = Column(String, default="Active")
-    user = relationship("User")
-
-class GeocodeCache(Base):
-    __tablename__ = 'geocode_cache'
-    address = Column(String, primary_key=True)
-    latitude = Column(Float)
-    longitude = Column(Float)
-    updated_at = Column(DateTime, default=datetime.now)
-
-Base.metadata.create_all(engine, checkfirst=True)
+    return db.ScopedSession()
 
 # Helper functions
 def generate_order_id():
-    return f"ORD-{random.randint(10000, 99999)}"
+    return new_order_id()
 
-@st.cache_data
-def create_map(_hash, service_type=None):
+def create_map(service_type=None, near=None):
     try:
-        session = get_db_session()
-        query = session.query(Merchant)
-        if service_type:
-            query = query.filter_by(type=service_type)
-        merchants = query.limit(20).all()  # Limit for speed
-        if not merchants:
+        from maps import merchant_map_html
+        with instrumentation.span("map"):
+            map_html = merchant_map_html(get_db_session(), service_type=service_type, near=near)
+        if not map_html:
             st.warning("No services found.")
-            return None
-        m = folium.Map(location=[39.1054, -76.7285], zoom_start=12)
-        for merchant in merchants:
-            popup_html = f"""
-            <b>{merchant.name}</b><br>
-            Type: {merchant.type}<br>
-            Website: <a href='{merchant.website}' target='_blank'>Visit</a>
-            """
-            folium.Marker(
-                [merchant.latitude, merchant.longitude],
-                popup=folium.Popup(popup_html, max_width=300)
-            ).add_to(m)
-        return m
+        return map_html
     except Exception as e:
         logger.error(f"Map creation error: {e}")
         st.error("Failed to load map.")
         return None
 
-@lru_cache(maxsize=100)
-def geocode_with_retry(address, max_retries=3, initial_delay=1):
-    session = get_db_session()
+# Process-wide geocoder: bounded worker pool, 1 req/s to Nominatim, concurrent lookups coalesced
+def get_geocoder():
+    from geocoding import get_geocoding_service
+    return get_geocoding_service()
+
+def geocode_with_retry(address):
+    # Blocking; only for startup work. Pages use poll_geocode() so a cache miss never stalls a rerun
     try:
-        # Check database cache
-        cached = session.query(GeocodeCache).filter_by(address=address).first()
-        if cached:
-            return type('Location', (), {'latitude': cached.latitude, 'longitude': cached.longitude})()
-        
-        geolocator = Nominatim(user_agent="local_butler_app")
-        for attempt in range(max_retries):
-            try:
-                time.sleep(initial_delay * (2 ** attempt))
-                location = geolocator.geocode(address)
-                if location:
-                    # Save to database
-                    session.merge(GeocodeCache(
-                        address=address,
-                        latitude=location.latitude,
-                        longitude=location.longitude,
-                        updated_at=datetime.now()
-                    ))
-                    session.commit()
-                    return location
-            except (GeocoderTimedOut, GeocoderServiceError) as e:
-                if attempt == max_retries - 1:
-                    logger.warning(f"Geocoding failed for {address}: {e}")
-                    return None
-        return None
+        return get_geocoder().geocode(address)
     except Exception as e:
         logger.error(f"Geocoding error: {e}")
         return None
 
-def async_geocode(address, callback):
-    def geocode_task():
-        location = geocode_with_retry(address)
-        callback(location)
-    threading.Thread(target=geocode_task, daemon=True).start()
-
-@dataclass
-class Service:
-    name: str
-    url: str
-    instructions: list
-    video_url: str = None
-    image_url: str = None
-    address: str = None
-    phone: str = None
-    hours: str = None
-
-def display_service(service: Service):
-    st.markdown(f"[**ORDER NOW**: {service.name}]({service.url})")
+def poll_geocode(address):
+    if not address:
+        return None
+    with instrumentation.span("geocode poll"):
+        return get_geocoder().poll(address)
+
+def display_service(service: Provider):
+    if service.url:
+        st.markdown(f"[**ORDER NOW**: {service.name}]({service.url})")
+    else:
+        st.markdown(f"**{service.name}**")
     if service.video_url:
         st.video(service.video_url)
     elif service.image_url:
         st.image(service.image_url, caption=service.name, use_column_width=True)
-    st.write("**Instructions**:")
-    for instruction in service.instructions:
-        st.markdown(f"- {instruction}")
+    if service.instructions:
+        st.write("**Instructions**:")
+        for instruction in service.instructions:
+            st.markdown(f"- {instruction}")
     if service.address:
         st.write(f"**Address**: {service.address}")
     if service.phone:
@@ -216,44 +127,22 @@ def display_service(service: Service):
         st.write(f"**Hours**: {service.hours}")
 
 def update_map(address):
-    if 'map_location' not in st.session_state:
-        st.session_state.map_location = None
-    def set_location(location):
-        st.session_state.map_location = location
-        st.experimental_rerun()
-    async_geocode(address, set_location)
-    if st.session_state.map_location:
-        m = folium.Map(location=[st.session_state.map_location.latitude, st.session_state.map_location.longitude], zoom_start=15)
+    location = poll_geocode(address)
+    if location:
+        import folium
+        m = folium.Map(location=[location.latitude, location.longitude], zoom_start=15)
         folium.Marker(
-            [st.session_state.map_location.latitude, st.session_state.map_location.longitude],
+            [location.latitude, location.longitude],
             popup=f"Service Address: {address}"
         ).add_to(m)
-        return m, st.session_state.map_location
+        return m, location
     return None, None
 
-def create_stripe_checkout_session(order_id, amount, service_type):
-    try:
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': f"Local Butler {service_type} - Order {order_id}"
-                    },
-                    'unit_amount': int(amount * 100),
-                },
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url="https://your-app.streamlit.app/success",  # Update after deployment
-            cancel_url="https://your-app.streamlit.app/cancel"
-        )
-        return checkout_session
-    except Exception as e:
-        logger.error(f"Stripe error: {e}")
-        st.error("Payment processing failed.")
-        return None
+def start_stripe_checkout(order_id, amount, service_type, attempt=0):
+    # Created on the checkout worker pool so the rerun never waits on Stripe; one order always gets one session
+    from payments import get_checkout_service
+    with instrumentation.span("stripe checkout submit"):
+        return get_checkout_service().submit(order_id, amount, service_type, attempt=attempt)
 
 def calculate_laundry_total(weight):
     RATE_PER_POUND = 2.00
@@ -298,72 +187,6 @@ st.markdown(f"""
     </style>
     """, unsafe_allow_html=True)
 
-# SERVICES dictionary (unchanged)
-SERVICES = {
-    "Groceries": {
-        "Weis Markets": {
-            "url": "https://www.weismarkets.com",
-            "instructions": ["Order online.", "Select pick-up.", "Notify Butler."],
-            "address": "2288 Blue Water Boulevard, Odenton, MD 21113",
-            "phone": "(410) 672-1877"
-        }
-    },
-    "Restaurants": {
-        "The Hideaway": {
-            "url": "https://thehideaway.com",
-            "instructions": ["Order online.", "Select pick-up.", "Notify Butler."],
-            "address": "1439 Odenton Rd, Odenton, MD 21113",
-            "phone": "(410) 874-7213"
-        }
-    },
-    "Laundry": {
-        "Local Butler Laundry": {
-            "url": "http://localhost:8501",
-            "instructions": ["Enter weight.", "Schedule pick-up.", "We wash and deliver."],
-            "address": "Odenton, MD 21113",
-            "phone": "(410) 555-5678",
-            "hours": "Mon-Fri 8am-6pm"
-        }
-    }
-}
-
-PARTNERSHIPS = {
-    "Factor": {
-        "url": "https://www.factor75.com",
-        "description": "Healthy meals delivered.",
-        "subscription_url": "https://www.factor75.com/plans",
-        "commission_rate": 0.10,
-        "image_url": "https://via.placeholder.com/150"
-    }
-}
-
-def populate_merchants():
-    if 'merchants_populated' not in st.session_state:
-        st.session_state.merchants_populated = False
-    if st.session_state.merchants_populated:
-        return
-    try:
-        session = get_db_session()
-        for service_type, providers in SERVICES.items():
-            for provider_name, provider_info in providers.items():
-                merchant = session.query(Merchant).filter_by(name=provider_name).first()
-                if not merchant:
-                    location = geocode_with_retry(provider_info['address'])
-                    if location:
-                        merchant = Merchant(
-                            name=provider_name,
-                            type=service_type,
-                            latitude=location.latitude,
-                            longitude=location.longitude,
-                            website=provider_info['url']
-                        )
-                        session.add(merchant)
-        session.commit()
-        st.session_state.merchants_populated = True
-    except Exception as e:
-        logger.error(f"Populate merchants error: {e}")
-        st.error("Failed to initialize merchants.")
-
 def auth0_authentication():
     if 'user' not in st.session_state:
         st.session_state.user = None
@@ -377,9 +200,41 @@ def auth0_authentication():
         st.stop()
     return st.session_state.user  # Simplified; replace with proper Auth0 later
 
+_rerun_state = threading.local()
+
+@contextmanager
+def rerun_context(label):
+    """Instrumentation and database session for a rerun; a fragment that runs within a full rerun uses the rerun's."""
+    if getattr(_rerun_state, 'active', False):
+        yield
+        return
+    _rerun_state.active = True
+    try:
+        with instrumentation.rerun(label), db.rerun_scope():
+            yield
+    finally:
+        _rerun_state.active = False
+
+def live_fragment(run_every):
+    """st.fragment(run_every=...) whose timed reruns, which skip main(), get a rerun_context of their own."""
+    def decorate(func):
+        @functools.wraps(func)
+        def run(*args, **kwargs):
+            with rerun_context(func.__name__):
+                return func(*args, **kwargs)
+        return st.fragment(run, run_every=run_every)
+    return decorate
+
 def main():
+    with rerun_context(lambda: st.session_state.get('current_page')):
+        render_app()
+
+# Pages that read the database wait for the one-time server bootstrap; the rest render immediately
+BOOTSTRAP_FREE_PAGES = {"🏠 Home", "🛍️ Services", "📹 LIVE SHOP"}
+
+def render_app():
     st.markdown("<h1 style='text-align: center;'>🚚 Local Butler</h1>", unsafe_allow_html=True)
-    populate_merchants()
+    ready = bootstrap.start(engine)
 
     user = auth0_authentication()
 
@@ -405,13 +260,44 @@ def main():
             if cols[i].button(emoji_label, key=emoji_label):
                 st.session_state.current_page = emoji_label
 
-        menu_items[st.session_state.current_page]()
+        if ready or st.session_state.current_page in BOOTSTRAP_FREE_PAGES:
+            with instrumentation.span(f"page {st.session_state.current_page}"):
+                menu_items[st.session_state.current_page]()
+        elif bootstrap.status()['phase'] == 'failed':
+            st.error("Local Butler failed to start. Retrying shortly…")
+        else:
+            st.info("Local Butler is getting ready. This page will be available in a moment.")
 
         if st.sidebar.button("🚪 Log Out"):
             st.session_state.user = None
             st.session_state.current_page = "🏠 Home"
             st.success("Logged out successfully.")
 
+        if instrumentation.is_enabled() and user.type == ADMIN_USER_TYPE:
+            debug_panel()
+
+ADMIN_USER_TYPE = 'admin'
+
+def debug_panel():
+    # Opt-in per session; needs INSTRUMENTATION=1 on the server
+    if not st.sidebar.checkbox("🔧 Debug panel", key="debug_panel"):
+        return
+    stats = instrumentation.current_rerun()
+    if stats is None:
+        return
+    st.sidebar.markdown(f"**This rerun so far**: {stats.elapsed() * 1000:.0f} ms, "
+                        f"{stats.queries} queries ({stats.sql_seconds * 1000:.1f} ms SQL)")
+    if stats.spans:
+        st.sidebar.table([
+            {'span': name, 'calls': count, 'ms': round(seconds * 1000, 1)}
+            for name, (count, seconds) in sorted(stats.spans.items(), key=lambda item: -item[1][1])
+        ])
+    for seconds, statement in stats.slowest():
+        st.sidebar.caption(f"{seconds * 1000:.2f} ms")
+        st.sidebar.code(' '.join(statement.split())[:500], language='sql')
+    with st.sidebar.expander("Pool and caches"):
+        st.json({'pool': db.pool_metrics(engine), 'order cache': order_cache.stats(), 'bootstrap': bootstrap.status()})
+
 def home_page():
     st.markdown("<h1 style='text-align: center;'>Welcome to Local Butler!</h1>", unsafe_allow_html=True)
     st.write(f"Hello, {st.session_state.user.name}! 🎉")
@@ -460,13 +346,39 @@ def home_page():
                 st.session_state.selected_service = service['name']
                 st.experimental_rerun()
 
+MAX_PROVIDER_CHOICES = 25
+
+def current_catalog():
+    # In memory; the database is only asked every few seconds whether merchants changed, once it is set up
+    with instrumentation.span("catalog"):
+        return get_catalog(get_db_session() if bootstrap.is_ready() else None)
+
+def providers_by_distance(service_type, address):
+    # Nearest merchants of this type first, then any listed provider that isn't on the map yet
+    catalog = current_catalog()
+    providers = catalog.names_by_type.get(service_type, ())
+    location = poll_geocode(address)
+    if not location:
+        return providers, {}
+    try:
+        with instrumentation.span("merchant lookup"):
+            merchant_index.ensure_fresh(get_db_session())
+            nearby = merchant_index.nearest(location.latitude, location.longitude, k=MAX_PROVIDER_CHOICES, type_=service_type)
+        # Merchants added since the catalog's last reload show up after its next one
+        distances = {catalog.by_id[merchant_id].name: distance for merchant_id, distance in nearby if merchant_id in catalog.by_id}
+    except Exception as e:
+        logger.error(f"Provider distance error: {e}")
+        return providers, {}
+    ordered = list(distances) + [name for name in providers if name not in distances]
+    return ordered, distances
+
 def place_order():
     st.subheader("🛒 Place a New Order")
     if 'order_state' not in st.session_state:
         st.session_state.order_state = {
             'selected_service_type': None,
             'selected_provider': None,
-            'date': datetime.now().date(),
+            'date': service_now().date(),
             'time': "07:00 AM EST",
             'address': st.session_state.user.address or "",
             'review_clicked': False,
@@ -475,17 +387,31 @@ def place_order():
         }
     
     state = st.session_state.order_state
+    schedule = get_schedule()
+    try:
+        schedule.refresh(get_db_session())
+    except Exception as e:
+        logger.error(f"Schedule refresh error: {e}")
+    # Outside the form so the time slots follow the chosen date
+    state['date'] = st.date_input("Select Date", min_value=service_now().date(), value=state['date'])
+    slots = schedule.available_slots(state['date'])
+    if not slots:
+        st.warning("No delivery slots left on this date. Next available: "
+                   + (", ".join(f"{slot:%b %d} {format_slot(slot)}" for slot in schedule.next_free_slots(service_now(), n=3)) or "none"))
     
     with st.form("order_form"):
-        service_type = st.selectbox("Select Service Type", list(SERVICES.keys()), key='selected_service_type')
+        service_type = st.selectbox("Select Service Type", current_catalog().types, key='selected_service_type')
         state['selected_service_type'] = service_type
-        provider = st.selectbox("Select Provider", list(SERVICES[service_type].keys()), key='selected_provider')
-        state['selected_provider'] = provider
-        state['date'] = st.date_input("Select Date", min_value=datetime.now().date(), value=state['date'])
-        state['time'] = st.selectbox(
-            "Select Time",
-            [f"{h:02d}:{m:02d} {'AM' if h < 12 else 'PM'} EST" for h in range(7, 22) for m in [0, 15, 30, 45]]
+        providers, distances = providers_by_distance(service_type, state['address'])
+        provider = st.selectbox(
+            "Select Provider",
+            providers,
+            format_func=lambda name: f"{name} ({distances[name]:.1f} km)" if name in distances else name,
+            key='selected_provider'
         )
+        state['selected_provider'] = provider
+        state['slot_start'] = st.selectbox("Select Time", slots, format_func=format_slot)
+        state['time'] = format_slot(state['slot_start']) if state['slot_start'] else None
         state['address'] = st.text_input("Service Address", value=state['address'])
         
         if service_type == "Laundry":
@@ -500,6 +426,9 @@ def place_order():
     
     if submit_button:
         state['review_clicked'] = True
+        # A new review is a new order; until then repeated payment attempts reuse the same one
+        state.pop('checkout_order_id', None)
+        state.pop('checkout', None)
     
     if state['review_clicked']:
         with st.expander("Order Details", expanded=True):
@@ -513,8 +442,8 @@ def place_order():
             
             session = get_db_session()
             try:
-                merchant = session.query(Merchant).filter_by(name=state['selected_provider']).first()
-                if not merchant:
+                merchant = current_catalog().by_name.get(state['selected_provider'])
+                if merchant is None or merchant.merchant_id is None:
                     st.error(f"Provider {state['selected_provider']} not found.")
                     return
                 
@@ -523,77 +452,149 @@ def place_order():
                         if not all([state['selected_provider'], state['date'], state['time'], state['address'], state['total_amount']]):
                             st.error("Please fill in all fields.")
                         else:
-                            order_id = generate_order_id()
-                            checkout_session = create_stripe_checkout_session(order_id, state['total_amount'], state['selected_service_type'])
-                            if checkout_session:
-                                new_order = Order(
-                                    id=order_id,
+                            order_id = state.get('checkout_order_id')
+                            if order_id is None:
+                                order_id = generate_order_id()
+                                create_order(
+                                    session,
+                                    order_id=order_id,
                                     user_id=st.session_state.user.id,
-                                    merchant_id=merchant.id,
+                                    merchant_id=merchant.merchant_id,
                                     service=state['selected_service_type'],
                                     date=state['date'],
                                     time=state['time'],
                                     address=state['address'],
-                                    status='Pending',
-                                    payment_status='Pending',
                                     payment_method='Online',
-                                    total_amount=state['total_amount']
+                                    total_amount=state['total_amount'],
+                                    slot_start=state['slot_start']
                                 )
-                                session.add(new_order)
-                                session.commit()
-                                st.markdown(
-                                    f"""
-                                    <script src="https://js.stripe.com/v3/"></script>
-                                    <script>
-                                        var stripe = Stripe('{STRIPE_PUBLISHABLE_KEY}');
-                                        stripe.redirectToCheckout({{ sessionId: '{checkout_session.id}' }});
-                                    </script>
-                                    """,
-                                    unsafe_allow_html=True
-                                )
-                                state['review_clicked'] = False
-                            else:
-                                st.error("Payment failed.")
+                                state['checkout_order_id'] = order_id
+                                state['checkout_attempt'] = 0
+                            state['checkout'] = start_stripe_checkout(order_id, state['total_amount'], state['selected_service_type'],
+                                                                      attempt=state.get('checkout_attempt', 0))
+                            state['review_clicked'] = False
                 else:
                     if st.button("✅ Confirm In-Person Payment"):
                         if not all([state['selected_provider'], state['date'], state['time'], state['address'], state['total_amount']]):
                             st.error("Please fill in all fields.")
                         else:
                             order_id = generate_order_id()
-                            new_order = Order(
-                                id=order_id,
+                            create_order(
+                                session,
+                                order_id=order_id,
                                 user_id=st.session_state.user.id,
-                                merchant_id=merchant.id,
+                                merchant_id=merchant.merchant_id,
                                 service=state['selected_service_type'],
                                 date=state['date'],
                                 time=state['time'],
                                 address=state['address'],
-                                status='Pending',
-                                payment_status='Pending',
                                 payment_method='In-Person',
-                                total_amount=state['total_amount']
+                                total_amount=state['total_amount'],
+                                slot_start=state['slot_start']
                             )
-                            session.add(new_order)
-                            session.commit()
                             st.success(f"Order {order_id} created! Payment will be collected in-person.")
                             state['review_clicked'] = False
+            except SlotUnavailable as e:
+                st.error(f"{e}. Please pick another time.")
             except Exception as e:
+                session.rollback()
                 logger.error(f"Place order error: {e}")
                 st.error("An error occurred while placing the order.")
 
-@st.cache_data
-def get_user_orders(user_id):
+    if state.get('checkout'):
+        checkout_redirect(state)
+
+# The checkout session is created in the background; poll for it this often
+CHECKOUT_POLL_SECONDS = 1
+
+@live_fragment(CHECKOUT_POLL_SECONDS)
+def checkout_redirect(state):
+    future = state['checkout']
+    if not future.done():
+        st.info("⏳ Preparing secure checkout…")
+        return
+    try:
+        checkout_session = future.result()
+    except Exception as e:
+        logger.error(f"Stripe error: {e}")
+        st.error("Payment processing failed.")
+        if st.button("🔁 Retry Payment"):
+            from payments import retry_attempt
+            state['checkout_attempt'] = retry_attempt(state.get('checkout_attempt', 0), e)
+            state['checkout'] = start_stripe_checkout(state['checkout_order_id'], state['total_amount'], state['selected_service_type'],
+                                                      attempt=state['checkout_attempt'])
+        return
+    st.success(f"Order {state['checkout_order_id']} created! Redirecting to payment…")
+    st.markdown(
+        f"""
+        <script src="https://js.stripe.com/v3/"></script>
+        <script>
+            var stripe = Stripe('{STRIPE_PUBLISHABLE_KEY}');
+            stripe.redirectToCheckout({{ sessionId: '{checkout_session.id}' }});
+        </script>
+        """,
+        unsafe_allow_html=True
+    )
+
+# Live pages re-run as fragments this often; a tick only reads the database if an order event arrived
+LIVE_REFRESH_SECONDS = 2
+ROUTE_REPLAN_SECONDS = 15
+
+def watch_orders(name, topics, load, key=None, max_age=None):
+    """load()'s result, kept in session state until an order event on one of the topics (or key changes)."""
+    version = order_events.version(*topics)
+    cached = st.session_state.get(f"watch_{name}")
+    if (cached is None or cached['version'] != version or cached['key'] != key
+            or (max_age and time.monotonic() - cached['loaded_at'] > max_age)):
+        cached = {'version': version, 'key': key, 'loaded_at': time.monotonic(), 'value': load()}
+        st.session_state[f"watch_{name}"] = cached
+    return cached['value']
+
+def load_order_pages(first_page, next_page, pages):
+    """Rows of the first `pages` pages of a keyset-paged listing, and the cursor to load more from."""
+    page = first_page()
+    rows = list(page.rows)
+    for _ in range(pages - 1):
+        if page.next_cursor is None:
+            break
+        page = next_page(page.next_cursor)
+        rows += page.rows
+    return rows, page.next_cursor
+
+def load_more(pages_key):
+    # A button callback, so the click's rerun already renders the extra page
+    st.session_state[pages_key] = st.session_state.get(pages_key, 1) + 1
+
+def get_user_orders(user_id, pages=1):
     session = get_db_session()
     try:
-        orders = session.query(Order).filter_by(user_id=user_id).limit(50).all()
-        return orders
+        return load_order_pages(lambda: cached_order_page_for_user(session, user_id),
+                                lambda after: get_order_page_for_user(session, user_id, after=after), pages)
     except Exception as e:
         logger.error(f"Get user orders error: {e}")
-        return []
+        return [], None
 
 def display_user_orders():
     st.subheader("📦 My Orders")
-    user_orders = get_user_orders(st.session_state.user.id)
+    live_user_orders(st.session_state.user.id)
+
+STATUS_EMOJIS = {PENDING: '⏳', PREPARING: '👨‍🍳', ON_THE_WAY: '🚚', DELIVERED: '✅'}
+
+def get_status_histories(order_ids):
+    session = get_db_session()
+    try:
+        return status_histories(session, order_ids)
+    except Exception as e:
+        logger.error(f"Get status history error: {e}")
+        return {}
+
+@live_fragment(LIVE_REFRESH_SECONDS)
+def live_user_orders(user_id):
+    pages = st.session_state.get('user_order_pages', 1)
+    def load():
+        orders, more = get_user_orders(user_id, pages)
+        return orders, more, get_status_histories([order.id for order in orders])
+    user_orders, more, histories = watch_orders('user_orders', [('user', user_id)], load, key=pages)
     if not user_orders:
         st.info("No orders yet.")
     else:
@@ -606,67 +607,73 @@ def display_user_orders():
                 st.write(f"**Total**: ${order.total_amount:.2f}")
                 st.write(f"**Payment Status**: {order.payment_status}")
                 st.write(f"**Payment Method**: {order.payment_method}")
-                session = get_db_session()
-                try:
-                    merchant = session.query(Merchant).filter_by(id=order.merchant_id).first()
-                    if merchant:
-                        st.write(f"**Merchant**: {merchant.name}")
-                except Exception as e:
-                    logger.error(f"Merchant query error: {e}")
-                statuses = ['Pending', 'Preparing', 'On the way', 'Delivered']
-                status_emojis = ['⏳', '👨‍🍳', '🚚', '✅']
-                try:
-                    current_status_index = statuses.index(order.status)
-                except ValueError:
-                    current_status_index = 0
-                progress = (current_status_index + 1) * 25
-                st.progress(progress)
-                cols = st.columns(4)
-                for i, (status, emoji) in enumerate(zip(statuses, status_emojis)):
-                    cols[i].markdown(
-                        f"<p style='text-align: center; color: {'blue' if i == current_status_index else 'green' if i < current_status_index else 'gray'}'>{emoji}<br>{status}</p>",
-                        unsafe_allow_html=True
-                    )
+                if order.merchant_name:
+                    st.write(f"**Merchant**: {order.merchant_name}")
+                if order.status in PROGRESS_STATUSES:
+                    current_status_index = PROGRESS_STATUSES.index(order.status)
+                    progress = (current_status_index + 1) * 25
+                    st.progress(progress)
+                    cols = st.columns(4)
+                    for i, status in enumerate(PROGRESS_STATUSES):
+                        cols[i].markdown(
+                            f"<p style='text-align: center; color: {'blue' if i == current_status_index else 'green' if i < current_status_index else 'gray'}'>{STATUS_EMOJIS[status]}<br>{status}</p>",
+                            unsafe_allow_html=True
+                        )
+                elif order.status == CANCELLED:
+                    st.error("❌ This order was cancelled.")
+                else:
+                    st.warning(f"Status: {order.status}")
+                for from_status, to_status, changed_at in histories.get(order.id, []):
+                    st.caption(f"{changed_at:%b %d %I:%M %p} · {f'{from_status} → ' if from_status else ''}{to_status}")
+                if order.status == PENDING and st.button("Cancel Order", key=f"cancel_{order.id}"):
+                    session = get_db_session()
+                    try:
+                        cancel_order(session, order.id, actor_id=user_id)
+                        st.success(f"Order {order.id} cancelled.")
+                    except (InvalidTransition, StatusConflict):
+                        st.warning("This order can no longer be cancelled.")
+                    except Exception as e:
+                        logger.error(f"Cancel order error: {e}")
+                        st.error("Failed to cancel order.")
+        if more:
+            st.button("Load more orders", key="user_orders_more", on_click=load_more, args=('user_order_pages',))
 
 def display_map():
     st.subheader("🗺️ Service Map")
     service_type = st.session_state.get('selected_service', None)
-    map_hash = str(random.randint(0, 1000000))  # Force cache refresh if needed
-    map_obj = create_map(map_hash, service_type=service_type)
-    if map_obj:
-        folium_static(map_obj)
+    address = st.session_state.user.address
+    near = poll_geocode(address)
+    if address and not near:
+        st.caption("Locating your address… the map will center on it once it is found.")
+    map_html = create_map(service_type=service_type, near=near)
+    if map_html:
+        components.html(map_html, height=510)
 
 def display_services():
     st.subheader("🛍️ Available Services")
     selected_service = st.session_state.get('selected_service', None)
-    services_to_show = [selected_service] if selected_service else SERVICES.keys()
+    catalog = current_catalog()
+    services_to_show = [selected_service] if selected_service else catalog.types
     
     for service_name in services_to_show:
         st.markdown(f"### {service_name}")
-        for provider_name, provider_info in SERVICES[service_name].items():
-            with st.expander(provider_name):
-                display_service(Service(
-                    name=provider_name,
-                    url=provider_info['url'],
-                    instructions=provider_info['instructions'],
-                    address=provider_info.get('address'),
-                    phone=provider_info.get('phone'),
-                    hours=provider_info.get('hours')
-                ))
+        for provider in catalog.by_type.get(service_name, ()):
+            with st.expander(provider.name):
+                display_service(provider)
 
 def display_subscriptions():
     st.subheader("🤝 Partner Subscriptions")
     st.write("Subscribe to premium services for exclusive benefits!")
     session = get_db_session()
     try:
-        for partner_name, partner_info in PARTNERSHIPS.items():
+        for partner_name, partner in current_catalog().partners.items():
             with st.expander(partner_name):
-                if partner_info.get('image_url'):
-                    st.image(partner_info['image_url'], caption=partner_name, use_column_width=True)
-                st.write(f"**Description**: {partner_info['description']}")
+                if partner.image_url:
+                    st.image(partner.image_url, caption=partner_name, use_column_width=True)
+                st.write(f"**Description**: {partner.description}")
                 if st.button(f"Subscribe to {partner_name}", key=f"sub_{partner_name}"):
-                    st.markdown(f"[Start Your Subscription]({partner_info['subscription_url']})")
-                    subscription_id = f"SUB-{random.randint(10000, 99999)}"
+                    st.markdown(f"[Start Your Subscription]({partner.subscription_url})")
+                    subscription_id = new_subscription_id()
                     new_subscription = Subscription(
                         user_id=st.session_state.user.id,
                         partner_name=partner_name,
@@ -677,125 +684,342 @@ def display_subscriptions():
                     session.commit()
                     st.success(f"Subscribed to {partner_name}!")
     except Exception as e:
+        session.rollback()
         logger.error(f"Subscriptions error: {e}")
         st.error("Failed to process subscription.")
 
-@st.cache_data
-def get_pending_orders():
+def format_minutes(minutes):
+    if minutes < 0:
+        return f"{-minutes:.0f} min overdue"
+    if minutes < 120:
+        return f"in {minutes:.0f} min"
+    return f"in {minutes / 60:.1f} h"
+
+def get_pending_orders(pages=1):
     session = get_db_session()
     try:
-        orders = session.query(Order).filter_by(status='Pending').limit(50).all()
-        return orders
+        return load_order_pages(lambda: cached_order_page_by_status(session, PENDING),
+                                lambda after: get_order_page_by_status(session, PENDING, after=after), pages)
     except Exception as e:
         logger.error(f"Get pending orders error: {e}")
+        return [], None
+
+DRIVER_ORDER_CHOICES = 50
+DUE_SOON_MINUTES = 30
+
+def get_orders_due_soon():
+    session = get_db_session()
+    try:
+        return get_order_rows_due(session, *due_window(DUE_SOON_MINUTES))
+    except Exception as e:
+        logger.error(f"Get due orders error: {e}")
         return []
 
-def driver_dashboard():
-    st.subheader("🚗 Driver Dashboard")
-    orders_container = st.container()
-    with orders_container:
-        available_orders = get_pending_orders()
-        if not available_orders:
-            st.info("No pending orders.")
-        else:
-            for order in available_orders:
-                with st.expander(f"📦 Order ID: {order.id}"):
-                    st.write(f"**Service**: {order.service}")
-                    st.write(f"**Address**: {order.address}")
-                    st.write(f"**Total**: ${order.total_amount:.2f}")
-                    st.write(f"**Payment Method**: {order.payment_method}")
+def minutes_until(timestamp):
+    return (timestamp - datetime.now(timezone.utc)).total_seconds() / 60
+
+def get_unranked_pending_orders(pages):
+    orders, more = get_pending_orders(pages)
+    return [(order, None) for order in orders], more
+
+def get_ranked_pending_orders(location, pages=1):
+    """Pending orders nearest-pickup/soonest-slot first for a driver at location, and whether more can be
+    loaded (only when unranked: oldest first, a page at a time, while the location is unknown)."""
+    if not location:
+        return get_unranked_pending_orders(pages)
+    session = get_db_session()
+    try:
+        ranked = cached_dispatch_board(session).rank(location.latitude, location.longitude, k=DRIVER_ORDER_CHOICES)
+        rows = get_order_rows_by_ids(session, [choice.order_id for choice in ranked])
+        by_id = {choice.order_id: choice for choice in ranked}
+        return [(order, by_id[order.id]) for order in rows], None
+    except Exception as e:
+        logger.error(f"Rank pending orders error: {e}")
+        return get_unranked_pending_orders(pages)
+
+def plan_suggested_runs(order_ids, location):
+    session = get_db_session()
+    try:
+        route_orders = load_route_orders(session, order_ids, get_geocoder())
+    except Exception as e:
+        logger.error(f"Route planning error: {e}")
+        return []
+    start = (location.latitude, location.longitude) if location else None
+    return [run for run in plan_runs(route_orders, start=start) if len(run.orders) > 1]
+
+def display_suggested_runs(runs, location):
+    if not runs:
+        return
+    from maps import route_map_html
+    start = (location.latitude, location.longitude) if location else None
+    st.markdown("### 🧭 Suggested Runs")
+    for run in runs:
+        with st.expander(f"{len(run.orders)} orders · {run.distance_km:.1f} km (saves {run.savings_km:.1f} km)"):
+            for number, stop in enumerate(run.stops, 1):
+                action = "Pick up" if stop.kind == 'pickup' else "Drop off"
+                st.write(f"{number}. **{action}** {stop.label} ({', '.join(stop.order_ids)})")
+            components.html(route_map_html(run.stops, start=start), height=400)
+            if st.button("✅ Accept Run", key=f"accept_run_{run.order_ids[0]}"):
+                session = get_db_session()
+                try:
+                    claimed = [order_id for order_id in run.order_ids if claim_order(session, order_id, st.session_state.user.id)]
+                    if len(claimed) == len(run.orders):
+                        st.success(f"Accepted {len(claimed)} orders!")
+                    elif claimed:
+                        st.warning(f"Accepted {', '.join(claimed)}; the other orders were already taken.")
+                    else:
+                        st.warning("These orders were already taken by other drivers.")
+                except Exception as e:
+                    session.rollback()
+                    logger.error(f"Accept run error: {e}")
+                    st.error("Failed to accept run.")
+
+def get_driver_orders(driver_id):
+    session = get_db_session()
+    try:
+        return get_order_rows_for_driver(session, driver_id)
+    except Exception as e:
+        logger.error(f"Get driver orders error: {e}")
+        return []
+
+@live_fragment(LIVE_REFRESH_SECONDS)
+def live_driver_deliveries(driver_id):
+    topics = [('status', status) for status in (PREPARING, ON_THE_WAY, DELIVERED, CANCELLED)]
+    deliveries = watch_orders('driver_deliveries', topics, lambda: get_driver_orders(driver_id))
+    if not deliveries:
+        return
+    st.markdown("### 🚚 My Deliveries")
+    for order in deliveries:
+        with st.expander(f"{STATUS_EMOJIS.get(order.status, '')} {order.id} - {order.status}"):
+            st.write(f"**Pickup**: {order.merchant_name}")
+            st.write(f"**Address**: {order.address}")
+            if order.scheduled_at:
+                st.write(f"**Slot**: {order.time} ({format_minutes(minutes_until(order.scheduled_at))})")
+            else:
+                st.write(f"**Slot**: {order.time}")
+            for status in next_statuses(order.status):
+                if status == CANCELLED:
+                    continue
+                if st.button(f"Mark {status}", key=f"advance_{order.id}_{status}"):
                     session = get_db_session()
                     try:
-                        merchant = session.query(Merchant).filter_by(id=order.merchant_id).first()
-                        if merchant:
-                            st.write(f"**Pickup**: {merchant.name}")
+                        update_order_status(session, order.id, status, actor_id=driver_id)
+                        st.success(f"Order {order.id} is now {status}.")
+                    except (InvalidTransition, StatusConflict) as e:
+                        st.warning(str(e))
                     except Exception as e:
-                        logger.error(f"Merchant query error: {e}")
-                    if order.service == "Laundry":
-                        st.info("Verify laundry weight at pick-up.")
-                    if order.payment_method == "In-Person":
-                        st.warning("Collect payment via Tap to Pay.")
-                    if st.button(f"✅ Accept Order {order.id}", key=f"accept_{order.id}"):
-                        session = get_db_session()
-                        try:
-                            order_to_update = session.query(Order).filter_by(id=order.id).first()
-                            if order_to_update:
-                                order_to_update.status = 'Preparing'
-                                session.commit()
-                                st.success(f"Accepted order {order.id}!")
-                        except Exception as e:
-                            logger.error(f"Accept order error: {e}")
-                            st.error("Failed to accept order.")
-    if st.button("Refresh Orders"):
-        st.experimental_rerun()
+                        logger.error(f"Update order status error: {e}")
+                        st.error("Failed to update order.")
+
+def driver_dashboard():
+    st.subheader("🚗 Driver Dashboard")
+    live_driver_deliveries(st.session_state.user.id)
+    driver_address = st.text_input("Your Location", value=st.session_state.user.address or "", key='driver_location')
+    location = poll_geocode(driver_address)
+    if driver_address and not location:
+        st.caption("Locating you… orders are shown unranked until then.")
+    live_pending_orders(location)
+
+@live_fragment(LIVE_REFRESH_SECONDS)
+def live_pending_orders(location):
+    topics = [('status', PENDING)]
+    # Re-read every minute as well, since orders move into the window without any event
+    due_soon = watch_orders('driver_due_soon', topics, get_orders_due_soon, max_age=60)
+    if due_soon:
+        st.warning(f"⏰ Due in the next {DUE_SOON_MINUTES} minutes: "
+                   + ", ".join(f"{order.id} ({format_minutes(minutes_until(order.scheduled_at))})" for order in due_soon))
+    pages = st.session_state.get('pending_order_pages', 1)
+    available_orders, more = watch_orders('driver_orders', topics, lambda: get_ranked_pending_orders(location, pages),
+                                          key=(location, pages))
+    if not available_orders:
+        st.info("No pending orders.")
+        return
+    order_ids = [order.id for order, _ in available_orders]
+    # Runs also wait on drop-off addresses being geocoded, so they are re-planned now and then as well
+    runs = watch_orders('driver_runs', topics, lambda: plan_suggested_runs(order_ids, location),
+                        key=(location, tuple(order_ids)), max_age=ROUTE_REPLAN_SECONDS)
+    display_suggested_runs(runs, location)
+    for order, choice in available_orders:
+        label = f"📦 Order ID: {order.id}"
+        if choice and math.isfinite(choice.pickup_km):
+            label += f" - {choice.pickup_km:.1f} km to pickup"
+        with st.expander(label):
+            if choice:
+                st.write(f"**Slot**: {order.time} ({format_minutes(choice.minutes_to_slot)})")
+            st.write(f"**Service**: {order.service}")
+            st.write(f"**Address**: {order.address}")
+            st.write(f"**Total**: ${order.total_amount:.2f}")
+            st.write(f"**Payment Method**: {order.payment_method}")
+            if order.merchant_name:
+                st.write(f"**Pickup**: {order.merchant_name}")
+            if order.service == "Laundry":
+                st.info("Verify laundry weight at pick-up.")
+            if order.payment_method == "In-Person":
+                st.warning("Collect payment via Tap to Pay.")
+            if st.button(f"✅ Accept Order {order.id}", key=f"accept_{order.id}"):
+                session = get_db_session()
+                try:
+                    if claim_order(session, order.id, st.session_state.user.id):
+                        st.success(f"Accepted order {order.id}!")
+                    else:
+                        st.warning(f"Order {order.id} was already taken by another driver.")
+                except Exception as e:
+                    session.rollback()
+                    logger.error(f"Accept order error: {e}")
+                    st.error("Failed to accept order.")
+    if more:
+        st.button("Load more orders", key="pending_orders_more", on_click=load_more, args=('pending_order_pages',))
+
+@live_fragment(LIVE_REFRESH_SECONDS)
+def live_video_stats(pipelines):
+    for pipeline in pipelines:
+        stats = pipeline.stats()
+        if stats['frames']:
+            st.caption(f"{pipeline.overlay.text}: {stats['frames']} frames · {stats['p50_ms']:.2f} ms p50 · "
+                       f"{stats['p95_ms']:.2f} ms p95 (budget {stats['budget_ms']:.1f} ms) · {stats['level']}")
+
+LIVE_SHOP_TYPES = ("Groceries", "Restaurants")
+CHAT_REFRESH_SECONDS = 1
+# Associates can join customer sessions with messages this recent
+CHAT_ROOM_WINDOW = timedelta(hours=2)
+
+@live_fragment(CHAT_REFRESH_SECONDS)
+def live_chat(store, session_id, role):
+    # A tick reads the database only on first use; new messages come from this process's chat ring buffer
+    key = f"chat_{store}_{session_id}"
+    if key not in st.session_state:
+        st.session_state[key] = RoomCursor(store, session_id)
+    cursor = st.session_state[key]
+    session = get_db_session()
+    try:
+        cursor.refresh(session)
+        if cursor.has_older and st.button("Load earlier messages", key=f"{key}_older"):
+            cursor.load_older(session)
+    except Exception as e:
+        logger.error(f"Chat load error: {e}")
+        st.error("Failed to load chat.")
+    messages_area = st.container()
+    with st.form(f"{key}_form", clear_on_submit=True):
+        user_message = st.text_input("Type your message:")
+        if st.form_submit_button("Send") and user_message.strip():
+            try:
+                cursor.add([send_message(session, store, session_id, st.session_state.user.id, role, user_message)])
+            except (ValueError, NotAnAssociate) as e:
+                st.warning(str(e))
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Chat send error: {e}")
+                st.error("Failed to send message.")
+    with messages_area:
+        for message in cursor.messages:
+            sender = "You" if message.sender_role == role else store if message.sender_role == ASSOCIATE else "Customer"
+            st.text(f"{sender}: {message.body}")
+
+def select_customer_session(store):
+    session = get_db_session()
+    try:
+        rooms = active_rooms(session, store, since=datetime.now() - CHAT_ROOM_WINDOW)
+    except Exception as e:
+        logger.error(f"Active rooms error: {e}")
+        rooms = []
+    if not rooms:
+        st.info("No customers are in a live session right now.")
+        return None
+    return st.selectbox("Customer session", [session_id for session_id, _ in rooms],
+                        format_func=lambda session_id: f"{session_id} (last message {dict(rooms)[session_id]:%I:%M %p})")
 
 def live_shop():
     st.subheader("📹 LIVE SHOP")
-    all_stores = {**SERVICES["Groceries"], **SERVICES["Restaurants"]}
+    catalog = current_catalog()
+    stores = catalog.names_of(*LIVE_SHOP_TYPES)
     if 'live_shop_state' not in st.session_state:
         st.session_state.live_shop_state = {
             'selected_store': None,
             'live_session_active': False,
-            'chat_messages': []
+            'live_session_id': None
         }
     
     state = st.session_state.live_shop_state
-    selected_store = st.selectbox("Select a Store", list(all_stores.keys()), index=0 if state['selected_store'] is None else list(all_stores.keys()).index(state['selected_store']))
+    selected_store = st.selectbox("Select a Store", stores, index=stores.index(state['selected_store']) if state['selected_store'] in stores else 0)
     
     if selected_store != state['selected_store']:
         state['selected_store'] = selected_store
         state['live_session_active'] = False
-        state['chat_messages'] = []
+        state['live_session_id'] = None
+        state['video_pipelines'] = {}
     
     if not state['selected_store']:
         st.warning("Please select a store.")
         return
     
-    store_info = all_stores[state['selected_store']]
-    st.write(f"**Address**: {store_info['address']}")
-    st.write(f"**Phone**: {store_info['phone']}")
+    store_info = catalog.by_name[state['selected_store']]
+    if store_info.address:
+        st.write(f"**Address**: {store_info.address}")
+    if store_info.phone:
+        st.write(f"**Phone**: {store_info.phone}")
+    
+    # The chat needs the database; the video works before the server bootstrap has finished
+    chat_ready = bootstrap.is_ready()
+    user = st.session_state.user
+    if user.type == ASSOCIATE_USER_TYPE and not chat_ready:
+        st.info("Live sessions will be listed in a moment.")
+        return
+    # Only the store's own associates see its customers' rooms; everyone else joins as a customer
+    try:
+        role = chat_role(get_db_session(), user, state['selected_store']) if chat_ready else CUSTOMER
+    except Exception as e:
+        logger.error(f"Chat role error: {e}")
+        role = CUSTOMER
+    if role == ASSOCIATE:
+        customer_session = select_customer_session(state['selected_store'])
+        if customer_session is None:
+            return
+        if customer_session != state['live_session_id']:
+            state['live_session_id'] = customer_session
+            state['live_session_active'] = False
     
     if st.button("START LIVE SESSION" if not state['live_session_active'] else "END LIVE SESSION"):
         state['live_session_active'] = not state['live_session_active']
         if state['live_session_active']:
             st.info("Starting live session...")
-            time.sleep(1)
+            if role == CUSTOMER:
+                # A new room per session; the greeting is what lists it for the store's associates
+                state['live_session_id'] = new_id('LIVE')
+                if chat_ready:
+                    try:
+                        send_message(get_db_session(), state['selected_store'], state['live_session_id'],
+                                     st.session_state.user.id, CUSTOMER, "👋 Joined the live session")
+                    except Exception as e:
+                        logger.error(f"Chat send error: {e}")
     
     if state['live_session_active']:
+        from streamlit_webrtc import webrtc_streamer
+        from live_video import LIVE_VIDEO_FPS, label_pipeline
         col1, col2 = st.columns(2)
-        with col1:
-            st.markdown("**Your Camera**")
-            def user_video_frame_callback(frame):
-                img = frame.to_ndarray(format="bgr24")
-                cv2.putText(img, "User - Local Butler", (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                return av.VideoFrame.from_ndarray(img, format="bgr24")
-            webrtc_streamer(
-                key=f"user_live_shop_{state['selected_store']}",
-                video_frame_callback=user_video_frame_callback,
-                rtc_configuration={"iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]},
-                media_stream_constraints={"video": {"width": 320, "height": 240, "frameRate": 15}, "audio": True}
-            )
-        with col2:
-            st.markdown(f"**{state['selected_store']} Associate**")
-            def merchant_video_frame_callback(frame):
-                img = frame.to_ndarray(format="bgr24")
-                cv2.putText(img, state['selected_store'], (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
-                return av.VideoFrame.from_ndarray(img, format="bgr24")
-            webrtc_streamer(
-                key=f"merchant_live_shop_{state['selected_store']}",
-                video_frame_callback=merchant_video_frame_callback,
-                rtc_configuration={"iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]},
-                media_stream_constraints={"video": {"width": 320, "height": 240, "frameRate": 15}, "audio": True}
-            )
+        # One pipeline per stream for the whole session: the overlays are rendered once and the timings accumulate
+        pipelines = state.setdefault('video_pipelines', {})
+        streams = (
+            (col1, "**Your Camera**", f"user_live_shop_{state['selected_store']}", "User - Local Butler"),
+            (col2, f"**{state['selected_store']} Associate**", f"merchant_live_shop_{state['selected_store']}", state['selected_store']),
+        )
+        for col, title, key, label in streams:
+            with col:
+                st.markdown(title)
+                if key not in pipelines:
+                    pipelines[key] = label_pipeline(label)
+                webrtc_streamer(
+                    key=key,
+                    video_frame_callback=pipelines[key],
+                    rtc_configuration={"iceServers": [{"urls": ["stun:stun.l.google.com:19302"]}]},
+                    media_stream_constraints={"video": {"width": 320, "height": 240, "frameRate": LIVE_VIDEO_FPS}, "audio": True}
+                )
+        live_video_stats([pipelines[key] for _, _, key, _ in streams])
         
-        st.markdown(f"**Chat with {state['selected_store']}**")
-        for message in state['chat_messages']:
-            st.text(message)
-        user_message = st.text_input("Type your message:", key=f"chat_input_{state['selected_store']}")
-        if st.button("Send", key=f"send_chat_{state['selected_store']}"):
-            if user_message:
-                state['chat_messages'].append(f"You: {user_message}")
-                st.experimental_rerun()
+        st.markdown(f"**Chat with {state['selected_store'] if role == CUSTOMER else 'the customer'}**")
+        if chat_ready:
+            live_chat(state['selected_store'], state['live_session_id'], role)
+        else:
+            st.info("Chat is getting ready…")
 
 if __name__ == "__main__":
     main()
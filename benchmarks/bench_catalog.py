@@ -0,0 +1,120 @@
+"""Merchant catalog: per-rerun page lookups from the in-memory Catalog against dict walks and name queries.
+
+Seeds --providers merchants (the data file's providers plus bulk-imported ones) and times what a
+rerun of Order Now, Services and LIVE SHOP does with each, a catalog reload, and how quickly a
+bump of the 'merchants' version reaches the store.
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from common import StatementCounter, percentile, setup_database, temp_sqlite_url
+
+import db
+from catalog import CatalogStore, load_catalog_file
+from models import Merchant, bump_data_version
+from spatial import geohash_encode, merchants_near_sql
+
+CENTER = (39.0840, -76.6994)  # Odenton, MD
+TYPES = ("Groceries", "Restaurants", "Laundry")
+
+
+def synthetic_catalog(providers, seed=19):
+    """(services, merchant rows) with details for every provider, as a grown catalog file would have."""
+    rng = random.Random(seed)
+    services, rows = {service_type: {} for service_type in TYPES}, []
+    for i in range(providers):
+        name, service_type = f"Provider {i:05d}", TYPES[i % 3]
+        latitude, longitude = CENTER[0] + rng.gauss(0, 0.2), CENTER[1] + rng.gauss(0, 0.2)
+        services[service_type][name] = {
+            'url': f"https://provider{i}.example.com",
+            'instructions': ["Order online.", "Select pick-up.", "Notify Butler."],
+            'address': f"{i} Main St, Odenton, MD 21113",
+            'phone': "(410) 555-0100",
+        }
+        rows.append({'name': name, 'type': service_type, 'latitude': latitude, 'longitude': longitude,
+                     'website': services[service_type][name]['url'], 'geohash': geohash_encode(latitude, longitude)})
+    return services, rows
+
+
+def timed(fn, repeats):
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return percentile(samples, 50) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--providers", type=int, default=5000)
+    parser.add_argument("--repeats", type=int, default=200)
+    args = parser.parse_args()
+
+    engine = setup_database(args.url or temp_sqlite_url("catalog"))
+    services, rows = synthetic_catalog(args.providers)
+    _, partners = load_catalog_file()
+    path = os.path.join(tempfile.mkdtemp(prefix='lb_bench_'), "catalog.json")
+    with open(path, 'w') as f:
+        json.dump({'services': services, 'partners': partners}, f)
+    with db.session_scope() as session:
+        session.bulk_insert_mappings(Merchant, rows)
+        bump_data_version(session, 'merchants')
+
+    store = CatalogStore(path=path)
+    rng = random.Random(3)
+    names = [row['name'] for row in rows]
+    with db.session_scope() as session:
+        started = time.perf_counter()
+        catalog = store.get(session)
+        print(f"catalog load: {len(catalog):,} providers in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+        comparisons = {
+            'Order Now provider names': (
+                lambda: list(services[rng.choice(TYPES)].keys()),
+                lambda: store.get(session).names_by_type[rng.choice(TYPES)]),
+            'LIVE SHOP store list': (
+                lambda: list({**services["Groceries"], **services["Restaurants"]}.keys()),
+                lambda: store.get(session).names_of("Groceries", "Restaurants")),
+            'Services page (all providers)': (
+                lambda: [(name, info['url'], info['instructions'], info.get('address'))
+                         for providers in services.values() for name, info in providers.items()],
+                lambda: [provider for group in store.get(session).by_type.values() for provider in group]),
+            'provider by name': (
+                lambda: session.query(Merchant).filter_by(name=rng.choice(names)).first(),
+                lambda: store.get(session).by_name[rng.choice(names)]),
+            'names of 25 nearest ids': (
+                lambda: dict(session.query(Merchant.id, Merchant.name).filter(
+                    Merchant.id.in_(rng.sample(range(1, args.providers + 1), 25)))),
+                lambda: [store.get(session).by_id[i].name for i in rng.sample(range(1, args.providers + 1), 25)]),
+            'providers within 2 km': (
+                lambda: merchants_near_sql(session, CENTER[0] + rng.gauss(0, 0.2), CENTER[1] + rng.gauss(0, 0.2), 2.0),
+                lambda: store.get(session).within(CENTER[0] + rng.gauss(0, 0.2), CENTER[1] + rng.gauss(0, 0.2), 2.0)),
+        }
+        for label, (before, after) in comparisons.items():
+            with StatementCounter(engine) as old_queries:
+                old = timed(before, args.repeats)
+            with StatementCounter(engine) as new_queries:
+                new = timed(after, args.repeats)
+            print(f"{label}: {old:.3f} ms ({old_queries.count / args.repeats:.1f} queries) -> "
+                  f"{new:.4f} ms ({new_queries.count / args.repeats:.2f} queries) per rerun")
+
+    # Hot reload: another process onboards a merchant; the next check after CATALOG_CHECK_SECONDS picks it up
+    with db.session_scope() as session:
+        session.add(Merchant(name="Late Arrival", type="Groceries", latitude=CENTER[0], longitude=CENTER[1]))
+    store.invalidate()
+    with db.session_scope() as session:
+        started = time.perf_counter()
+        catalog = store.get(session)
+        reload_ms = (time.perf_counter() - started) * 1000
+    print(f"reload after a merchants version bump: {reload_ms:.0f} ms, 'Late Arrival' listed: "
+          f"{'Late Arrival' in catalog.by_name}; {store.loads} loads in total")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""LIVE SHOP chat: 1,000 concurrent rooms, two watchers each, messages sent from another process.
+
+Watchers wait on the chat hub and read new messages from their room's ring buffer; the baseline
+is every watcher asking the database for messages after its last id once a second. Also times
+the paging queries against a room history of --history messages per room.
+"""
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from common import StatementCounter, percentile, setup_database, temp_sqlite_url
+
+import chat
+import db
+from chat import ASSOCIATE, CUSTOMER, RoomCursor, load_before, load_messages, send_message
+from models import ChatMessage
+
+
+def room_id(i):
+    return ("Weis Markets" if i % 2 else "The Hideaway", f"LIVE-{i:05d}")
+
+
+def seed(rooms, history):
+    started = datetime.now() - timedelta(hours=1)
+    with db.session_scope() as session:
+        # Interleaved across rooms, the way live traffic lands in the table
+        session.bulk_insert_mappings(ChatMessage, [
+            {'store': room_id(i)[0], 'session_id': room_id(i)[1], 'sender_id': f"user-{i}",
+             'sender_role': CUSTOMER if n % 2 else ASSOCIATE, 'body': f"message {n}",
+             'created_at': started + timedelta(milliseconds=n * rooms + i)}
+            for n in range(history) for i in range(rooms)
+        ])
+
+
+def writer(url, rooms, rate, duration, results):
+    engine = db.make_engine(url)
+    db.bind_engine(engine)
+    stop_at = time.time() + duration
+    while time.time() < stop_at:
+        i = random.randrange(rooms)
+        with db.session_scope() as session:
+            message = send_message(session, *room_id(i), f"user-{i}", CUSTOMER, "Do you have ripe avocados?")
+        results.put((message.id, time.time()))
+        time.sleep(1 / rate)
+    results.put(None)
+
+
+def watch(room, stop, seen):
+    cursor = RoomCursor(*room)
+    with db.session_scope() as session:
+        cursor.refresh(session)
+    while not stop.is_set():
+        chat.chat_hub.wait(cursor.room, cursor.version, timeout=2)
+        last_id = cursor.messages[-1].id if cursor.messages else 0
+        # A session per read, as on a fragment tick; ring buffer hits never check out a connection
+        with db.session_scope() as session:
+            changed = cursor.refresh(session)
+        if changed:
+            now = time.time()
+            seen.extend((message.id, now) for message in cursor.messages if message.id > last_id)
+
+
+def timer_baseline(engine, rooms, interval, duration):
+    stop = threading.Event()
+
+    def rerun(room):
+        with db.session_scope() as session:
+            last_id = (load_before(session, *room, limit=1) or [None])[0]
+            last_id = last_id.id if last_id else 0
+            stop.wait(interval * random.random())
+            while not stop.is_set():
+                new = load_messages(session, *room, after_id=last_id)
+                last_id = new[-1].id if new else last_id
+                session.rollback()  # end the read transaction between ticks
+                stop.wait(interval)
+
+    with StatementCounter(engine) as counter:
+        threads = [threading.Thread(target=rerun, args=(room_id(i),)) for i in range(rooms) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return counter.count / duration
+
+
+def time_paging(session, rooms, repeats=200):
+    samples = {'latest page': [], 'after cursor': [], 'older page': []}
+    for _ in range(repeats):
+        room = room_id(random.randrange(rooms))
+        started = time.perf_counter()
+        page = load_before(session, *room)
+        samples['latest page'].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        load_messages(session, *room, after_id=page[-1].id - 1)
+        samples['after cursor'].append(time.perf_counter() - started)
+        started = time.perf_counter()
+        load_before(session, *room, before_id=page[0].id)
+        samples['older page'].append(time.perf_counter() - started)
+    return ", ".join(f"{name} p50 {percentile(values, 50) * 1000:.2f} ms" for name, values in samples.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--rooms", type=int, default=1000)
+    parser.add_argument("--history", type=int, default=200, help="messages already in each room")
+    parser.add_argument("--rate", type=float, default=50, help="messages per second")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--interval", type=float, default=1, help="baseline re-query interval (s)")
+    args = parser.parse_args()
+
+    url = args.url or temp_sqlite_url("chat")
+    engine = setup_database(url)
+    seed(args.rooms, args.history)
+    with db.session_scope() as session:
+        print(f"paging over {args.rooms * args.history:,} messages: {time_paging(session, args.rooms)}")
+        if engine.dialect.name == 'sqlite':
+            session.execute(text("DROP INDEX ix_chat_messages_room"))
+            print(f"  without ix_chat_messages_room: {time_paging(session, args.rooms, repeats=10)}")
+            session.execute(text("CREATE INDEX ix_chat_messages_room ON chat_messages (store, session_id, id)"))
+    feed = chat.start(engine)
+
+    stop, seen = threading.Event(), []
+    watchers = [threading.Thread(target=watch, args=(room_id(i), stop, seen)) for i in range(args.rooms) for _ in range(2)]
+    for thread in watchers:
+        thread.start()
+    while sum(version is not None for version in map(chat.chat_hub.version, map(room_id, range(args.rooms)))) < args.rooms:
+        time.sleep(0.1)
+    time.sleep(1)  # every watcher has loaded its first page
+
+    results = multiprocessing.get_context("fork").Queue()
+    with StatementCounter(engine) as counter:
+        process = multiprocessing.get_context("fork").Process(
+            target=writer, args=(url, args.rooms, args.rate, args.duration, results))
+        process.start()
+        sent = []
+        while (item := results.get()) is not None:
+            sent.append(item)
+        process.join()
+        time.sleep(1.0)  # let the last message arrive
+        stop.set()
+        for thread in watchers:
+            thread.join()
+    chat.stop()
+
+    arrivals = {}
+    for message_id, at in seen:
+        arrivals.setdefault(message_id, []).append(at)
+    latencies = [at - sent_at for message_id, sent_at in sent for at in arrivals.get(message_id, [])]
+    delivered = sum(len(arrivals.get(message_id, [])) == 2 for message_id, _ in sent)
+    print(f"{type(feed).__name__}: {len(sent)} messages to {args.rooms} rooms ({2 * args.rooms} watchers), "
+          f"{delivered} reached both participants; latency p50 {percentile(latencies, 50) * 1000:.0f} ms, "
+          f"p99 {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"ring buffer reads: {counter.count / args.duration:.1f} queries/s in this process "
+          f"({feed.polls} feed polls)")
+    baseline = timer_baseline(engine, args.rooms, args.interval, min(args.duration, 6))
+    print(f"database re-query every {args.interval:g} s: {baseline:.1f} queries/s")
+
+
+if __name__ == "__main__":
+    main()
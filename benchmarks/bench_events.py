@@ -0,0 +1,135 @@
+"""Order events: delivery latency and database load with 1,000 sessions watching their orders.
+
+A writer process changes order statuses; every watching session waits on the event bus for its
+own user's topic and re-reads its orders only when woken. The baseline is the old behaviour:
+each session re-running its query on a timer whether or not anything changed.
+"""
+import argparse
+import multiprocessing
+import random
+import threading
+import time
+from datetime import datetime
+
+from common import StatementCounter, percentile, setup_database, temp_sqlite_url
+
+import db
+import events
+from models import Merchant, Order, User
+from lifecycle import PROGRESS_STATUSES, backfill_status_history
+from orders import get_order_rows_for_user, update_order_status
+
+
+def seed(sessions):
+    with db.session_scope() as session:
+        session.add(Merchant(id=1, name="Weis Markets", type="Groceries", latitude=39.08, longitude=-76.69))
+        session.bulk_insert_mappings(User, [
+            {'id': f"user-{i}", 'name': f"User {i}", 'email': f"user{i}@example.com", 'type': 'customer'}
+            for i in range(sessions)
+        ])
+        session.bulk_insert_mappings(Order, [
+            {'id': f"ORD-{i}", 'user_id': f"user-{i}", 'merchant_id': 1, 'service': 'Groceries',
+             'date': datetime.now(), 'time': "07:00 AM EST", 'address': "1 Main St", 'status': 'Pending'}
+            for i in range(sessions)
+        ])
+        backfill_status_history(session)
+
+
+def writer(url, sessions, rate, duration, results):
+    engine = db.make_engine(url)
+    db.bind_engine(engine)
+    stop_at = time.time() + duration
+    # Every write moves an order one step along its lifecycle, so each one is a real change
+    steps = [0] * sessions
+    while time.time() < stop_at:
+        i = random.choice([i for i in range(sessions) if steps[i] < len(PROGRESS_STATUSES) - 1])
+        steps[i] += 1
+        with db.session_scope() as session:
+            update_order_status(session, f"ORD-{i}", PROGRESS_STATUSES[steps[i]])
+        results.put((f"user-{i}", time.time()))
+        time.sleep(1 / rate)
+    results.put(None)
+
+
+def watch(user_id, stop, received):
+    version = events.order_events.version(('user', user_id))
+    while not stop.is_set():
+        new_version = events.order_events.wait([('user', user_id)], version, timeout=0.5)
+        if new_version != version:
+            received.append((user_id, time.time()))
+            version = new_version
+            with db.session_scope() as session:
+                get_order_rows_for_user(session, user_id)
+
+
+def timer_baseline(engine, sessions, interval, duration):
+    stop = threading.Event()
+
+    def rerun(user_id):
+        stop.wait(interval * random.random())  # sessions don't all tick together
+        while not stop.is_set():
+            with db.session_scope() as session:
+                get_order_rows_for_user(session, user_id)
+            stop.wait(interval)
+
+    with StatementCounter(engine) as counter:
+        threads = [threading.Thread(target=rerun, args=(f"user-{i}",)) for i in range(sessions)]
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+    return counter.count / duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=20, help="status changes per second")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--interval", type=float, default=2, help="baseline re-run interval (s)")
+    args = parser.parse_args()
+
+    url = args.url or temp_sqlite_url("events")
+    engine = setup_database(url)
+    seed(args.sessions)
+    listener = events.start(engine)
+
+    stop, received = threading.Event(), []
+    watchers = [threading.Thread(target=watch, args=(f"user-{i}", stop, received)) for i in range(args.sessions)]
+    for thread in watchers:
+        thread.start()
+
+    results = multiprocessing.get_context("fork").Queue()
+    with StatementCounter(engine) as counter:
+        process = multiprocessing.get_context("fork").Process(
+            target=writer, args=(url, args.sessions, args.rate, args.duration, results))
+        process.start()
+        sent = []
+        while (item := results.get()) is not None:
+            sent.append(item)
+        process.join()
+        time.sleep(1.0)  # let the last change arrive
+        stop.set()
+        for thread in watchers:
+            thread.join()
+    events.stop()
+
+    # Match each write to the first wake-up of that user's watcher after it
+    latencies = []
+    for user_id, committed_at in sent:
+        wakeups = [at for uid, at in received if uid == user_id and at >= committed_at]
+        if wakeups:
+            latencies.append(min(wakeups) - committed_at)
+    print(f"{type(listener).__name__}: {len(sent)} status changes, {len(latencies)} delivered, "
+          f"latency p50 {percentile(latencies, 50) * 1000:.0f} ms, p99 {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"event-driven: {counter.count / args.duration:.1f} queries/s in this process for {args.sessions} sessions "
+          f"({len(received)} re-reads)")
+    baseline = timer_baseline(engine, args.sessions, args.interval, min(args.duration, 6))
+    print(f"timer re-runs every {args.interval:g} s: {baseline:.1f} queries/s")
+
+
+if __name__ == "__main__":
+    main()
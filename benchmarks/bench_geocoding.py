@@ -0,0 +1,107 @@
+"""Geocoding service against a local stub geocoder: cold vs warm latency, caching, coalescing and retries."""
+import argparse
+import threading
+import time
+from concurrent.futures import wait
+
+from geopy.exc import GeocoderTimedOut
+
+from common import percentile, setup_database, temp_sqlite_url
+
+from geocode_cache import MISS
+from geocoding import GeocodingService, GeocodingUnavailable
+
+
+class StubGeocoder:
+    """Answers after a fixed upstream latency; addresses containing 'flaky' time out on the first try, 'down'
+    ones until the stub is brought back up."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._failed = set()
+        self.up = False
+
+    def geocode(self, address):
+        with self._lock:
+            self.calls += 1
+            fail = 'flaky' in address and address not in self._failed
+            self._failed.add(address)
+        time.sleep(self.latency)
+        if fail or ('down' in address and not self.up):
+            raise GeocoderTimedOut("stub timeout")
+        if 'nowhere' in address.lower():
+            return None
+        n = sum(map(ord, address))
+        return type('Location', (), {'latitude': 39.0 + (n % 1000) / 10000, 'longitude': -76.7 + (n % 777) / 10000})()
+
+
+def measure(service, addresses):
+    samples = []
+    for address in addresses:
+        started = time.perf_counter()
+        assert service.geocode(address) is not None
+        samples.append(time.perf_counter() - started)
+    return percentile(samples, 50) * 1000, percentile(samples, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--addresses", type=int, default=50)
+    parser.add_argument("--latency", type=float, default=0.05, help="stub upstream latency in seconds")
+    parser.add_argument("--rate", type=float, default=20.0, help="upstream requests/second (Nominatim allows 1)")
+    args = parser.parse_args()
+
+    setup_database(temp_sqlite_url("geocoding"))
+    stub = StubGeocoder(args.latency)
+    service = GeocodingService(geocoder=stub, rate=args.rate, backoff=0.05)
+    addresses = [f"{100 + i} Main St, Odenton, MD 21113" for i in range(args.addresses)]
+
+    cold = measure(service, addresses)
+    warm = measure(service, addresses)
+    print(f"{'lookup':<8} {'p50 ms':>8} {'p99 ms':>8}")
+    print(f"{'cold':<8} {cold[0]:>8.2f} {cold[1]:>8.2f}")
+    print(f"{'warm':<8} {warm[0]:>8.2f} {warm[1]:>8.2f}")
+    assert stub.calls == args.addresses, "warm lookups must not reach the upstream geocoder"
+
+    calls_before = stub.calls
+    futures = [service.submit("1 Coalesced Way, Odenton, MD") for _ in range(100)]
+    wait(futures)
+    print(f"100 concurrent requests for one address -> {stub.calls - calls_before} upstream call(s)")
+    assert stub.calls - calls_before == 1
+
+    calls_before = stub.calls
+    assert service.geocode("2288 Blue Water Blvd, Odenton, MD") is not None
+    assert service.geocode("2288  blue water boulevard, odenton, md.") is not None
+    assert service.geocode("1 Nowhere Ln, Odenton, MD") is None
+    assert service.geocode("1 nowhere lane, Odenton, MD") is None
+    print(f"2 spellings of one address + 2 of an unknown one -> {stub.calls - calls_before} upstream calls")
+    assert stub.calls - calls_before == 2
+
+    started = time.perf_counter()
+    assert service.geocode("7 flaky Rd, Odenton, MD") is not None
+    print(f"timeout then success: {(time.perf_counter() - started) * 1000:.0f} ms (one backoff after the failure)")
+
+    outage = "9 down St, Odenton, MD"
+    try:
+        service.geocode(outage)
+        raise AssertionError("an upstream outage must not read as an answer")
+    except GeocodingUnavailable:
+        pass
+    assert service.cached(outage) is MISS, "an upstream outage must not be cached as not found"
+    stub.up = True
+    assert service.geocode(outage) is not None
+    print("upstream outage: not cached, found once the upstream is back")
+
+    started = time.perf_counter()
+    futures = [service.submit(f"{i} Burst Ave, Odenton, MD") for i in range(10)]
+    wait(futures)
+    elapsed = time.perf_counter() - started
+    print(f"10 distinct cold addresses in {elapsed:.2f} s at {args.rate:g} req/s")
+    print("cache:", service.cache.stats())
+    service.shutdown()
+
+
+if __name__ == "__main__":
+    main()
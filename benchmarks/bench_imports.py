@@ -0,0 +1,201 @@
+"""Cold start of the Streamlit entry point: an import-time budget and time to the first rendered page.
+
+The budget check runs LocalButler.py's module-level imports in a fresh interpreter under
+`python -X importtime`, after Streamlit itself (which the server has loaded before it runs the
+script), and fails when they take longer than --budget-ms or pull in one of LAZY_MODULES: the
+video, map, payments and geocoding libraries that only their own pages and bootstrap's background
+warm-up may import. The fastest of --import-runs runs counts, as the others only add disk and
+scheduler noise.
+
+The cold-start part starts a fresh interpreter per sample against a seeded SQLite database and
+times, for each page, the first script run, the wait for bootstrap, the first run that renders
+the page and a warm rerun once bootstrap's map warm-up has finished. Exits with status 1 when the budget is exceeded.
+"""
+import argparse
+import ast
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "LocalButler.py")
+ENV = {'AUTH0_CLIENT_ID': "bench", 'AUTH0_DOMAIN': "bench.invalid", 'STRIPE_SECRET_KEY': "sk_test_bench",
+       'STRIPE_PUBLISHABLE_KEY': "pk_test_bench", 'PAYMENT_RECONCILE_SECONDS': "86400"}
+# Imported on first use only; none of them may load with the entry point
+LAZY_MODULES = ('cv2', 'av', 'streamlit_webrtc', 'folium', 'streamlit_folium', 'geopy', 'stripe')
+# SQLAlchemy alone is about half of it
+BUDGET_MS = 500.0
+MARKER = "-- LocalButler imports --"
+_IMPORT_TIME = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def entry_point_imports(path=APP):
+    """LocalButler.py's module-level import statements, as source."""
+    with open(path, encoding='utf-8') as f:
+        source = f.read()
+    return [ast.get_source_segment(source, node) for node in ast.parse(source).body
+            if isinstance(node, (ast.Import, ast.ImportFrom))]
+
+
+def import_profile():
+    """(total self ms, {module: (self ms, cumulative ms, depth)}) for one fresh interpreter."""
+    code = "\n".join([
+        "import os, sys",
+        f"sys.path.insert(0, {ROOT!r})",
+        f"os.environ.update({ENV!r})",
+        "import streamlit",
+        f"sys.stderr.write({MARKER + chr(10)!r}); sys.stderr.flush()",
+        *entry_point_imports(),
+    ])
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    modules = {}
+    lines = result.stderr.splitlines()
+    for line in lines[lines.index(MARKER) + 1:]:
+        match = _IMPORT_TIME.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us) / 1000, int(cumulative_us) / 1000, len(indent) // 2)
+    return sum(self_ms for self_ms, _, _ in modules.values()), modules
+
+
+def prepare_database():
+    """A seeded SQLite database on which bootstrap has nothing left to geocode; returns its URL."""
+    os.environ.update(ENV)
+    import numpy as np
+    from common import setup_database, temp_sqlite_url
+    from bench_pages import ADDRESS, StubGeocoder, seed
+
+    import bootstrap
+    import geocoding
+    from catalog import load_catalog_file
+    import db
+
+    url = temp_sqlite_url("imports")
+    engine = setup_database(url)
+    seed(engine, users=1_000, orders=20_000, merchants=200, rng=np.random.default_rng(25))
+    geocoder = geocoding.GeocodingService(geocoder=StubGeocoder(), rate=1000, backoff=0)
+    with db.session_scope() as session:
+        services, _ = load_catalog_file()
+        bootstrap.seed_merchants(session, services, geocoder)
+    geocoder.geocode(ADDRESS)
+    engine.dispose()
+    return url
+
+
+def cold_start(page, url, reruns=5):
+    """Runs in a fresh interpreter: one page from the first script run to a warm rerun, in ms."""
+    # As under `streamlit run`: AppTest keeps the app's directory on sys.path only while the script
+    # runs, and bootstrap's thread imports geocoding, payments and maps after that
+    sys.path.insert(0, ROOT)
+    os.environ.update(ENV, DATABASE_URL=url)
+    import logging
+
+    import streamlit.logger
+    from streamlit import config as streamlit_config
+    from streamlit.testing.v1 import AppTest
+
+    logging.basicConfig(level=logging.WARNING)
+    streamlit_config.set_option("logger.level", "error")
+    streamlit.logger.set_log_level(logging.ERROR)
+
+    def run(at):
+        at.run()
+        if at.exception:
+            raise RuntimeError(f"{page}: {at.exception[0].value}")
+
+    started = time.perf_counter()
+    at = AppTest.from_file(APP, default_timeout=120)
+    at.session_state['user'] = types.SimpleNamespace(
+        id="bench-customer", name="Bench Customer", address="1439 Odenton Rd, Odenton, MD 21113", type='customer')
+    at.session_state['current_page'] = page
+    run(at)
+    first_run = time.perf_counter() - started
+    # Bootstrap's warm-up imports some of them in the background later; the first run must not wait on them
+    loaded = sorted(name for name in LAZY_MODULES if name in sys.modules)
+    bootstrap = sys.modules['bootstrap']
+    while not bootstrap.is_ready():
+        if bootstrap.status()['phase'] == 'failed':
+            raise RuntimeError(f"bootstrap failed: {bootstrap.status()['error']}")
+        time.sleep(0.005)
+    ready = time.perf_counter() - started
+    run(at)
+    first_page = time.perf_counter() - started
+    # Reruns are timed once the background map warm-up is done, as in a server that has settled
+    while bootstrap.status()['maps'] is None:
+        time.sleep(0.005)
+    durations = []
+    for _ in range(reruns):
+        rerun_started = time.perf_counter()
+        run(at)
+        durations.append(time.perf_counter() - rerun_started)
+    return {
+        'first_run_ms': round(first_run * 1000, 1),
+        'bootstrap_ms': round(ready * 1000, 1),
+        'first_page_ms': round(first_page * 1000, 1),
+        'rerun_ms': round(statistics.median(durations) * 1000, 1),
+        'lazy_loaded': loaded,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=BUDGET_MS,
+                        help="allowed self time of the entry point's imports, after streamlit")
+    parser.add_argument("--import-runs", type=int, default=5)
+    parser.add_argument("--pages", default="🏠 Home,📦 My Orders", help="comma-separated pages to cold-start")
+    parser.add_argument("--samples", type=int, default=3, help="fresh interpreters per page")
+    parser.add_argument("--top", type=int, default=10, help="slowest top-level imports to list")
+    parser.add_argument("--cold-start-child", nargs=2, metavar=("PAGE", "URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.cold_start_child:
+        print(json.dumps(cold_start(*args.cold_start_child)))
+        return
+
+    profiles = [import_profile() for _ in range(args.import_runs)]
+    total, modules = min(profiles, key=lambda profile: profile[0])
+    top_level = min(depth for _, _, depth in modules.values())
+    slowest = sorted(((cumulative, name) for name, (_, cumulative, depth) in modules.items() if depth == top_level),
+                     reverse=True)[:args.top]
+    print(f"entry point imports: {total:.0f} ms over {len(modules)} modules (budget {args.budget_ms:.0f} ms), "
+          f"best of {args.import_runs}")
+    for cumulative, name in slowest:
+        print(f"  {cumulative:8.1f} ms  {name}")
+    failures = []
+    if total > args.budget_ms:
+        failures.append(f"imports take {total:.0f} ms, over the {args.budget_ms:.0f} ms budget")
+    eager = [name for name in LAZY_MODULES if name in modules]
+    if eager:
+        failures.append(f"imported with the entry point: {', '.join(eager)}")
+
+    pages = [page for page in args.pages.split(",") if page]
+    if pages and args.samples:
+        url = prepare_database()
+        print(f"{'page':<16} {'first run':>10} {'bootstrap':>10} {'first page':>11} {'rerun':>8}  lazy modules after the first run")
+        for page in pages:
+            samples = []
+            for _ in range(args.samples):
+                result = subprocess.run([sys.executable, os.path.abspath(__file__), "--cold-start-child", page, url],
+                                        cwd=ROOT, capture_output=True, text=True)
+                if result.returncode:
+                    sys.exit(f"{page}: cold start failed\n{result.stderr}")
+                samples.append(json.loads(result.stdout.splitlines()[-1]))
+            median = {key: statistics.median(sample[key] for sample in samples)
+                      for key in ('first_run_ms', 'bootstrap_ms', 'first_page_ms', 'rerun_ms')}
+            print(f"{page:<16} {median['first_run_ms']:>8.0f}ms {median['bootstrap_ms']:>8.0f}ms "
+                  f"{median['first_page_ms']:>9.0f}ms {median['rerun_ms']:>6.1f}ms  "
+                  f"{', '.join(samples[-1]['lazy_loaded']) or '-'}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
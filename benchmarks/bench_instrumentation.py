@@ -0,0 +1,151 @@
+"""Instrumentation overhead: the same simulated reruns with instrumentation off and on.
+
+A rerun here is what the My Orders and Driver Dashboard pages ask of the database: a user's first
+order page with its status histories, the pending queue, orders due soon and the catalog, under
+the same spans the app uses. Off and on alternate in blocks, in turns, so drift hits both equally;
+a sub-1% difference is still within this noise, so the per-statement, per-span and per-rerun costs
+are also timed on their own (best of several blocks) and added up for one rerun.
+"""
+import argparse
+import logging
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import text
+
+from common import percentile, setup_database, temp_sqlite_url
+
+import db
+import instrumentation
+from catalog import CatalogStore
+from lifecycle import PENDING, PROGRESS_STATUSES, status_histories
+from models import Merchant, Order, User
+from orders import get_order_page_by_status, get_order_page_for_user, get_order_rows_due
+from scheduling import due_window, service_time
+
+CHUNK = 50_000
+
+
+def seed(engine, orders, users, rng):
+    with db.session_scope() as session:
+        session.add(Merchant(id=1, name="Weis Markets", type="Groceries", latitude=39.08, longitude=-76.69))
+        session.bulk_insert_mappings(User, [
+            {'id': f"user-{i}", 'name': f"User {i}", 'email': f"user{i}@example.com", 'type': 'customer'}
+            for i in range(users)
+        ])
+    now = datetime.now()
+    user_ids = rng.integers(0, users, orders)
+    minutes = rng.integers(-60 * 24 * 30, 60 * 24 * 3, orders)
+    statuses = rng.choice(len(PROGRESS_STATUSES), size=orders, p=[0.1, 0.05, 0.05, 0.8])
+    for start in range(0, orders, CHUNK):
+        rows = []
+        for i in range(start, min(start + CHUNK, orders)):
+            slot = now + timedelta(minutes=int(minutes[i]))
+            rows.append({
+                'id': f"ORD-{i:09d}", 'user_id': f"user-{user_ids[i]}", 'merchant_id': 1, 'service': 'Groceries',
+                'date': slot.replace(hour=0, minute=0, second=0, microsecond=0), 'time': slot.strftime("%I:%M %p"),
+                'scheduled_at': service_time(slot), 'address': "1 Main St",
+                'status': PROGRESS_STATUSES[statuses[i]], 'total_amount': 10.0,
+            })
+        with engine.begin() as conn:
+            conn.execute(Order.__table__.insert(), rows)
+
+
+def simulated_rerun(store, user_id):
+    with instrumentation.rerun("📦 My Orders") as stats, db.session_scope() as session:
+        with instrumentation.span("catalog"):
+            store.get(session)
+        with instrumentation.span("page 📦 My Orders"):
+            page = get_order_page_for_user(session, user_id)
+            status_histories(session, [row.id for row in page.rows])
+        with instrumentation.span("page 🚗 Driver Dashboard"):
+            get_order_page_by_status(session, PENDING)
+            get_order_rows_due(session, *due_window(30))
+    return stats
+
+
+def run_block(store, user_ids, reruns):
+    started = time.perf_counter()
+    for user_id in user_ids[:reruns]:
+        simulated_rerun(store, user_id)
+    return (time.perf_counter() - started) / reruns
+
+
+def best_of(fn, blocks=7, calls=20_000):
+    """Fastest per-call time of fn over several blocks, in microseconds."""
+    samples = []
+    for _ in range(blocks):
+        started = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        samples.append((time.perf_counter() - started) / calls)
+    return min(samples) * 1e6
+
+
+def toggled(engine, on):
+    if on:
+        instrumentation.enable()
+        instrumentation.instrument(engine)
+    else:
+        instrumentation.uninstrument(engine)
+        instrumentation.disable()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--orders", type=int, default=200_000)
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--reruns", type=int, default=200, help="reruns per block")
+    parser.add_argument("--blocks", type=int, default=15, help="blocks per mode")
+    args = parser.parse_args()
+
+    engine = setup_database(args.url or temp_sqlite_url("instrumentation"))
+    rng = np.random.default_rng(22)
+    seed(engine, args.orders, args.users, rng)
+    store = CatalogStore()
+    # The per-rerun log line is part of the cost, but not the terminal it would go to
+    logging.getLogger('instrumentation').addHandler(logging.NullHandler())
+    logging.getLogger('instrumentation').propagate = False
+
+    user_ids = [f"user-{i}" for i in rng.integers(0, args.users, args.reruns)]
+    instrumentation.instrument(engine)  # no-op while disabled
+    run_block(store, user_ids, args.reruns)  # warm the page cache
+    samples = {False: [], True: []}
+    for block in range(args.blocks):
+        for on in ((False, True) if block % 2 else (True, False)):
+            toggled(engine, on)
+            samples[on].append(run_block(store, user_ids, args.reruns))
+    off, on = (percentile(samples[mode], 50) * 1000 for mode in (False, True))
+    toggled(engine, True)
+    stats = simulated_rerun(store, user_ids[0])
+    print(f"simulated rerun ({stats.queries} queries, {len(stats.spans)} spans), median of {args.blocks} blocks:")
+    print(f"  instrumentation off: {off:.3f} ms")
+    print(f"  instrumentation on:  {on:.3f} ms ({(on - off) / off * 100:+.2f}%)")
+
+    # The same costs one at a time
+    costs = {}
+    with engine.connect() as conn:
+        for on in (False, True, False, True):
+            toggled(engine, on)
+            costs[on] = min(costs.get(on, float('inf')), best_of(lambda: conn.execute(text("SELECT 1")).all()))
+    statement = costs[True] - costs[False]
+    toggled(engine, True)
+    span = best_of(lambda: instrumentation.span("page").__enter__().__exit__(None, None, None))
+
+    def empty_rerun():
+        with instrumentation.rerun("page"):
+            pass
+    rerun = best_of(empty_rerun)
+    toggled(engine, False)
+    disabled = best_of(lambda: instrumentation.span("page").__enter__(), calls=200_000)
+    total = stats.queries * statement + len(stats.spans) * span + rerun
+    print(f"  per statement {statement:.2f} us, per span {span:.2f} us, per rerun {rerun:.2f} us: "
+          f"{total:.0f} us per simulated rerun ({total / (off * 1000) * 100:.2f}%)")
+    print(f"disabled span(): {disabled * 1000:.0f} ns per call")
+    print(f"metrics export: {len(instrumentation.registry.render().splitlines())} lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Order lifecycle: status queries over a large order history, and racing transitions of one order."""
+import argparse
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, select, text
+
+from common import setup_database, temp_sqlite_url
+
+import db
+from lifecycle import (DELIVERED, InvalidTransition, ON_THE_WAY, PENDING, PROGRESS_STATUSES, StatusConflict,
+                       current_status, status_histories)
+from models import Merchant, Order, OrderStatusChange, User
+from orders import claim_order, get_order_rows_by_status, update_order_status
+
+CHUNK = 50_000
+
+
+def seed(orders, users, rng):
+    """Mostly delivered history, a sliver of live orders; every order has its full event trail."""
+    now = datetime.now()
+    with db.session_scope() as session:
+        session.add(Merchant(id=1, name="Weis Markets", type="Groceries", latitude=39.08, longitude=-76.69))
+        session.bulk_insert_mappings(User, [
+            {'id': f"user-{i}", 'name': f"User {i}", 'email': f"user{i}@example.com", 'type': 'customer'}
+            for i in range(users)
+        ])
+    # Final step reached: 0 = Pending ... 3 = Delivered
+    steps = rng.choice(4, size=orders, p=[0.01, 0.005, 0.005, 0.98])
+    ages = rng.uniform(0, 365 * 24 * 3600, orders)
+    for start in range(0, orders, CHUNK):
+        with db.session_scope() as session:
+            order_rows, event_rows = [], []
+            for i in range(start, min(start + CHUNK, orders)):
+                created = now - timedelta(seconds=float(ages[i]))
+                order_id = f"ORD-{i:08d}"
+                order_rows.append({
+                    'id': order_id, 'user_id': f"user-{i % users}", 'merchant_id': 1, 'service': 'Groceries',
+                    'date': created, 'time': "07:00 AM EST", 'address': "1 Main St",
+                    'status': PROGRESS_STATUSES[steps[i]], 'total_amount': 10.0,
+                })
+                for step in range(steps[i] + 1):
+                    event_rows.append({
+                        'order_id': order_id, 'from_status': PROGRESS_STATUSES[step - 1] if step else None,
+                        'to_status': PROGRESS_STATUSES[step], 'created_at': created + timedelta(minutes=20 * step),
+                    })
+            session.bulk_insert_mappings(Order, order_rows)
+            session.bulk_insert_mappings(OrderStatusChange, event_rows)
+
+
+def timed(label, fn, repeats=20):
+    fn()
+    started = time.perf_counter()
+    for _ in range(repeats):
+        result = fn()
+    print(f"  {label}: {(time.perf_counter() - started) / repeats * 1000:.2f} ms")
+    return result
+
+
+def race(order_id, threads, target):
+    barrier = threading.Barrier(threads)
+    outcomes = []
+
+    def attempt(worker):
+        session = db.Session()
+        try:
+            barrier.wait()
+            outcomes.append(target(session, order_id, worker))
+        except (StatusConflict, InvalidTransition) as e:
+            outcomes.append(type(e).__name__)
+        finally:
+            session.close()
+
+    workers = [threading.Thread(target=attempt, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return outcomes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--orders", type=int, default=500_000)
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    engine = setup_database(args.url or temp_sqlite_url("lifecycle"))
+    rng = np.random.default_rng(3)
+    started = time.perf_counter()
+    seed(args.orders, args.users, rng)
+    with db.session_scope() as session:
+        events = session.scalar(select(func.count()).select_from(OrderStatusChange))
+        pending = session.scalar(select(func.count()).select_from(Order).where(Order.status == PENDING))
+    print(f"seeded {args.orders:,} orders / {events:,} status changes ({pending:,} pending) "
+          f"in {time.perf_counter() - started:.0f} s")
+
+    sample = [f"ORD-{i:08d}" for i in rng.integers(0, args.orders, 50)]
+    hour_ago = datetime.now() - timedelta(hours=1)
+    with db.session_scope() as session:
+        print("indexed:")
+        timed("50 oldest pending orders (ix_orders_status_date_id)", lambda: get_order_rows_by_status(session, PENDING))
+        timed("current status of one order from order_events", lambda: current_status(session, sample[0]))
+        timed("status history of 50 orders", lambda: status_histories(session, sample))
+        timed("orders delivered in the last hour", lambda: session.scalar(
+            select(func.count()).select_from(OrderStatusChange)
+            .where(OrderStatusChange.to_status == DELIVERED, OrderStatusChange.created_at >= hour_ago)))
+        assert current_status(session, sample[0]) == session.get(Order, sample[0]).status
+
+    if engine.dialect.name == 'sqlite':
+        with engine.begin() as conn:
+            conn.execute(text("DROP INDEX ix_orders_status_date_id"))
+        with db.session_scope() as session:
+            print("without ix_orders_status_date_id (the old full scan):")
+            timed("50 oldest pending orders", lambda: get_order_rows_by_status(session, PENDING), repeats=3)
+
+    # Race: every thread claims the same pending order, then every thread tries to move it on
+    with db.session_scope() as session:
+        order_id = session.scalar(select(Order.id).where(Order.status == PENDING).limit(1))
+    claims = race(order_id, args.threads, lambda session, oid, worker: claim_order(session, oid, f"user-{worker}"))
+    advances = race(order_id, args.threads,
+                    lambda session, oid, worker: bool(update_order_status(session, oid, ON_THE_WAY)))
+    with db.session_scope() as session:
+        history = status_histories(session, [order_id])[order_id]
+    print(f"{args.threads} concurrent claims: {claims.count(True)} won; "
+          f"{args.threads} concurrent 'On the way': {advances.count(True)} won, others {sorted(set(advances) - {True})}")
+    print(f"  history: {' -> '.join(to_status for _, to_status, _ in history)}")
+    assert claims.count(True) == 1 and advances.count(True) == 1 and len(history) == 3
+
+
+if __name__ == "__main__":
+    main()
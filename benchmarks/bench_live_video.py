@@ -0,0 +1,108 @@
+"""LIVE SHOP overlay: per-frame cost of the old copy/draw/copy callback against the in-place overlay.
+
+Synthetic yuv420p frames (what the WebRTC decoder hands the callback) at a few resolutions; also
+checks that both paths draw the same label and shows the pipeline adapting to a slow stage.
+"""
+import argparse
+import time
+
+import av
+import cv2
+import numpy as np
+
+from common import percentile
+
+from live_video import LEVEL_NAMES, FramePipeline, TextOverlay
+
+LABEL = "Weis Markets"
+RESOLUTIONS = ((320, 240), (640, 480), (1280, 720))
+
+
+def synthetic_frames(width, height, count, rng):
+    frames = []
+    for i in range(count):
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        frame = av.VideoFrame.from_ndarray(image, format='bgr24').reformat(format='yuv420p')
+        frame.pts = i
+        frames.append(frame)
+    return frames
+
+
+def old_callback(frame):
+    img = frame.to_ndarray(format="bgr24")
+    cv2.putText(img, LABEL, (10, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
+    return av.VideoFrame.from_ndarray(img, format="bgr24")
+
+
+def time_callback(callback, frames, repeats):
+    samples = []
+    for _ in range(repeats):
+        for frame in frames:
+            started = time.perf_counter()
+            callback(frame)
+            samples.append(time.perf_counter() - started)
+    return samples
+
+
+def label_difference(overlay, frame):
+    """Mean absolute BGR difference between the two paths' output, inside the label box and outside it."""
+    old = old_callback(frame).to_ndarray(format='bgr24').astype(int)
+    new = overlay.apply(frame.reformat(format='yuv420p')).to_ndarray(format='bgr24').astype(int)
+    box = np.zeros(old.shape[:2], bool)
+    box[overlay.top:overlay.top + overlay.mask.shape[0], overlay.left:overlay.left + overlay.mask.shape[1]] = True
+    difference = np.abs(old - new).mean(axis=2)
+    return difference[box].mean(), difference[~box].mean()
+
+
+class SlowOverlay:
+    """An overlay that takes `delay` seconds per frame, to push the pipeline over budget."""
+
+    def __init__(self, overlay, delay):
+        self.overlay = overlay
+        self.delay = delay
+
+    def apply(self, frame):
+        end = time.perf_counter() + self.delay * frame.width / 640
+        while time.perf_counter() < end:
+            pass
+        return self.overlay.apply(frame)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    rng = np.random.default_rng(17)
+    overlay = TextOverlay(LABEL)
+
+    for width, height in RESOLUTIONS:
+        frames = synthetic_frames(width, height, args.frames, rng)
+        old = time_callback(old_callback, frames, args.repeats)
+        new = time_callback(overlay.apply, frames, args.repeats)
+        inside, outside = label_difference(overlay, frames[0])
+        old_p50, new_p50 = percentile(old, 50), percentile(new, 50)
+        print(f"{width}x{height}: copy/draw/copy p50 {old_p50 * 1000:.3f} ms (p95 {percentile(old, 95) * 1000:.3f}), "
+              f"in place p50 {new_p50 * 1000:.3f} ms (p95 {percentile(new, 95) * 1000:.3f}) -> {old_p50 / new_p50:.0f}x; "
+              f"15 fps streams per core: {1 / (15 * old_p50):.0f} -> {1 / (15 * new_p50):.0f}")
+        print(f"  output difference (mean |BGR|): label box {inside:.1f}, rest of frame {outside:.1f}")
+
+    frames = synthetic_frames(640, 480, args.frames, rng)
+    # 30 ms per frame (scaling with width) is far over the 16.7 ms budget at 15 fps
+    pipeline = FramePipeline(SlowOverlay(overlay, delay=0.030), settle_frames=15)
+    levels = []
+    for i in range(180):
+        if i == 90:
+            pipeline.overlay.delay = 0.0005  # the slow stage goes away
+        level = pipeline.level
+        output = pipeline(frames[i % len(frames)])
+        if not levels or levels[-1][1] != level:
+            levels.append((i, level, f"{output.width}x{output.height}"))
+    print("adaptation:", "; ".join(f"frame {i}: {LEVEL_NAMES[level]} ({size})" for i, level, size in levels))
+    stats = pipeline.stats()
+    print(f"  {stats['frames']} frames, {stats['skipped']} sent again in place of a new frame, p50 {stats['p50_ms']:.2f} ms, "
+          f"p95 {stats['p95_ms']:.2f} ms, budget {stats['budget_ms']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Map render latency and HTML size for growing merchant sets, cold (build) vs warm (cached)."""
+import argparse
+import random
+import time
+
+from common import setup_database, temp_sqlite_url
+
+import db
+from maps import build_map_html, get_map_html, map_html_cache
+from models import Merchant, get_data_version
+
+
+def seed(count):
+    rng = random.Random(count)
+    with db.session_scope() as session:
+        session.query(Merchant).delete()
+        session.add_all(
+            Merchant(name=f"Merchant {i}", type="Groceries", latitude=39.1054 + rng.gauss(0, 0.05),
+                     longitude=-76.7285 + rng.gauss(0, 0.05), website="https://example.com")
+            for i in range(count)
+        )
+
+
+def load_merchants():
+    with db.session_scope() as session:
+        return [tuple(row) for row in session.query(
+            Merchant.name, Merchant.type, Merchant.latitude, Merchant.longitude, Merchant.website)]
+
+
+def render():
+    with db.session_scope() as session:
+        version = get_data_version(session, 'merchants')
+    return get_map_html(("Groceries", version, None), load_merchants)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="20,500,5000")
+    parser.add_argument("--warm-repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    setup_database(temp_sqlite_url("map"))
+    print(f"{'merchants':>9} {'cold ms':>9} {'warm ms':>9} {'html KB':>9} {'unclustered ms':>15} {'unclustered KB':>15}")
+    for size in (int(n) for n in args.sizes.split(",")):
+        seed(size)
+        map_html_cache.clear()
+        started = time.perf_counter()
+        html = render()
+        cold = time.perf_counter() - started
+        started = time.perf_counter()
+        for _ in range(args.warm_repeat):
+            render()
+        warm = (time.perf_counter() - started) / args.warm_repeat
+        started = time.perf_counter()
+        unclustered = build_map_html(load_merchants(), cluster_threshold=float("inf"))
+        unclustered_time = time.perf_counter() - started
+        print(f"{size:>9} {cold * 1000:>9.1f} {warm * 1000:>9.3f} {len(html) / 1024:>9.1f} "
+              f"{unclustered_time * 1000:>15.1f} {len(unclustered) / 1024:>15.1f}")
+    print("cache:", map_html_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Order listings on a 5M-row orders table: keyset pages against OFFSET pages and the unindexed sort.
+
+Times "a user's orders, newest first" and "pending orders, oldest first" at increasing depth. A
+keyset page seeks to the cursor on ix_orders_user_id_date_id / ix_orders_status_date_id and reads
+51 index entries wherever it is; OFFSET walks every row before the page.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, select, text
+
+from common import percentile, setup_database, temp_sqlite_url
+
+import db
+from lifecycle import PROGRESS_STATUSES, PENDING, CANCELLED
+from models import Merchant, Order, User
+from orders import ORDER_PAGE_SIZE, ORDER_ROW_COLUMNS, OrderRow, get_order_page_by_status, get_order_page_for_user
+
+CHUNK = 100_000
+HEAVY_USER = "user-0"
+STATUSES = PROGRESS_STATUSES + (CANCELLED,)
+
+
+def seed(engine, orders, users, heavy_share, rng):
+    """Orders over two years with date-only dates (many ties); HEAVY_USER places heavy_share of them."""
+    with db.session_scope() as session:
+        session.add(Merchant(id=1, name="Weis Markets", type="Groceries", latitude=39.08, longitude=-76.69))
+        session.bulk_insert_mappings(User, [
+            {'id': f"user-{i}", 'name': f"User {i}", 'email': f"user{i}@example.com", 'type': 'customer'}
+            for i in range(users)
+        ])
+    today = datetime.combine(datetime.now().date(), datetime.min.time())
+    user_ids = np.where(rng.random(orders) < heavy_share, 0, rng.integers(1, users, orders))
+    days = rng.integers(0, 730, orders)
+    statuses = rng.choice(len(STATUSES), size=orders, p=[0.10, 0.02, 0.02, 0.81, 0.05])
+    table = Order.__table__
+    # Loading first and indexing afterwards is how a real backfill of this size would go
+    with engine.begin() as conn:
+        for index in table.indexes:
+            index.drop(conn)
+    for start in range(0, orders, CHUNK):
+        end = min(start + CHUNK, orders)
+        rows = [{
+            'id': f"ORD-{i:09d}", 'user_id': f"user-{user_ids[i]}", 'merchant_id': 1, 'service': 'Groceries',
+            'date': today - timedelta(days=int(days[i])), 'time': "07:00 AM EST", 'address': "1 Main St",
+            'status': STATUSES[statuses[i]], 'payment_status': 'Paid', 'payment_method': 'Online',
+            'total_amount': 10.0, 'updated_at': today,
+        } for i in range(start, end)]
+        with engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+    with engine.begin() as conn:
+        for index in table.indexes:
+            index.create(conn)
+        if engine.dialect.name == 'sqlite':
+            conn.execute(text("ANALYZE"))
+        else:
+            conn.execute(text("ANALYZE orders"))
+
+
+def cursor_at(session, criterion, order_by, position):
+    """(date, id) of the row at position in the listing, i.e. the cursor a reader paging that far holds."""
+    return tuple(session.execute(
+        select(Order.date, Order.id).where(criterion).order_by(*order_by).limit(1).offset(position)).one())
+
+
+def offset_page(session, criterion, order_by, offset):
+    """The same page and row shape as the keyset listing, reached with OFFSET."""
+    stmt = (
+        select(*ORDER_ROW_COLUMNS)
+        .outerjoin(Merchant, Order.merchant_id == Merchant.id)
+        .where(criterion)
+        .order_by(*order_by)
+        .limit(ORDER_PAGE_SIZE + 1)
+        .offset(offset)
+    )
+    return [OrderRow(**row._mapping) for row in session.execute(stmt)]
+
+
+def timed(fn, repeats):
+    fn()
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return percentile(samples, 50) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--orders", type=int, default=5_000_000)
+    parser.add_argument("--users", type=int, default=50_000)
+    parser.add_argument("--heavy-share", type=float, default=0.05, help=f"share of orders placed by {HEAVY_USER}")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+
+    engine = setup_database(args.url or temp_sqlite_url("order_pages"))
+    started = time.perf_counter()
+    seed(engine, args.orders, args.users, args.heavy_share, np.random.default_rng(20))
+    print(f"seeded {args.orders:,} orders in {time.perf_counter() - started:.0f} s")
+
+    listings = (
+        (f"{HEAVY_USER}'s orders, newest first",
+         lambda session, after: get_order_page_for_user(session, HEAVY_USER, after=after),
+         Order.user_id == HEAVY_USER, (Order.date.desc(), Order.id.desc())),
+        ("pending orders, oldest first",
+         lambda session, after: get_order_page_by_status(session, PENDING, after=after),
+         Order.status == PENDING, (Order.date, Order.id)),
+    )
+    with db.session_scope() as session:
+        for label, page, criterion, order_by in listings:
+            total = session.execute(select(func.count()).select_from(Order).where(criterion)).scalar()
+            print(f"{label} ({total:,} rows, {ORDER_PAGE_SIZE} per page):")
+            last_page = max(1, -(-total // ORDER_PAGE_SIZE))
+            for page_number in sorted({n for n in (1, 10, 100, 1000, 10_000) if n < last_page} | {last_page}):
+                position = (page_number - 1) * ORDER_PAGE_SIZE
+                after = cursor_at(session, criterion, order_by, position - 1) if position else None
+                keyset = timed(lambda: page(session, after), args.repeats)
+                offset = timed(lambda: offset_page(session, criterion, order_by, position),
+                               max(1, args.repeats // 10))
+                rows = page(session, after).rows
+                print(f"  page {page_number:>6,}: keyset {keyset:6.2f} ms, OFFSET {offset:8.2f} ms "
+                      f"({len(rows)} rows)")
+
+        # The listings before the indexes: a full scan and sort for every first page
+        for index in ('ix_orders_user_id_date_id', 'ix_orders_status_date_id'):
+            session.execute(text(f"DROP INDEX {index}"))
+        for label, page, _, _ in listings:
+            print(f"{label}, first page without its index: {timed(lambda: page(session, None), 2):.0f} ms")
+        session.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""SQL statements and latency to render an order listing: per-order merchant lookups vs one joined query."""
+import argparse
+import time
+from datetime import datetime
+
+from common import StatementCounter, setup_database, temp_sqlite_url
+
+import db
+from models import Merchant, Order, User
+from orders import get_order_rows_for_user, get_orders_for_user
+
+
+def seed(orders):
+    with db.session_scope() as session:
+        session.add(User(id="user-1", name="User", email="user@example.com", type="customer"))
+        for i in range(10):
+            session.add(Merchant(id=i + 1, name=f"Merchant {i}", type="Groceries", latitude=39.08, longitude=-76.69))
+        for i in range(orders):
+            session.add(Order(id=f"ORD-{i:05d}", user_id="user-1", merchant_id=i % 10 + 1, service="Groceries",
+                              date=datetime.now(), time="07:00 AM EST", address="Odenton, MD", status="Pending"))
+
+
+def render_n_plus_one(session, limit):
+    # What display_user_orders used to do: one merchant query per order
+    orders = session.query(Order).filter_by(user_id="user-1").limit(limit).all()
+    return [(order.id, session.query(Merchant).filter_by(id=order.merchant_id).first().name) for order in orders]
+
+
+def render_eager(session, limit):
+    return [(order.id, order.merchant.name) for order in get_orders_for_user(session, "user-1", limit=limit)]
+
+
+def render_rows(session, limit):
+    return [(row.id, row.merchant_name) for row in get_order_rows_for_user(session, "user-1", limit=limit)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--orders", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    engine = setup_database(args.url or temp_sqlite_url("order_queries"))
+    seed(args.orders)
+
+    print(f"{'strategy':<12} {'statements':>10} {'ms/render':>10}")
+    for name, render in (("n+1", render_n_plus_one), ("joinedload", render_eager), ("read model", render_rows)):
+        with db.session_scope() as session, StatementCounter(engine) as counter:
+            render(session, args.orders)
+        started = time.perf_counter()
+        for _ in range(args.repeat):
+            with db.session_scope() as session:
+                render(session, args.orders)
+        elapsed = (time.perf_counter() - started) / args.repeat
+        print(f"{name:<12} {counter.count:>10} {elapsed * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
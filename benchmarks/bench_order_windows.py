@@ -0,0 +1,118 @@
+"""Time-window order queries: parsing date + time labels in Python against a range scan on scheduled_at.
+
+Loads --orders orders without scheduled_at (as they were before the column), times the batched
+backfill, then compares "pending orders due in the next 30 minutes" and "the next 50 active
+orders by delivery time" done the old way (fetch the candidates, parse "07:00 AM EST" labels,
+filter and sort) with range scans on the scheduled_at indexes.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import select, text
+
+from common import percentile, setup_database, temp_sqlite_url
+
+import db
+from lifecycle import ACTIVE_STATUSES, CANCELLED, PENDING, PROGRESS_STATUSES
+from models import Merchant, Order, User
+from orders import get_order_rows_due
+from scheduling import backfill_scheduled_at, format_slot, scheduled_at, service_time
+
+CHUNK = 100_000
+STATUSES = PROGRESS_STATUSES + (CANCELLED,)
+DAYS = 60
+
+
+def seed(engine, orders, rng):
+    """Orders over DAYS days around today in 15-minute slots from 7 AM to 9 PM; no scheduled_at yet."""
+    with db.session_scope() as session:
+        session.add(Merchant(id=1, name="Weis Markets", type="Groceries", latitude=39.08, longitude=-76.69))
+        session.add(User(id="user-1", name="User", email="user@example.com", type="customer"))
+    first_day = datetime.combine(datetime.now().date(), datetime.min.time()) - timedelta(days=DAYS // 2)
+    days = rng.integers(0, DAYS, orders)
+    slots = rng.integers(0, 14 * 4, orders)
+    statuses = rng.choice(len(STATUSES), size=orders, p=[0.10, 0.02, 0.02, 0.81, 0.05])
+    labels = [format_slot(datetime(2000, 1, 1, 7) + timedelta(minutes=15 * s)) for s in range(14 * 4)]
+    for start in range(0, orders, CHUNK):
+        rows = [{
+            'id': f"ORD-{i:09d}", 'user_id': "user-1", 'merchant_id': 1, 'service': 'Groceries',
+            'date': first_day + timedelta(days=int(days[i])), 'time': labels[slots[i]], 'address': "1 Main St",
+            'status': STATUSES[statuses[i]], 'total_amount': 10.0,
+        } for i in range(start, min(start + CHUNK, orders))]
+        with engine.begin() as conn:
+            conn.execute(Order.__table__.insert(), rows)
+
+
+def due_by_parsing(session, start, end):
+    """The old way: pending orders on the window's dates, with their labels parsed and filtered here."""
+    local_start, local_end = start.replace(tzinfo=None), end.replace(tzinfo=None)
+    first_day = datetime.combine(local_start.date(), datetime.min.time())
+    rows = session.execute(
+        select(Order.id, Order.date, Order.time)
+        .where(Order.status == PENDING, Order.date >= first_day, Order.date < local_end)
+    ).all()
+    return sorted((slot, row.id) for row in rows if local_start <= (slot := scheduled_at(row.date, row.time)) < local_end)
+
+
+def next_active_by_parsing(session, now, limit):
+    """The old way: every active order parsed and sorted to find the next ones to deliver."""
+    rows = session.execute(select(Order.id, Order.date, Order.time).where(Order.status.in_(ACTIVE_STATUSES))).all()
+    upcoming = ((scheduled_at(row.date, row.time), row.id) for row in rows)
+    return sorted(item for item in upcoming if item[0] >= now)[:limit]
+
+
+def timed(fn, repeats):
+    fn()
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return percentile(samples, 50) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--orders", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=10)
+    args = parser.parse_args()
+
+    engine = setup_database(args.url or temp_sqlite_url("order_windows"))
+    seed(engine, args.orders, np.random.default_rng(21))
+    with db.session_scope() as session:
+        started = time.perf_counter()
+        filled = backfill_scheduled_at(session)
+        elapsed = time.perf_counter() - started
+    print(f"backfill: {filled:,} orders in {elapsed:.1f} s ({filled / elapsed:,.0f} rows/s)")
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+
+    # A busy moment in the middle of the data: 6 PM today, service time
+    local_now = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=18)
+    now = service_time(local_now)
+    start, end = now, now + timedelta(minutes=30)
+    with db.session_scope() as session:
+        old_due, new_due = due_by_parsing(session, start, end), get_order_rows_due(session, start, end, limit=10_000)
+        assert [order_id for _, order_id in old_due] == [row.id for row in new_due]
+        print(f"pending orders due in the next 30 minutes ({len(new_due)} of {args.orders:,}):")
+        print(f"  parse labels of the day's pending orders: "
+              f"{timed(lambda: due_by_parsing(session, start, end), args.repeats):8.2f} ms")
+        print(f"  scheduled_at range scan:                  "
+              f"{timed(lambda: get_order_rows_due(session, start, end, limit=10_000), args.repeats):8.2f} ms")
+
+        def next_active():
+            return get_order_rows_due(session, now, now + timedelta(days=DAYS), statuses=ACTIVE_STATUSES)
+
+        old_next, new_next = next_active_by_parsing(session, local_now, 50), next_active()
+        assert [order_id for _, order_id in old_next] == [row.id for row in new_next]
+        print("next 50 active orders by delivery time:")
+        print(f"  parse and sort every active order:        "
+              f"{timed(lambda: next_active_by_parsing(session, local_now, 50), args.repeats):8.2f} ms")
+        print(f"  scheduled_at index order:                 {timed(next_active, args.repeats):8.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
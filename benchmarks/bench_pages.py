@@ -0,0 +1,310 @@
+"""Every menu page rendered headlessly with Streamlit's AppTest, checked against a JSON baseline.
+
+Seeds a SQLite database with --users / --orders / --merchants, stubs the geocoder and Stripe, and
+runs LocalButler.py once per page until bootstrap is done and the page is warm. Then it records
+the page's rerun latency (p50/p95 of --reruns full reruns), the SQL statements per rerun (taken
+from instrumentation's per-rerun log line) and the peak Python memory allocated while the page
+renders in one rerun (from LocalButler's rerun context in, so AppTest's own work is left out).
+
+Results are compared with the entry for the same data sizes in --baseline. The run exits with
+status 1 when a page got slower than --latency-tolerance allows, runs more statements, or
+allocates more than --memory-tolerance allows. --update-baseline records this run instead.
+Latency depends on the machine; record the baseline on the machine that checks against it.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import types
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+# Read at import time by the app and its modules, so set before any of them is imported
+os.environ.update(AUTH0_CLIENT_ID="bench", AUTH0_DOMAIN="bench.invalid", STRIPE_SECRET_KEY="sk_test_bench",
+                  STRIPE_PUBLISHABLE_KEY="pk_test_bench", PAYMENT_RECONCILE_SECONDS="86400")
+
+import numpy as np
+import streamlit.logger
+from streamlit import config as streamlit_config
+from streamlit.testing.v1 import AppTest
+
+from common import percentile, setup_database, temp_sqlite_url
+
+import bootstrap
+import db
+import geocoding
+import instrumentation
+import payments
+from lifecycle import ON_THE_WAY, PROGRESS_STATUSES, backfill_status_history
+from models import Merchant, Order, User, bump_data_version
+from scheduling import service_time
+from spatial import geohash_encode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "LocalButler.py")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "pages.json")
+CENTER = (39.0840, -76.6994)  # Odenton, MD
+TYPES = ("Groceries", "Restaurants", "Laundry")
+CUSTOMER_ID, DRIVER_ID = "bench-customer", "bench-driver"
+ADDRESS = "1439 Odenton Rd, Odenton, MD 21113"
+# The pages in the app's menu, and who looks at them
+PAGES = {
+    "🏠 Home": CUSTOMER_ID,
+    "🛒 Order Now": CUSTOMER_ID,
+    "📦 My Orders": CUSTOMER_ID,
+    "🗺️ Map": CUSTOMER_ID,
+    "🛍️ Services": CUSTOMER_ID,
+    "🤝 Subscriptions": CUSTOMER_ID,
+    "🚗 Driver Dashboard": DRIVER_ID,
+}
+CHUNK = 50_000
+# Below these a latency or memory change is noise, whatever the ratio
+LATENCY_FLOOR_MS = 5.0
+MEMORY_FLOOR_KB = 64
+
+
+class StubGeocoder:
+    """Stands in for Nominatim: every address resolves, near CENTER, to the same point every time."""
+
+    def geocode(self, address):
+        h = zlib.crc32(address.encode())
+        return types.SimpleNamespace(latitude=CENTER[0] + (h % 2000 - 1000) / 20_000,
+                                     longitude=CENTER[1] + (h // 2000 % 2000 - 1000) / 20_000)
+
+
+def stub_checkout(**params):
+    order_id = params['client_reference_id']
+    return types.SimpleNamespace(id=f"cs_test_{order_id}", url=f"https://checkout.invalid/{order_id}")
+
+
+def seed(engine, users, orders, merchants, rng):
+    """Users, merchants around CENTER and orders over the last 90 days and next 3; a share for the bench users."""
+    with db.session_scope() as session:
+        session.bulk_insert_mappings(User, [
+            {'id': CUSTOMER_ID, 'name': "Bench Customer", 'email': "customer@bench.invalid", 'type': 'customer',
+             'address': ADDRESS},
+            {'id': DRIVER_ID, 'name': "Bench Driver", 'email': "driver@bench.invalid", 'type': 'driver',
+             'address': ADDRESS},
+        ] + [
+            {'id': f"user-{i}", 'name': f"User {i}", 'email': f"user{i}@bench.invalid", 'type': 'customer'}
+            for i in range(users)
+        ])
+        merchant_rows = []
+        for i in range(merchants):
+            latitude, longitude = CENTER[0] + rng.normal(0, 0.05), CENTER[1] + rng.normal(0, 0.05)
+            merchant_rows.append({'name': f"Merchant {i:05d}", 'type': TYPES[i % len(TYPES)],
+                                  'website': "https://example.com", 'latitude': latitude, 'longitude': longitude,
+                                  'geohash': geohash_encode(latitude, longitude)})
+        session.bulk_insert_mappings(Merchant, merchant_rows)
+        bump_data_version(session, 'merchants')
+    now = datetime.now()
+    owners = np.where(rng.random(orders) < 0.01, -1, rng.integers(0, users, orders))
+    minutes = rng.integers(-60 * 24 * 90, 60 * 24 * 3, orders)
+    statuses = rng.choice(len(PROGRESS_STATUSES), size=orders, p=[0.1, 0.05, 0.05, 0.8])
+    merchant_ids = rng.integers(1, merchants + 1, orders)
+    for start in range(0, orders, CHUNK):
+        rows = []
+        for i in range(start, min(start + CHUNK, orders)):
+            slot = (now + timedelta(minutes=int(minutes[i]))).replace(second=0, microsecond=0)
+            status = PROGRESS_STATUSES[statuses[i]]
+            rows.append({
+                'id': f"ORD-{i:09d}", 'user_id': CUSTOMER_ID if owners[i] < 0 else f"user-{owners[i]}",
+                'merchant_id': int(merchant_ids[i]), 'service': TYPES[i % len(TYPES)],
+                'date': slot.replace(hour=0, minute=0), 'time': slot.strftime("%I:%M %p"),
+                'scheduled_at': service_time(slot), 'address': f"{i} Main St, Odenton, MD 21113",
+                'status': status, 'payment_status': 'Paid', 'payment_method': 'Online', 'total_amount': 25.0,
+                'driver_id': DRIVER_ID if status == ON_THE_WAY and i % 50 == 0 else None, 'updated_at': now,
+            })
+        with engine.begin() as conn:
+            conn.execute(Order.__table__.insert(), rows)
+    # Their creation entries, so bootstrap finds nothing to backfill, as on a migrated database
+    with db.session_scope() as session:
+        backfill_status_history(session)
+
+
+class RerunLog(logging.Handler):
+    """Collects instrumentation's per-rerun JSON lines."""
+
+    def __init__(self):
+        super().__init__()
+        self.reruns = []
+
+    def emit(self, record):
+        self.reruns.append(json.loads(record.getMessage()))
+
+
+def page_app(page, user_id):
+    at = AppTest.from_file(APP, default_timeout=120)
+    at.session_state['user'] = types.SimpleNamespace(
+        id=user_id, name=user_id, address=ADDRESS, type='driver' if user_id == DRIVER_ID else 'customer')
+    at.session_state['current_page'] = page
+    return at
+
+
+def run(at, page):
+    at.run()
+    if at.exception:
+        raise RuntimeError(f"{page}: {at.exception[0].value}")
+
+
+class PagePeak:
+    """tracemalloc's peak over the page alone, from entering instrumentation.rerun (LocalButler's rerun
+    context) to leaving it. AppTest compiles the script and reads back its elements on every run, which
+    takes a few MB of its own and would bury any change in the page's."""
+
+    def __init__(self):
+        self.peak = None
+        self._rerun = instrumentation.rerun
+
+    def __enter__(self):
+        instrumentation.rerun = self._traced
+        tracemalloc.start()
+        return self
+
+    def __exit__(self, *exc):
+        tracemalloc.stop()
+        instrumentation.rerun = self._rerun
+        return False
+
+    @contextmanager
+    def _traced(self, label=None):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        try:
+            with self._rerun(label) as stats:
+                yield stats
+        finally:
+            self.peak = tracemalloc.get_traced_memory()[1] - base
+
+
+def measure(page, user_id, reruns, warmup, log):
+    at = page_app(page, user_id)
+    for _ in range(warmup):
+        run(at, page)
+    durations, queries = [], []
+    for _ in range(reruns):
+        log.reruns.clear()
+        started = time.perf_counter()
+        run(at, page)
+        durations.append(time.perf_counter() - started)
+        queries.append(sum(rerun['queries'] for rerun in log.reruns))
+    with PagePeak() as traced:
+        run(at, page)
+    return {
+        'p50_ms': round(percentile(durations, 50) * 1000, 2),
+        'p95_ms': round(percentile(durations, 95) * 1000, 2),
+        'queries': int(np.median(queries)),
+        'peak_kb': round(traced.peak / 1024),
+    }
+
+
+def regressions(results, baseline, latency_tolerance, memory_tolerance):
+    found = []
+    for page, result in results.items():
+        before = baseline.get(page)
+        if before is None:
+            continue
+        if result['p50_ms'] > max(before['p50_ms'] * (1 + latency_tolerance), before['p50_ms'] + LATENCY_FLOOR_MS):
+            found.append(f"{page}: p50 {before['p50_ms']} -> {result['p50_ms']} ms")
+        if result['queries'] > before['queries']:
+            found.append(f"{page}: {before['queries']} -> {result['queries']} queries per rerun")
+        if result['peak_kb'] > max(before['peak_kb'] * (1 + memory_tolerance), before['peak_kb'] + MEMORY_FLOOR_KB):
+            found.append(f"{page}: peak {before['peak_kb']} -> {result['peak_kb']} KB")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--orders", type=int, default=50_000)
+    parser.add_argument("--merchants", type=int, default=500)
+    parser.add_argument("--pages", default=",".join(PAGES), help="comma-separated page labels")
+    parser.add_argument("--reruns", type=int, default=20, help="measured reruns per page")
+    parser.add_argument("--warmup", type=int, default=3, help="reruns per page before measuring")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="record this run as the baseline")
+    parser.add_argument("--latency-tolerance", type=float, default=0.5, help="allowed p50 growth (0.5 = +50%%)")
+    parser.add_argument("--memory-tolerance", type=float, default=0.25, help="allowed peak memory growth")
+    args = parser.parse_args()
+    pages = [page for page in args.pages.split(",") if page]
+    unknown = set(pages) - set(PAGES)
+    if unknown:
+        parser.error(f"unknown pages: {', '.join(sorted(unknown))}")
+
+    logging.basicConfig(level=logging.WARNING)
+    # Bare-mode and deprecation warnings on every rerun would bury the results
+    streamlit_config.set_option("logger.level", "error")
+    streamlit.logger.set_log_level(logging.ERROR)
+    log = RerunLog()
+    rerun_logger = logging.getLogger('instrumentation')
+    rerun_logger.setLevel(logging.INFO)
+    rerun_logger.addHandler(log)
+    rerun_logger.propagate = False
+
+    url = temp_sqlite_url("pages")
+    engine = setup_database(url)
+    started = time.perf_counter()
+    seed(engine, args.users, args.orders, args.merchants, np.random.default_rng(23))
+    print(f"seeded {args.users:,} users, {args.merchants:,} merchants, {args.orders:,} orders "
+          f"in {time.perf_counter() - started:.0f} s")
+    engine.dispose()
+
+    os.environ['DATABASE_URL'] = url
+    geocoding._service = geocoding.GeocodingService(geocoder=StubGeocoder(), rate=1000, backoff=0)
+    payments._service = payments.CheckoutService(create=stub_checkout)
+    instrumentation.enable()
+
+    # `streamlit run` keeps the app's directory on sys.path; AppTest only while the script runs, and
+    # bootstrap's thread imports geocoding, payments and maps after that
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    started = time.perf_counter()
+    run(page_app("🏠 Home", CUSTOMER_ID), "🏠 Home")
+    while not bootstrap.is_ready():
+        if bootstrap.status()['phase'] == 'failed':
+            sys.exit(f"bootstrap failed: {bootstrap.status()['error']}")
+        time.sleep(0.1)
+    # The map warm-up carries on after ready; don't time the first pages against it
+    while bootstrap.status()['maps'] is None:
+        time.sleep(0.1)
+    print(f"bootstrap: {time.perf_counter() - started:.1f} s")
+
+    results = {}
+    print(f"{'page':<22} {'p50 ms':>8} {'p95 ms':>8} {'queries':>8} {'peak KB':>8}")
+    for page in pages:
+        results[page] = measure(page, PAGES[page], args.reruns, args.warmup, log)
+        result = results[page]
+        print(f"{page:<22} {result['p50_ms']:>8.1f} {result['p95_ms']:>8.1f} {result['queries']:>8} "
+              f"{result['peak_kb']:>8}")
+
+    profile = f"users={args.users},orders={args.orders},merchants={args.merchants}"
+    try:
+        with open(args.baseline, encoding='utf-8') as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+    if args.update_baseline:
+        baselines[profile] = {**baselines.get(profile, {}), **results}
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write('\n')
+        print(f"baseline for {profile} written to {args.baseline}")
+        return
+    if profile not in baselines:
+        print(f"no baseline for {profile} in {args.baseline}; run with --update-baseline to record one")
+        return
+    found = regressions(results, baselines[profile], args.latency_tolerance, args.memory_tolerance)
+    for regression in found:
+        print(f"REGRESSION {regression}")
+    if found:
+        sys.exit(1)
+    print(f"no regressions against the baseline for {profile}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""Checkout pipeline: session creation throughput, duplicate clicks, webhook and reconciliation updates.
+
+Runs the real stripe client against a local fake of the Checkout Sessions API (or stripe-mock with
+--api-base http://localhost:12111). The fake answers after --latency seconds like the real API
+does, honours idempotency keys, and can mark sessions paid for the webhook/reconcile phases.
+"""
+import argparse
+import json
+import threading
+import time
+import uuid
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+import stripe
+from sqlalchemy import func, select, update
+
+from common import percentile, setup_database, temp_sqlite_url
+
+import db
+import payments
+from models import Merchant, Order, User
+from payments import CheckoutService, apply_payment_updates, checkout_params, reconcile
+
+WEBHOOK_SECRET = "whsec_bench"
+
+
+class FakeStripe(BaseHTTPRequestHandler):
+    sessions = {}
+    by_key = {}
+    creates = 0
+    latency = 0.2
+    lock = threading.Lock()
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, body):
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        params = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode())
+        time.sleep(self.latency)
+        key = self.headers.get('Idempotency-Key')
+        with self.lock:
+            FakeStripe.creates += 1
+            if key not in self.by_key:
+                session_id = f"cs_test_{uuid.uuid4().hex}"
+                self.sessions[session_id] = {
+                    'id': session_id, 'object': 'checkout.session', 'status': 'open', 'payment_status': 'unpaid',
+                    'client_reference_id': params['client_reference_id'][0], 'created': int(time.time()),
+                    'url': f"https://checkout.stripe.test/{session_id}",
+                }
+                self.by_key[key] = session_id
+            body = self.sessions[self.by_key[key]]
+        self._reply(body)
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        limit = int(query.get('limit', ['10'])[0])
+        after = query.get('starting_after', [None])[0]
+        with self.lock:
+            ids = sorted(self.sessions)
+        if after:
+            ids = ids[ids.index(after) + 1:]
+        page = [self.sessions[session_id] for session_id in ids[:limit]]
+        self._reply({'object': 'list', 'url': '/v1/checkout/sessions', 'data': page, 'has_more': len(ids) > limit})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(handler):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def seed(orders):
+    with db.session_scope() as session:
+        session.add(Merchant(id=1, name="Weis Markets", type="Groceries", latitude=39.08, longitude=-76.69))
+        session.add(User(id="user-0", name="User 0", email="user0@example.com", type='customer'))
+        session.bulk_insert_mappings(Order, [
+            {'id': f"ORD-{i}", 'user_id': "user-0", 'merchant_id': 1, 'service': 'Groceries',
+             'date': datetime.now(), 'time': "07:00 AM EST", 'address': "1 Main St", 'status': 'Pending',
+             'payment_status': 'Pending', 'payment_method': 'Online', 'total_amount': 10.0}
+            for i in range(orders)
+        ])
+
+
+def signed_webhook(checkout_session, event_type='checkout.session.completed'):
+    payload = json.dumps({'id': f"evt_{uuid.uuid4().hex}", 'object': 'event', 'type': event_type,
+                          'data': {'object': checkout_session}})
+    timestamp = int(time.time())
+    signature = stripe.WebhookSignature._compute_signature(f"{timestamp}.{payload}", WEBHOOK_SECRET)
+    return payload.encode(), f"t={timestamp},v1={signature}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--api-base", default=None, help="Stripe API base (default: in-process fake)")
+    parser.add_argument("--orders", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.2, help="fake Stripe response time (s)")
+    parser.add_argument("--bulk", type=int, default=20_000, help="orders for the bulk update comparison")
+    args = parser.parse_args()
+
+    setup_database(args.url or temp_sqlite_url("payments"))
+    seed(args.orders + args.bulk)
+    FakeStripe.latency = args.latency
+    fake = None
+    if args.api_base:
+        stripe.api_base = args.api_base
+    else:
+        fake = serve(FakeStripe)
+        stripe.api_base = f"http://127.0.0.1:{fake.server_port}"
+    stripe.api_key = "sk_test_bench"
+    stripe.max_network_retries = 0
+
+    # Old behaviour: each click blocks its rerun on Stripe, one session at a time
+    inline = min(args.orders, 20)
+    latencies = []
+    started = time.perf_counter()
+    for i in range(inline):
+        t = time.perf_counter()
+        stripe.checkout.Session.create(**checkout_params(f"INLINE-{i}", 10.0, "Groceries"))
+        latencies.append(time.perf_counter() - t)
+    inline_rate = inline / (time.perf_counter() - started)
+    print(f"inline: {inline_rate:.1f} sessions/s, rerun blocked p50 {percentile(latencies, 50) * 1000:.0f} ms")
+
+    # Pool: reruns only submit; every order is clicked three times
+    service = CheckoutService(max_workers=args.workers)
+    creates_before = FakeStripe.creates
+    submit_latencies, futures = [], []
+    started = time.perf_counter()
+    for _ in range(3):
+        for i in range(args.orders):
+            t = time.perf_counter()
+            futures.append(service.submit(f"ORD-{i}", 10.0, "Groceries"))
+            submit_latencies.append(time.perf_counter() - t)
+    results = [future.result() for future in futures]
+    elapsed = time.perf_counter() - started
+    distinct = len({checkout_session.id for checkout_session in results})
+    print(f"pool ({args.workers} workers): {args.orders / elapsed:.1f} sessions/s "
+          f"({args.orders / elapsed / inline_rate:.1f}x), rerun blocked p50 "
+          f"{percentile(submit_latencies, 50) * 1e6:.0f} us")
+    print(f"  {len(futures)} clicks -> {distinct} checkout sessions, {service.coalesced} coalesced, "
+          f"{FakeStripe.creates - creates_before} API calls")
+    # A later retry (another tab, a restarted server) gets the same session back from Stripe
+    again = CheckoutService(max_workers=args.workers)
+    retried = [again.submit(f"ORD-{i}", 10.0, "Groceries") for i in range(args.orders)]
+    assert {future.result().id for future in retried} <= {checkout_session.id for checkout_session in results}
+    assert distinct == args.orders
+    with db.session_scope() as session:
+        recorded = session.scalar(select(func.count()).select_from(Order).where(Order.checkout_session_id.isnot(None)))
+    print(f"  retried with a fresh pool: still {distinct} sessions; {recorded} orders have their session id")
+
+    if fake is None:
+        return
+
+    # Customers pay: half the orders hear about it by webhook, the other half only by reconciliation
+    for checkout_session in FakeStripe.sessions.values():
+        checkout_session.update(status='complete', payment_status='paid')
+    payments.STRIPE_WEBHOOK_SECRET = WEBHOOK_SECRET
+    webhook_server = serve(payments.WebhookHandler)
+    paid_by_webhook = [s for s in FakeStripe.sessions.values() if s['client_reference_id'].startswith('ORD-')][::2]
+    started = time.perf_counter()
+    for checkout_session in paid_by_webhook:
+        payload, signature = signed_webhook(checkout_session)
+        urlopen(Request(f"http://127.0.0.1:{webhook_server.server_port}/stripe/webhook", data=payload,
+                        headers={'Stripe-Signature': signature, 'Content-Type': 'application/json'})).read()
+    webhook_rate = len(paid_by_webhook) / (time.perf_counter() - started)
+    payload, signature = signed_webhook(paid_by_webhook[0])
+    try:
+        urlopen(Request(f"http://127.0.0.1:{webhook_server.server_port}/stripe/webhook", data=payload,
+                        headers={'Stripe-Signature': signature.replace('v1=', 'v1=0')}))
+        forged = "accepted"
+    except Exception as e:
+        forged = f"rejected ({e})"
+    started = time.perf_counter()
+    with db.session_scope() as session:
+        reconciled = reconcile(session)
+    reconcile_seconds = time.perf_counter() - started
+    with db.session_scope() as session:
+        paid = session.scalar(select(func.count()).select_from(Order).where(Order.payment_status == payments.PAID))
+    print(f"webhooks: {len(paid_by_webhook)} at {webhook_rate:.0f}/s; forged signature {forged}")
+    print(f"reconcile: {len(reconciled)} more orders in {reconcile_seconds * 1000:.0f} ms; "
+          f"{paid} of {args.orders} orders Paid")
+    assert paid == args.orders
+
+    # Bulk update against one UPDATE per order
+    bulk_ids = [f"ORD-{i}" for i in range(args.orders, args.orders + args.bulk)]
+    half = len(bulk_ids) // 2
+    started = time.perf_counter()
+    with db.session_scope() as session:
+        for order_id in bulk_ids[:half]:
+            session.execute(update(Order).where(Order.id == order_id, Order.payment_status == 'Pending')
+                            .values(payment_status=payments.PAID))
+    per_row = time.perf_counter() - started
+    started = time.perf_counter()
+    with db.session_scope() as session:
+        apply_payment_updates(session, {order_id: payments.PAID for order_id in bulk_ids[half:]})
+    bulk = time.perf_counter() - started
+    print(f"{half:,} payment updates: per row {per_row * 1000:.0f} ms, bulk {bulk * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
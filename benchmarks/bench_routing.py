@@ -0,0 +1,80 @@
+"""Route batching: stop-ordering solve time and quality versus batch size, and driver km saved in a lunch rush."""
+import argparse
+import itertools
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# Imported only for its side effect: it puts the repo root on sys.path so the app modules below resolve
+import common  # noqa: F401
+
+from routing import RouteOrder, nearest_neighbor, path_length, plan_runs, solve_path
+from spatial import haversine_matrix_km
+
+# Around The Hideaway, Odenton
+CENTER_LAT, CENTER_LON = 39.085, -76.70
+
+
+def random_points(rng, n, spread):
+    return np.column_stack([CENTER_LAT + rng.uniform(-spread, spread, n), CENTER_LON + rng.uniform(-spread, spread, n)])
+
+
+def bench_solver(rng, sizes, repeats):
+    print(f"{'stops':>5} {'solve ms':>9} {'NN km':>8} {'2-opt km':>9} {'optimal km':>10}")
+    for n in sizes:
+        times, nn_km, opt_km, exact_km = [], [], [], []
+        for _ in range(repeats):
+            points = random_points(rng, n, 0.03)
+            dist = haversine_matrix_km(points[:, 0], points[:, 1])
+            started = time.perf_counter()
+            path = solve_path(dist)
+            times.append(time.perf_counter() - started)
+            assert sorted(path) == list(range(n)) and path[0] == 0
+            nn_km.append(path_length(nearest_neighbor(dist), dist))
+            opt_km.append(path_length(path, dist))
+            if n <= 8:
+                exact_km.append(min(path_length([0, *rest], dist) for rest in itertools.permutations(range(1, n))))
+        exact = f"{np.mean(exact_km):10.2f}" if exact_km else f"{'-':>10}"
+        print(f"{n:5d} {np.median(times) * 1000:9.2f} {np.mean(nn_km):8.2f} {np.mean(opt_km):9.2f} {exact}")
+
+
+def bench_lunch_rush(rng, orders, restaurants):
+    merchants = random_points(rng, restaurants, 0.02)
+    drops = random_points(rng, orders, 0.04)
+    lunch = datetime.now().replace(hour=11, minute=30, second=0, microsecond=0)
+    route_orders = [
+        RouteOrder(f"ORD-{i}", int(m), f"Restaurant {m}", tuple(merchants[m]), tuple(drops[i]), f"Drop {i}",
+                   lunch + timedelta(minutes=15 * int(rng.integers(0, 8))))
+        for i, m in enumerate(rng.integers(0, restaurants, orders))
+    ]
+    started = time.perf_counter()
+    runs = plan_runs(route_orders)
+    elapsed = time.perf_counter() - started
+    assert sorted(order_id for run in runs for order_id in run.order_ids) == sorted(o.order_id for o in route_orders)
+    batched_km = sum(run.distance_km for run in runs)
+    # Without batching every order is its own trip: merchant to door
+    solo_km = sum(float(haversine_matrix_km([o.pickup[0]], [o.pickup[1]], [o.drop[0]], [o.drop[1]])[0, 0])
+                  for o in route_orders)
+    trips = len(runs)
+    print(f"lunch rush: {orders} orders from {restaurants} restaurants -> {trips} runs "
+          f"({orders / trips:.2f} orders/run) planned in {elapsed * 1000:.0f} ms")
+    print(f"  driving km per order: {solo_km / orders:.2f} one trip each vs {batched_km / orders:.2f} batched "
+          f"(driver trips {orders} -> {trips})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="4,6,8,16,32,64,128,256")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--orders", type=int, default=400)
+    parser.add_argument("--restaurants", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(11)
+    bench_solver(rng, [int(n) for n in args.sizes.split(",")], args.repeats)
+    bench_lunch_rush(rng, args.orders, args.restaurants)
+
+
+if __name__ == "__main__":
+    main()
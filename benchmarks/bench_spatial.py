@@ -0,0 +1,102 @@
+"""Nearest-merchant queries: KD-tree index vs brute-force haversine scan (pure Python and NumPy)."""
+import argparse
+import math
+import random
+import time
+
+import numpy as np
+
+from common import percentile, setup_database, temp_sqlite_url
+
+import db
+from models import Merchant
+from spatial import MerchantIndex, haversine_km, merchants_near_sql
+
+CENTER = (39.0840, -76.6994)  # Odenton, MD
+
+
+def synthetic_merchants(count, seed=7):
+    rng = random.Random(seed)
+    types = ("Groceries", "Restaurants", "Laundry")
+    return [(i + 1, types[i % 3], CENTER[0] + rng.gauss(0, 0.2), CENTER[1] + rng.gauss(0, 0.2)) for i in range(count)]
+
+
+def brute_force(rows, lat, lon, k):
+    return sorted(((merchant_id, haversine_km(lat, lon, mlat, mlon)) for merchant_id, _, mlat, mlon in rows),
+                  key=lambda item: item[1])[:k]
+
+
+def brute_force_numpy(ids, lats, lons, lat, lon, k):
+    phi1, phi2 = math.radians(lat), np.radians(lats)
+    a = np.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lons - lon) / 2) ** 2
+    distances = 2 * 6371.0088 * np.arcsin(np.sqrt(a))
+    nearest = np.argpartition(distances, k)[:k]
+    return sorted(zip(ids[nearest].tolist(), distances[nearest].tolist()), key=lambda item: item[1])
+
+
+def timed(fn, queries):
+    samples = []
+    for lat, lon in queries:
+        started = time.perf_counter()
+        fn(lat, lon)
+        samples.append(time.perf_counter() - started)
+    return percentile(samples, 50) * 1000, percentile(samples, 99) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--merchants", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--radius-km", type=float, default=2.0)
+    args = parser.parse_args()
+
+    rows = synthetic_merchants(args.merchants)
+    ids = np.array([r[0] for r in rows])
+    lats = np.array([r[2] for r in rows])
+    lons = np.array([r[3] for r in rows])
+    rng = random.Random(1)
+    queries = [(CENTER[0] + rng.gauss(0, 0.2), CENTER[1] + rng.gauss(0, 0.2)) for _ in range(args.queries)]
+
+    index = MerchantIndex()
+    started = time.perf_counter()
+    index.rebuild(rows)
+    print(f"build: {(time.perf_counter() - started) * 1000:.0f} ms for {len(index)} merchants")
+
+    for lat, lon in queries[:20]:
+        expected = brute_force_numpy(ids, lats, lons, lat, lon, args.k)
+        assert [i for i, _ in index.nearest(lat, lon, k=args.k)] == [i for i, _ in expected], \
+            "index disagrees with brute force"
+
+    started = time.perf_counter()
+    for i in range(1000):
+        index.add(args.merchants + i + 1, "Groceries", CENTER[0] + rng.gauss(0, 0.2), CENTER[1] + rng.gauss(0, 0.2))
+    print(f"incremental insert: {(time.perf_counter() - started):.3f} ms/merchant amortized over 1000 inserts")
+
+    print(f"{'query':<34} {'p50 ms':>8} {'p99 ms':>8}")
+    results = [
+        (f"index nearest-{args.k}", lambda lat, lon: index.nearest(lat, lon, k=args.k)),
+        (f"index nearest-{args.k} (type filter)", lambda lat, lon: index.nearest(lat, lon, k=args.k, type_="Laundry")),
+        (f"index within {args.radius_km} km", lambda lat, lon: index.within(lat, lon, args.radius_km)),
+        (f"numpy brute-force nearest-{args.k}", lambda lat, lon: brute_force_numpy(ids, lats, lons, lat, lon, args.k)),
+    ]
+    for name, fn in results:
+        p50, p99 = timed(fn, queries)
+        print(f"{name:<34} {p50:>8.3f} {p99:>8.3f}")
+    p50, p99 = timed(lambda lat, lon: brute_force(rows, lat, lon, args.k), queries[:10])
+    print(f"{'python brute-force nearest-' + str(args.k):<34} {p50:>8.3f} {p99:>8.3f}")
+
+    setup_database(temp_sqlite_url("spatial"))
+    with db.session_scope() as session:
+        session.add_all(Merchant(id=i, name=f"M{i}", type=t, latitude=lat, longitude=lon)
+                        for i, t, lat, lon in rows[:20_000])
+    with db.session_scope() as session:
+        lat, lon = queries[0]
+        assert len(merchants_near_sql(session, lat, lon, args.radius_km)) == len(
+            [1 for i, _, mlat, mlon in rows[:20_000] if haversine_km(lat, lon, mlat, mlon) <= args.radius_km])
+        p50, p99 = timed(lambda lat, lon: merchants_near_sql(session, lat, lon, args.radius_km), queries[:50])
+    print(f"{'SQL geohash prefilter (20k rows)':<34} {p50:>8.3f} {p99:>8.3f}")
+
+
+if __name__ == "__main__":
+    main()
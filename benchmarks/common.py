@@ -0,0 +1,49 @@
+"""Shared setup for the benchmark scripts (run them from the repo root: python benchmarks/<name>.py)."""
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db  # noqa: E402
+from models import Base  # noqa: E402
+
+
+def temp_sqlite_url(name):
+    return f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='lb_bench_'), name)}.db"
+
+
+def setup_database(url, **engine_kwargs):
+    engine = db.make_engine(url, **engine_kwargs)
+    db.bind_engine(engine)
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    return engine
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class StatementCounter:
+    """Counts SQL statements sent to the database while active."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._on_execute)
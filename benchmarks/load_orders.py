@@ -0,0 +1,100 @@
+"""Load test: N simulated users concurrently placing orders and reading "My Orders".
+
+Each simulated user uses its own short-lived session per request, the same lifecycle the
+app uses per rerun, so throughput should scale with the pool until the database saturates.
+"My Orders" is read the way the page reads it: the cached first page plus the orders' status
+histories. The first read after an order is placed misses the cache, which the order invalidated;
+the other --reads of it are served from the cache.
+Point --url at Postgres to see pool scaling; SQLite serializes writers.
+"""
+import argparse
+import threading
+import time
+from datetime import datetime
+
+from common import percentile, setup_database, temp_sqlite_url
+
+import db
+from ids import new_order_id
+from lifecycle import status_histories
+from models import Merchant, User
+from orders import cached_order_page_for_user, create_order, order_cache
+
+
+def seed(users):
+    with db.session_scope() as session:
+        session.add(Merchant(id=1, name="Weis Markets", type="Groceries", latitude=39.08, longitude=-76.69))
+        for i in range(users):
+            session.add(User(id=f"user-{i}", name=f"User {i}", email=f"user{i}@example.com", type="customer"))
+
+
+def my_orders(user_id):
+    """What a render of My Orders reads (LocalButler.get_user_orders and get_status_histories)."""
+    with db.session_scope() as session:
+        page = cached_order_page_for_user(session, user_id)
+        return status_histories(session, [order.id for order in page.rows])
+
+
+def simulated_user(user_id, stop_at, reads, latencies, errors):
+    while time.perf_counter() < stop_at:
+        started = time.perf_counter()
+        try:
+            with db.session_scope() as session:
+                create_order(
+                    session,
+                    order_id=new_order_id(),
+                    user_id=user_id,
+                    merchant_id=1,
+                    service="Groceries",
+                    date=datetime.now(),
+                    time="07:00 AM EST",
+                    address="1439 Odenton Rd, Odenton, MD 21113",
+                    payment_method="In-Person",
+                    total_amount=10.0
+                )
+            for _ in range(reads):
+                my_orders(user_id)
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - started)
+
+
+def run(concurrency, duration, reads):
+    latencies, errors = [], []
+    stop_at = time.perf_counter() + duration
+    threads = [
+        threading.Thread(target=simulated_user, args=(f"user-{i}", stop_at, reads, latencies, errors))
+        for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default=None, help="database URL (default: temporary SQLite file)")
+    parser.add_argument("--users", default="1,2,4,8,16", help="comma separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=3.0, help="seconds per concurrency level")
+    parser.add_argument("--reads", type=int, default=5, help="My Orders renders per order placed")
+    args = parser.parse_args()
+
+    levels = [int(n) for n in args.users.split(",")]
+    engine = setup_database(args.url or temp_sqlite_url("load_orders"))
+    seed(max(levels))
+
+    print(f"{'users':>5} {'ops/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>6} {'peak conns':>10}")
+    for concurrency in levels:
+        latencies, errors = run(concurrency, args.duration, args.reads)
+        stats = db.pool_metrics(engine)
+        print(f"{concurrency:>5} {len(latencies) / args.duration:>9.1f} "
+              f"{percentile(latencies, 50) * 1000:>8.2f} {percentile(latencies, 99) * 1000:>8.2f} "
+              f"{len(errors):>6} {stats['peak_checked_out']:>10}")
+    print("order cache:", order_cache.stats())
+
+
+if __name__ == "__main__":
+    main()
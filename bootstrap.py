@@ -0,0 +1,183 @@
+"""One-time server bootstrap (schema, merchant seed, cache warm-up) run off the request path.
+
+start() is cheap and idempotent, so the app calls it on every rerun: the first call in a process
+starts a background thread, later calls only report status. Schema changes and seeding run under
+a database-wide lock so several server processes starting together don't race each other.
+Geocoding, payments and maps are imported by the thread, not with this module, and the rendered
+maps are warmed after the app has been told it is ready.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import text
+
+import chat
+import db
+import events
+import instrumentation
+from catalog import get_catalog, load_catalog_file
+from lifecycle import backfill_status_history
+from models import Base, Merchant
+from scheduling import backfill_scheduled_at
+from spatial import backfill_geohashes, merchant_index
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process dev servers only
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary application-wide key for pg_advisory_lock
+BOOTSTRAP_LOCK_KEY = 0x4C42_0001
+RETRY_AFTER_SECONDS = 30
+
+_ready = threading.Event()
+_lock = threading.Lock()
+_thread = None
+_status = {'phase': 'not started', 'error': None, 'seconds': None, 'maps': None}
+_failed_at = None
+
+
+def is_ready():
+    return _ready.is_set()
+
+
+def status():
+    return dict(_status)
+
+
+def start(engine):
+    """Start the bootstrap thread unless it is running or already finished; returns is_ready()."""
+    global _thread
+    with _lock:
+        retry_pending = _failed_at is not None and time.monotonic() - _failed_at < RETRY_AFTER_SECONDS
+        if not _ready.is_set() and not retry_pending and (_thread is None or not _thread.is_alive()):
+            _thread = threading.Thread(target=run, args=(engine,), name='bootstrap', daemon=True)
+            _thread.start()
+    return _ready.is_set()
+
+
+@contextmanager
+def server_lock(engine):
+    """Serialize bootstrap across processes: a Postgres advisory lock, or a lock file beside a SQLite DB."""
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            conn.execute(text("SELECT pg_advisory_lock(:key)"), {'key': BOOTSTRAP_LOCK_KEY})
+            try:
+                yield
+            finally:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {'key': BOOTSTRAP_LOCK_KEY})
+                conn.commit()
+    elif fcntl and engine.url.database and engine.url.database != ':memory:':
+        with open(f"{os.path.abspath(engine.url.database)}.bootstrap.lock", 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        yield
+
+
+def seed_merchants(session, services, geocoder):
+    """Insert the catalog file's providers that aren't in the merchants table yet."""
+    from geocoding import GeocodingUnavailable
+
+    known = {name for (name,) in session.query(Merchant.name)}
+    # Queue every missing provider's geocode up front so cache hits don't wait behind upstream calls
+    pending = {
+        provider_name: (service_type, provider_info, geocoder.submit(provider_info['address']))
+        for service_type, providers in services.items()
+        for provider_name, provider_info in providers.items()
+        if provider_name not in known
+    }
+    for provider_name, (service_type, provider_info, future) in pending.items():
+        try:
+            location = future.result()
+        except GeocodingUnavailable as e:
+            logger.warning(f"Geocoding {provider_name} failed: {e}")
+            location = None
+        if location:
+            session.add(Merchant(
+                name=provider_name,
+                type=service_type,
+                latitude=location.latitude,
+                longitude=location.longitude,
+                website=provider_info['url']
+            ))
+        else:
+            logger.warning(f"Could not geocode {provider_name}; it will be retried on the next start")
+    session.commit()
+    return len(pending)
+
+
+def _phase(name):
+    _status['phase'] = name
+    logger.info(f"Bootstrap: {name}")
+
+
+def run(engine):
+    global _failed_at
+    started = time.perf_counter()
+    try:
+        import payments
+        from geocoding import get_geocoding_service
+        geocoder = get_geocoding_service()
+        with server_lock(engine):
+            _phase('schema')
+            db.ensure_schema(engine, Base.metadata)
+            with db.session_scope() as session:
+                backfill_geohashes(session)
+                backfill_status_history(session)
+                backfill_scheduled_at(session)
+                # Before seed_merchants waits on geocoding: on SQLite an open write transaction here
+                # blocks the geocoder's cache writes until they hit the busy timeout
+                session.commit()
+                _phase('geocode cache')
+                loaded = geocoder.cache.preload(session)
+                logger.info(f"Preloaded {loaded} geocoded addresses")
+                _phase('merchants')
+                services, _ = load_catalog_file()
+                seed_merchants(session, services, geocoder)
+        # Per-process warm-up needs no lock
+        _phase('order events')
+        events.start(engine)
+        _phase('chat')
+        chat.start(engine)
+        _phase('payments')
+        payments.start()
+        _phase('metrics')
+        instrumentation.start()
+        with db.session_scope() as session:
+            _phase('spatial index')
+            merchant_index.ensure_fresh(session)
+            _phase('catalog')
+            get_catalog(session)
+        _status.update(phase='ready', error=None, seconds=round(time.perf_counter() - started, 3))
+        _failed_at = None
+        _ready.set()
+    except Exception as e:
+        logger.exception("Bootstrap failed")
+        _status.update(phase='failed', error=str(e))
+        _failed_at = time.monotonic()
+        return
+    warm_maps()
+
+
+def warm_maps():
+    """Render the merchant maps (folium is the slowest import) so the Map page's first visit is a cache hit."""
+    try:
+        from maps import merchant_map_html
+        with db.session_scope() as session:
+            for service_type in (None, *get_catalog(session).types):
+                merchant_map_html(session, service_type=service_type)
+        _status['maps'] = 'warm'
+        logger.info("Bootstrap: maps warmed")
+    except Exception:
+        # The Map page renders on demand all the same
+        _status['maps'] = 'failed'
+        logger.exception("Map warm-up failed")
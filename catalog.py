@@ -0,0 +1,227 @@
+"""Merchant and partner catalog: loaded once per process, indexed in memory, reloaded when it changes.
+
+Provider details (instructions, address, phone, hours) and partner offers come from a data file
+(CATALOG_PATH, catalog.json by default); locations and any merchants imported in bulk come from
+the merchants table. Pages read an immutable Catalog, so a rerun costs dictionary lookups instead
+of queries. A new Catalog is built when the file's mtime or the 'merchants' data version moves;
+the version is checked at most every CATALOG_CHECK_SECONDS so most reruns don't touch the database.
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+
+from models import Merchant, get_data_version
+from spatial import geohash_prefixes_for_radius, haversine_km
+
+logger = logging.getLogger(__name__)
+
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+CATALOG_CHECK_SECONDS = float(os.getenv("CATALOG_CHECK_SECONDS", "5"))
+
+
+@dataclass(frozen=True)
+class Provider:
+    name: str
+    type: str
+    url: str = None
+    instructions: tuple = ()
+    address: str = None
+    phone: str = None
+    hours: str = None
+    video_url: str = None
+    image_url: str = None
+    # From the merchants table; None until the provider has been geocoded and seeded
+    merchant_id: int = None
+    latitude: float = None
+    longitude: float = None
+    geohash: str = None
+
+
+@dataclass(frozen=True)
+class Partner:
+    name: str
+    url: str = None
+    description: str = None
+    subscription_url: str = None
+    commission_rate: float = None
+    image_url: str = None
+
+
+def load_catalog_file(path=CATALOG_PATH):
+    """(services, partners) as in the data file: {type: {name: details}} and {name: details}."""
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    return data.get('services', {}), data.get('partners', {})
+
+
+def _frozen(mapping):
+    return MappingProxyType(dict(mapping))
+
+
+class Catalog:
+    """Immutable indexes over providers and partners; share one instance between reruns and threads."""
+
+    def __init__(self, services, partners, merchant_rows=(), stamp=None):
+        """services/partners as from load_catalog_file(); merchant_rows: (id, name, type, lat, lon, website, geohash)."""
+        merchant_rows = tuple(tuple(row) for row in merchant_rows)
+        self.source = (services, partners, merchant_rows)
+        located = {row[1]: row for row in merchant_rows}
+        providers = []
+        for service_type, entries in services.items():
+            for name, details in entries.items():
+                row = located.pop(name, None)
+                providers.append(Provider(
+                    name=name,
+                    type=service_type,
+                    url=details.get('url'),
+                    instructions=tuple(details.get('instructions', ())),
+                    address=details.get('address'),
+                    phone=details.get('phone'),
+                    hours=details.get('hours'),
+                    video_url=details.get('video_url'),
+                    image_url=details.get('image_url'),
+                    **(self._location(row) if row else {}),
+                ))
+        # Merchants that only exist in the table (bulk imports) are listed with what the table knows
+        for merchant_id, name, type_, latitude, longitude, website, geohash in located.values():
+            providers.append(Provider(name=name, type=type_, url=website, merchant_id=merchant_id,
+                                      latitude=latitude, longitude=longitude, geohash=geohash))
+
+        by_type = {}
+        for provider in providers:
+            by_type.setdefault(provider.type, []).append(provider)
+        self.stamp = stamp
+        # File order first, so the built-in service types keep their place in menus
+        self.types = tuple(by_type)
+        self.by_type = _frozen((type_, tuple(group)) for type_, group in by_type.items())
+        self.names_by_type = _frozen((type_, tuple(p.name for p in group)) for type_, group in by_type.items())
+        self.by_name = _frozen((provider.name, provider) for provider in providers)
+        self.by_id = _frozen((p.merchant_id, p) for p in providers if p.merchant_id is not None)
+        # Sorted by geohash, so every provider under a prefix is one contiguous slice
+        located_providers = sorted((p for p in providers if p.geohash), key=lambda p: p.geohash)
+        self._geohashes = tuple(p.geohash for p in located_providers)
+        self.by_geohash = tuple(located_providers)
+        self.partners = _frozen((name, Partner(name=name, **{
+            field: details.get(field) for field in Partner.__dataclass_fields__ if field != 'name'
+        })) for name, details in partners.items())
+        self._names_of = {}
+        self._names_lock = threading.Lock()
+
+    @staticmethod
+    def _location(row):
+        merchant_id, _, _, latitude, longitude, _, geohash = row
+        return {'merchant_id': merchant_id, 'latitude': latitude, 'longitude': longitude, 'geohash': geohash}
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def names_of(self, *types):
+        """Provider names of several types as one tuple, built once per catalog."""
+        names = self._names_of.get(types)
+        if names is None:
+            names = tuple(name for type_ in types for name in self.names_by_type.get(type_, ()))
+            with self._names_lock:
+                self._names_of[types] = names
+        return names
+
+    def with_prefix(self, prefix):
+        """Located providers whose geohash starts with prefix."""
+        start = bisect.bisect_left(self._geohashes, prefix)
+        end = bisect.bisect_left(self._geohashes, prefix + '~', lo=start)
+        return self.by_geohash[start:end]
+
+    def within(self, latitude, longitude, radius_km, type_=None):
+        """[(provider, distance_km)] within radius_km of a point, nearest first."""
+        results = []
+        for prefix in geohash_prefixes_for_radius(latitude, longitude, radius_km):
+            for provider in self.with_prefix(prefix):
+                if type_ is None or provider.type == type_:
+                    distance = haversine_km(latitude, longitude, provider.latitude, provider.longitude)
+                    if distance <= radius_km:
+                        results.append((provider, distance))
+        results.sort(key=lambda item: item[1])
+        return results
+
+
+def _merchant_rows(session):
+    return session.query(Merchant.id, Merchant.name, Merchant.type, Merchant.latitude, Merchant.longitude,
+                         Merchant.website, Merchant.geohash).order_by(Merchant.id).all()
+
+
+class CatalogStore:
+    """Holds the current Catalog and replaces it when the data file or the merchants table changes."""
+
+    def __init__(self, path=CATALOG_PATH, check_seconds=CATALOG_CHECK_SECONDS, clock=time.monotonic):
+        self.path = path
+        self.check_seconds = check_seconds
+        self._clock = clock
+        self._catalog = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self.loads = 0
+
+    def _file_stamp(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def get(self, session=None):
+        """The current Catalog. Without a session (or before the database is usable) merchants that
+        aren't in the data file are missing and nothing has a location, until a later call has one."""
+        catalog, checked_at = self._catalog, self._checked_at
+        if catalog is not None and checked_at is not None and self._clock() - checked_at < self.check_seconds:
+            return catalog
+        with self._lock:
+            if self._catalog is not catalog:
+                return self._catalog  # another thread just reloaded
+            checked = False
+            version = catalog.stamp[1] if catalog is not None else None
+            if session is not None:
+                try:
+                    version, checked = get_data_version(session, 'merchants'), True
+                except Exception as e:
+                    logger.warning(f"Catalog version check failed: {e}")
+                    session.rollback()
+            stamp = (self._file_stamp(), version)
+            if catalog is None or stamp != catalog.stamp:
+                catalog = self._load(session if checked else None, stamp, previous=catalog)
+            # Until a check against the database succeeds, every call that brings a session retries it
+            self._checked_at = self._clock() if checked else None
+            self._catalog = catalog
+            return catalog
+
+    def _load(self, session, stamp, previous):
+        try:
+            services, partners = load_catalog_file(self.path)
+        except (OSError, ValueError) as e:
+            if previous is None:
+                raise
+            # Keep serving the last good file contents while the file is being edited
+            logger.error(f"Could not reload catalog from {self.path}: {e}")
+            services, partners = previous.source[:2]
+        if session is not None:
+            merchant_rows = _merchant_rows(session)
+        else:
+            merchant_rows = previous.source[2] if previous is not None else ()
+        catalog = Catalog(services, partners, merchant_rows, stamp)
+        self.loads += 1
+        logger.info(f"Loaded catalog: {len(catalog)} providers, {len(catalog.partners)} partners")
+        return catalog
+
+    def invalidate(self):
+        with self._lock:
+            self._checked_at = None
+
+
+# Shared by every session in this server process
+catalog_store = CatalogStore()
+
+
+def get_catalog(session=None):
+    return catalog_store.get(session)
@@ -0,0 +1,371 @@
+"""LIVE SHOP chat: an append-only message table paged by id, with a ring buffer per active room.
+
+A room is one live session between a customer and a store. Readers fetch the latest page once and
+afterwards only what is new. Each server process keeps the newest CHAT_RING_SIZE messages of the
+rooms it is serving in memory and wakes their watchers when one arrives, so an idle chat costs no
+queries. Messages reach every process the same way order events do: NOTIFY on Postgres, a poller
+following the id column elsewhere (woken at once by local commits).
+"""
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass
+from datetime import datetime
+
+import sqlalchemy.orm
+from sqlalchemy import event, func, select, text
+
+from events import RECONNECT_SECONDS, PostgresListener
+from models import ChatMessage, StoreAssociate, User
+
+logger = logging.getLogger(__name__)
+
+CHAT_CHANNEL = 'chat_messages'
+CHAT_RING_SIZE = int(os.getenv("CHAT_RING_SIZE", "200"))
+CHAT_MAX_ROOMS = int(os.getenv("CHAT_MAX_ROOMS", "5000"))
+CHAT_POLL_INTERVAL = float(os.getenv("CHAT_POLL_INTERVAL", "0.5"))
+CHAT_PAGE_SIZE = 50
+MAX_MESSAGE_LENGTH = 1000
+# Postgres' NOTIFY payload limit; a message is sent whole, so its JSON has to fit (checked in bytes, since
+# a character can take up to 4 in UTF-8 and a control character 6 once escaped)
+NOTIFY_PAYLOAD_BYTES = 8000
+
+CUSTOMER = 'customer'
+ASSOCIATE = 'associate'
+# users.type of the accounts that can be a store's associate (see models.StoreAssociate)
+ASSOCIATE_USER_TYPE = 'merchant'
+
+
+class NotAnAssociate(PermissionError):
+    """The sender isn't an associate of the store."""
+
+
+@dataclass(frozen=True)
+class Message:
+    id: int
+    store: str
+    session_id: str
+    sender_id: str
+    sender_role: str
+    body: str
+    created_at: datetime
+
+    @property
+    def room(self):
+        return (self.store, self.session_id)
+
+    def to_json(self):
+        return json.dumps({**asdict(self), 'created_at': self.created_at.isoformat()}, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, payload):
+        fields = json.loads(payload)
+        return cls(**{**fields, 'created_at': datetime.fromisoformat(fields['created_at'])})
+
+
+MESSAGE_COLUMNS = (
+    ChatMessage.id,
+    ChatMessage.store,
+    ChatMessage.session_id,
+    ChatMessage.sender_id,
+    ChatMessage.sender_role,
+    ChatMessage.body,
+    ChatMessage.created_at,
+)
+
+
+class _Room:
+    __slots__ = ('entries', 'floor', 'arrived')
+
+    def __init__(self, floor, ring_size, lock):
+        self.entries = deque(maxlen=ring_size)  # (arrival sequence, Message)
+        # Every message that arrived after this sequence number is still in entries
+        self.floor = floor
+        # Per room, so a message wakes only its own room's watchers
+        self.arrived = threading.Condition(lock)
+
+
+class ChatHub:
+    """Ring buffers of the rooms this process serves, versioned by arrival like the order EventBus."""
+
+    def __init__(self, ring_size=CHAT_RING_SIZE, max_rooms=CHAT_MAX_ROOMS):
+        self._lock = threading.Lock()
+        self._rooms = OrderedDict()  # least recently used first
+        self._sequence = 0
+        self.ring_size = ring_size
+        self.max_rooms = max_rooms
+
+    def track(self, room):
+        """Start buffering room (if not already); returns the version to read on from."""
+        with self._lock:
+            if room not in self._rooms:
+                self._rooms[room] = _Room(self._sequence, self.ring_size, self._lock)
+                while len(self._rooms) > self.max_rooms:
+                    _, evicted = self._rooms.popitem(last=False)
+                    evicted.arrived.notify_all()
+            self._rooms.move_to_end(room)
+            entries = self._rooms[room].entries
+            return entries[-1][0] if entries else self._rooms[room].floor
+
+    def publish(self, message):
+        with self._lock:
+            room = self._rooms.get(message.room)
+            if room is None:
+                return  # nobody reads this room in this process
+            self._sequence += 1
+            if len(room.entries) == room.entries.maxlen:
+                room.floor = room.entries[0][0]
+            room.entries.append((self._sequence, message))
+            room.arrived.notify_all()
+
+    def version(self, room):
+        """Arrival sequence of the room's latest message; None if the room isn't buffered (any more)."""
+        with self._lock:
+            return self._version(room)
+
+    def since(self, room, after):
+        """(messages that arrived after version `after`, new version), or None if the ring no longer has them all."""
+        with self._lock:
+            tracked = self._rooms.get(room)
+            if tracked is None or after < tracked.floor:
+                return None
+            self._rooms.move_to_end(room)
+            new = [message for sequence, message in tracked.entries if sequence > after]
+            return new, tracked.entries[-1][0] if tracked.entries else tracked.floor
+
+    def wait(self, room, after, timeout=None):
+        """Block until the room moves past version `after`; returns the new version (or `after` on timeout)."""
+        with self._lock:
+            tracked = self._rooms.get(room)
+            if tracked is not None:
+                tracked.arrived.wait_for(lambda: self._version(room) != after, timeout)
+            return self._version(room)
+
+    def _version(self, room):
+        tracked = self._rooms.get(room)
+        if tracked is None:
+            return None
+        return tracked.entries[-1][0] if tracked.entries else tracked.floor
+
+
+chat_hub = ChatHub()
+
+
+def _room_criteria(store, session_id):
+    return (ChatMessage.store == store, ChatMessage.session_id == session_id)
+
+
+def load_messages(session, store, session_id, after_id=0, limit=CHAT_PAGE_SIZE):
+    """Up to limit messages newer than after_id, oldest first."""
+    stmt = (
+        select(*MESSAGE_COLUMNS)
+        .where(*_room_criteria(store, session_id), ChatMessage.id > after_id)
+        .order_by(ChatMessage.id)
+        .limit(limit)
+    )
+    return [Message(*row) for row in session.execute(stmt)]
+
+
+def load_before(session, store, session_id, before_id=None, limit=CHAT_PAGE_SIZE):
+    """The limit messages before before_id (the latest ones without it), oldest first."""
+    criteria = _room_criteria(store, session_id)
+    if before_id is not None:
+        criteria += (ChatMessage.id < before_id,)
+    stmt = select(*MESSAGE_COLUMNS).where(*criteria).order_by(ChatMessage.id.desc()).limit(limit)
+    return [Message(*row) for row in reversed(session.execute(stmt).all())]
+
+
+def active_rooms(session, store, since):
+    """[(session_id, last message time)] for the store's rooms with messages since `since`, newest first."""
+    last_at = func.max(ChatMessage.created_at)
+    stmt = (
+        select(ChatMessage.session_id, last_at)
+        .where(ChatMessage.store == store)
+        .group_by(ChatMessage.session_id)
+        .having(last_at >= since)
+        .order_by(last_at.desc())
+    )
+    return session.execute(stmt).all()
+
+
+def is_associate(session, user_id, store):
+    stmt = (
+        select(StoreAssociate.user_id)
+        .join(User, User.id == StoreAssociate.user_id)
+        .where(StoreAssociate.user_id == user_id, StoreAssociate.store == store, User.type == ASSOCIATE_USER_TYPE)
+    )
+    return session.execute(stmt).first() is not None
+
+
+def chat_role(session, user, store):
+    """ASSOCIATE for a merchant user associated with the store, CUSTOMER for everyone else."""
+    if user.type == ASSOCIATE_USER_TYPE and is_associate(session, user.id, store):
+        return ASSOCIATE
+    return CUSTOMER
+
+
+def send_message(session, store, session_id, sender_id, sender_role, body):
+    """Append a message and commit; watchers of the room are woken once it is committed.
+
+    Raises ValueError for an empty or overlong message or an unknown role, and NotAnAssociate when
+    the sender posts as an associate of a store they aren't an associate of.
+    """
+    if sender_role not in (CUSTOMER, ASSOCIATE):
+        raise ValueError(f"Unknown chat role {sender_role!r}")
+    if sender_role == ASSOCIATE and not is_associate(session, sender_id, store):
+        raise NotAnAssociate(f"{sender_id} is not an associate of {store}")
+    body = body.strip()
+    if not body:
+        raise ValueError("Message is empty")
+    if len(body) > MAX_MESSAGE_LENGTH:
+        raise ValueError(f"Message is longer than {MAX_MESSAGE_LENGTH} characters")
+    # The widest id and timestamp the row can get, so the payload sent after the insert fits too
+    widest = Message(2 ** 63 - 1, store, session_id, sender_id, sender_role, body, datetime.max)
+    if len(widest.to_json().encode('utf-8')) > NOTIFY_PAYLOAD_BYTES:
+        raise ValueError("Message is too long")
+    row = ChatMessage(store=store, session_id=session_id, sender_id=sender_id, sender_role=sender_role, body=body)
+    session.add(row)
+    session.flush()
+    message = Message(row.id, store, session_id, sender_id, sender_role, body, row.created_at)
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                        {'channel': CHAT_CHANNEL, 'payload': message.to_json()})
+    session.info.setdefault('chat_messages', []).append(message)
+    session.commit()
+    return message
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    pending = session.info.pop('chat_messages', None)
+    if not pending:
+        return
+    if _feed is None:
+        for message in pending:
+            chat_hub.publish(message)
+    else:
+        _feed.wake()
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('chat_messages', None)
+
+
+class RoomCursor:
+    """One reader's view of a room: the messages loaded so far and where to continue from."""
+
+    def __init__(self, store, session_id, hub=chat_hub, page_size=CHAT_PAGE_SIZE):
+        self.store = store
+        self.session_id = session_id
+        self.hub = hub
+        self.page_size = page_size
+        self.messages = []
+        self.version = None
+        self.has_older = False
+
+    @property
+    def room(self):
+        return (self.store, self.session_id)
+
+    def refresh(self, session):
+        """Pick up new messages; True if there were any. Reads the database only on first use or a ring miss."""
+        if self.version is None:
+            # Track before loading, so a message committed in between is in the ring or the page
+            self.version = self.hub.track(self.room)
+            self.messages = load_before(session, self.store, self.session_id, limit=self.page_size)
+            self.has_older = len(self.messages) == self.page_size
+            return True
+        if self.hub.version(self.room) == self.version:
+            return False
+        result = self.hub.since(self.room, self.version)
+        if result is None:
+            self.version = self.hub.track(self.room)
+            last_id = self.messages[-1].id if self.messages else 0
+            new = load_messages(session, self.store, self.session_id, after_id=last_id, limit=self.hub.ring_size)
+        else:
+            new, self.version = result
+        return self.add(new)
+
+    def load_older(self, session):
+        older = load_before(session, self.store, self.session_id,
+                            before_id=self.messages[0].id if self.messages else None, limit=self.page_size)
+        self.has_older = len(older) == self.page_size
+        self.messages = older + self.messages
+
+    def add(self, new):
+        """Merge messages in (e.g. the reader's own just-sent one); True if any were new."""
+        known = {message.id for message in self.messages[-len(new) - self.hub.ring_size:]}
+        new = [message for message in new if message.id not in known]
+        if new:
+            self.messages = sorted(self.messages + new, key=lambda message: message.id)
+        return bool(new)
+
+
+class ChatPoller(threading.Thread):
+    """Publishes messages appended to chat_messages since the last poll (see events.PollingListener)."""
+
+    def __init__(self, engine, hub, interval=CHAT_POLL_INTERVAL):
+        super().__init__(name='chat-poll', daemon=True)
+        self.engine = engine
+        self.hub = hub
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        with engine.connect() as conn:
+            self._cursor = conn.execute(select(func.max(ChatMessage.id))).scalar() or 0
+        self.polls = 0
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Chat poll failed")
+                self._stopping.wait(RECONNECT_SECONDS)
+
+    def poll(self):
+        stmt = select(*MESSAGE_COLUMNS).where(ChatMessage.id > self._cursor).order_by(ChatMessage.id)
+        with self.engine.connect() as conn:
+            rows = conn.execute(stmt).all()
+        self.polls += 1
+        for row in rows:
+            self._cursor = row.id
+            self.hub.publish(Message(*row))
+
+
+_feed = None
+_feed_lock = threading.Lock()
+
+
+def start(engine, hub=chat_hub):
+    """Start this process's chat feed (idempotent); returns it."""
+    global _feed
+    with _feed_lock:
+        if _feed is None or not _feed.is_alive():
+            if engine.dialect.name == 'postgresql':
+                _feed = PostgresListener(engine, hub, channel=CHAT_CHANNEL, decode=Message.from_json)
+            else:
+                _feed = ChatPoller(engine, hub)
+            _feed.start()
+        return _feed
+
+
+def stop():
+    global _feed
+    with _feed_lock:
+        if _feed is not None:
+            _feed.stop()
+            _feed.join(timeout=5)
+            _feed = None
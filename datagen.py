@@ -0,0 +1,541 @@
+"""Synthetic data at scale: users, merchants, orders with their status history, subscriptions and geocodes.
+
+    python datagen.py --orders 10000000 [--users 200000] [--merchants 3000] [--days 365] [--seed 24]
+
+Homes and merchants are clustered around the towns near Odenton, MD. Orders are spread over the
+last --days days and the next few: volume grows over the period, weekends are busier, slots
+follow the schedule CSV's hours with lunch and dinner peaks. Each order's status follows from
+its slot (past slots are mostly delivered, the next hour is in progress, later ones are pending),
+and it gets the order_events history the app would have written. Customers order at heavy-tailed
+rates, mostly from merchants in their own town.
+
+Rows are generated a batch at a time as NumPy columns and written with COPY on Postgres (see
+db.copy_rows) or executemany on SQLite. The orders and order_events secondary indexes are dropped
+for the load and built afterwards, unless --keep-indexes is given.
+
+Times are relative to now, or to --now. The same --seed and --now produce the same rows, IDs
+included. To add a second batch with the same seed to the same database, give it another
+--id-salt so that its IDs and emails don't collide with the first batch.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import nullcontext
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.exc import IntegrityError
+
+import db
+from catalog import load_catalog_file
+from geocode_cache import normalize_address
+from lifecycle import CANCELLED, DELIVERED, ON_THE_WAY, PENDING, PREPARING
+from models import Base, GeocodeCache, Merchant, Order, OrderStatusChange, Subscription, User, UTCDateTime, bump_data_version
+from payments import PAID, PAYMENT_EXPIRED, PAYMENT_FAILED, PAYMENT_PENDING
+from scheduling import SERVICE_TIMEZONE, format_slot, read_slot_rows
+from spatial import geohash_encode_array
+
+BATCH_SIZE = 100_000
+
+# (town, zip, latitude, longitude, share of homes and merchants)
+TOWNS = (
+    ("Odenton", "21113", 39.0840, -76.6994, 0.24),
+    ("Crofton", "21114", 39.0018, -76.6875, 0.12),
+    ("Gambrills", "21054", 39.0671, -76.6652, 0.08),
+    ("Severn", "21144", 39.1371, -76.6983, 0.12),
+    ("Fort Meade", "20755", 39.1090, -76.7430, 0.06),
+    ("Laurel", "20724", 39.0993, -76.8483, 0.10),
+    ("Hanover", "21076", 39.1929, -76.7241, 0.08),
+    ("Millersville", "21108", 39.0598, -76.6480, 0.06),
+    ("Glen Burnie", "21061", 39.1626, -76.6247, 0.09),
+    ("Bowie", "20715", 38.9429, -76.7302, 0.05),
+)
+# Spread around a town centre, in degrees (about 2 km for homes, 1 km for merchants)
+HOME_SPREAD, MERCHANT_SPREAD = 0.018, 0.009
+STREETS = ("Odenton Rd", "Annapolis Rd", "Piney Orchard Pkwy", "Blue Water Blvd", "Hale St", "Baldwin Rd",
+           "Telegraph Rd", "Reece Rd", "Berger Rd", "Patuxent Rd", "Waugh Chapel Rd", "Crain Hwy",
+           "Duvall Hwy", "Riedel Rd", "Sappington Station Rd", "Nevada Ave", "Morgan Rd", "Severn Ln")
+FIRST_NAMES = ("James", "Mary", "Robert", "Patricia", "John", "Jennifer", "Michael", "Linda", "David",
+               "Elizabeth", "William", "Barbara", "Richard", "Susan", "Joseph", "Jessica", "Thomas", "Sarah",
+               "Carlos", "Maria", "Wei", "Aisha", "Darnell", "Priya", "Kevin", "Nicole", "Andre", "Grace")
+LAST_NAMES = ("Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez",
+              "Martinez", "Hernandez", "Lopez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson",
+              "Lee", "Nguyen", "Kim", "Patel", "Walker", "Young", "Allen", "King", "Wright", "Scott")
+USER_TYPES = (('customer', 0.92), ('driver', 0.06), ('merchant', 0.02))
+# Merchant type -> (share, name words, lognormal (mu, sigma) of an order's total, mean lead time in hours)
+MERCHANT_TYPES = {
+    'Groceries': (0.35, ("Market", "Grocers", "Fresh Foods", "Pantry"), (4.0, 0.5), 20.0),
+    'Restaurants': (0.50, ("Kitchen", "Grill", "Bistro", "Pizzeria", "Taqueria"), (3.3, 0.45), 1.5),
+    'Laundry': (0.15, ("Laundry", "Cleaners", "Wash & Fold"), (3.4, 0.35), 24.0),
+}
+MERCHANT_PREFIXES = ("Main Street", "Patuxent", "Chesapeake", "Red Oak", "Harbor", "Golden", "Village", "Sunrise")
+# Monday first; weekends are busier
+WEEKDAY_WEIGHTS = (0.90, 0.90, 0.95, 1.00, 1.15, 1.25, 1.10)
+# Bookings already made for the next days, relative to a full day
+AHEAD_WEIGHTS = (0.6, 0.3, 0.15)
+# Subscriptions per customer, on average
+SUBSCRIPTION_RATE = 0.12
+# Statuses and payment statuses as small integer codes while generating
+STATUS_CODES = (PENDING, PREPARING, ON_THE_WAY, DELIVERED, CANCELLED)
+PAYMENT_CODES = (PAYMENT_PENDING, PAID, PAYMENT_FAILED, PAYMENT_EXPIRED)
+# Status history per final status, as indexes into STATUS_CODES
+HISTORIES = {
+    PENDING: (0,),
+    PREPARING: (0, 1),
+    ON_THE_WAY: (0, 1, 2),
+    DELIVERED: (0, 1, 2, 3),
+    CANCELLED: (0, 4),
+}
+
+_CROCKFORD_CODES = np.frombuffer(b'0123456789ABCDEFGHJKMNPQRSTVWXYZ', dtype=np.uint8)
+_MS = np.timedelta64(1, 'ms')
+
+
+def ulids(prefix, timestamps, rng):
+    """IDs in ids.new_id()'s format for rows created at timestamps (datetime64), as an array of str."""
+    milliseconds = (np.asarray(timestamps, dtype='datetime64[ms]') - np.datetime64(0, 'ms')) // _MS
+    head = len(prefix) + 1
+    chars = np.empty((len(milliseconds), head + 26), dtype=np.uint8)
+    chars[:, :head] = np.frombuffer(f"{prefix}-".encode(), dtype=np.uint8)
+    # 48-bit millisecond timestamp in 10 base32 digits, then 80 random bits in 16
+    value = milliseconds.astype(np.int64)
+    for position in range(head + 9, head - 1, -1):
+        chars[:, position] = _CROCKFORD_CODES[value & 31]
+        value = value >> 5
+    chars[:, head + 10:] = _CROCKFORD_CODES[rng.integers(0, 32, (len(milliseconds), 16))]
+    return chars.view(f'S{head + 26}').ravel().astype(str)
+
+
+def _join(*parts):
+    """Element-wise string concatenation of arrays and scalars."""
+    result = np.asarray(parts[0]).astype(str)
+    for part in parts[1:]:
+        result = np.char.add(result, np.asarray(part).astype(str))
+    return result
+
+
+def _weights(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values / values.sum()
+
+
+def _town_points(rng, count, spread):
+    """(town indexes, latitudes, longitudes) for count points clustered around TOWNS."""
+    towns = rng.choice(len(TOWNS), size=count, p=_weights([town[4] for town in TOWNS]))
+    centres = np.array([(town[2], town[3]) for town in TOWNS])
+    latitudes = centres[towns, 0] + rng.normal(0, spread, count)
+    longitudes = centres[towns, 1] + rng.normal(0, spread * 1.3, count)  # degrees of longitude are shorter here
+    return towns, latitudes.round(6), longitudes.round(6)
+
+
+def slot_minutes():
+    """Minutes after midnight of every slot the schedule CSV offers."""
+    return np.array(sorted({slot.hour * 60 + slot.minute for _, slot, _ in read_slot_rows()}))
+
+
+def generate_users(rng, count, now, id_rng):
+    """Columns for count users with home addresses; also returns (towns, latitudes, longitudes) of the homes."""
+    towns, latitudes, longitudes = _town_points(rng, count, HOME_SPREAD)
+    created = np.datetime64(now, 'ms') - rng.integers(0, 3 * 365 * 86_400_000, count).astype('timedelta64[ms]')
+    ids = ulids('USR', created, id_rng)
+    first = np.array(FIRST_NAMES)[rng.integers(0, len(FIRST_NAMES), count)]
+    last = np.array(LAST_NAMES)[rng.integers(0, len(LAST_NAMES), count)]
+    town_names = np.array([f", {town[0]}, MD {town[1]}" for town in TOWNS])
+    streets = np.array(STREETS)[rng.integers(0, len(STREETS), count)]
+    columns = {
+        'id': ids,
+        'name': _join(first, " ", last),
+        # The ID keeps emails unique, across runs too
+        'email': np.char.lower(_join(first, ".", last, ".", np.char.replace(ids, "USR-", ""), "@example.com")),
+        'type': np.array([t for t, _ in USER_TYPES])[rng.choice(len(USER_TYPES), size=count, p=_weights([w for _, w in USER_TYPES]))],
+        'address': _join(rng.integers(1, 9999, count), " ", streets, town_names[towns]),
+    }
+    return columns, (towns, latitudes, longitudes)
+
+
+def generate_merchants(rng, count, first_id):
+    """Columns for count merchants with explicit IDs from first_id, so orders can refer to them."""
+    towns, latitudes, longitudes = _town_points(rng, count, MERCHANT_SPREAD)
+    types = list(MERCHANT_TYPES)
+    type_codes = rng.choice(len(types), size=count, p=_weights([spec[0] for spec in MERCHANT_TYPES.values()]))
+    names = np.empty(count, dtype=object)
+    for code, type_ in enumerate(types):
+        rows = np.flatnonzero(type_codes == code)
+        words = np.array(MERCHANT_TYPES[type_][1])[rng.integers(0, len(MERCHANT_TYPES[type_][1]), len(rows))]
+        prefixes = np.array(MERCHANT_PREFIXES)[rng.integers(0, len(MERCHANT_PREFIXES), len(rows))]
+        names[rows] = _join(prefixes, " ", words, " #", first_id + rows)
+    ids = np.arange(first_id, first_id + count)
+    return {
+        'id': ids,
+        'name': names.astype(str),
+        'type': np.array(types)[type_codes],
+        'latitude': latitudes,
+        'longitude': longitudes,
+        'website': _join("https://merchant", ids, ".example.com"),
+        'geohash': geohash_encode_array(latitudes, longitudes),
+    }, towns
+
+
+def generate_geocodes(users, homes, rng, now):
+    """geocode_cache rows for the users' addresses, one per normalized address, mostly still fresh."""
+    _, latitudes, longitudes = homes
+    keys = {}
+    for address, latitude, longitude in zip(users['address'].tolist(), latitudes.tolist(), longitudes.tolist()):
+        keys.setdefault(normalize_address(address), (latitude, longitude))
+    count = len(keys)
+    return {
+        'address': np.array(list(keys), dtype=str),
+        'latitude': np.array([point[0] for point in keys.values()]),
+        'longitude': np.array([point[1] for point in keys.values()]),
+        # Some entries are past GEOCODE_TTL, as on a server that has been running a while
+        'updated_at': np.datetime64(now, 'us') - rng.integers(0, 45 * 86_400, count).astype('timedelta64[s]'),
+    }
+
+
+def generate_subscriptions(rng, customer_ids, partners, now, id_rng):
+    if not partners or not len(customer_ids):
+        return None
+    count = rng.binomial(len(customer_ids), SUBSCRIPTION_RATE)
+    created = np.datetime64(now, 'ms') - rng.integers(0, 365 * 86_400_000, count).astype('timedelta64[ms]')
+    return {
+        'user_id': customer_ids[rng.integers(0, len(customer_ids), count)],
+        'partner_name': np.array(partners)[rng.integers(0, len(partners), count)],
+        'subscription_id': ulids('SUB', created, id_rng),
+        'status': np.where(rng.random(count) < 0.8, 'Active', 'Cancelled'),
+    }
+
+
+def daily_order_counts(rng, total, days, today):
+    """Orders per day from days ago to len(AHEAD_WEIGHTS) days ahead: growing, busier at weekends."""
+    dates = np.arange(np.datetime64(today, 'D') - days, np.datetime64(today, 'D') + len(AHEAD_WEIGHTS) + 1)
+    growth = np.concatenate([np.linspace(0.5, 1.0, days + 1), np.array(AHEAD_WEIGHTS)])
+    weekdays = (dates.astype(np.int64) + 3) % 7  # 1970-01-01 was a Thursday
+    return dates, rng.multinomial(total, _weights(growth * np.array(WEEKDAY_WEIGHTS)[weekdays]))
+
+
+def slot_weights(minutes):
+    """Lunch and dinner peaks over a steady daytime base."""
+    hours = minutes / 60
+    return _weights(0.3 + np.exp(-((hours - 12) / 1.2) ** 2) + 1.3 * np.exp(-((hours - 18.5) / 1.5) ** 2))
+
+
+class OrderGenerator:
+    """Orders (and their order_events) a batch at a time, in slot-date order."""
+
+    def __init__(self, rng, count, days, now, customers, drivers, merchants, merchant_towns, id_rng):
+        self.rng = rng
+        self.id_rng = id_rng
+        self.now = np.datetime64(now.replace(tzinfo=None), 'us')  # service-local wall time
+        self.customer_ids, self.customer_towns, self.customer_addresses = customers
+        self.driver_ids = drivers
+        self.merchants = merchants
+        # Codes index the sorted type names
+        self.merchant_types, self.type_codes = np.unique(merchants['type'], return_inverse=True)
+        # Heavy-tailed: a few customers order far more often than most
+        self.customer_weights = _weights(rng.pareto(1.5, len(self.customer_ids)) + 0.05)
+        # Per town, its merchants with Zipf-like popularity; 20% of orders go to any merchant
+        self.town_merchants = {}
+        for town in range(len(TOWNS)):
+            members = np.flatnonzero(merchant_towns == town)
+            if len(members):
+                self.town_merchants[town] = (members, _weights(1 / np.arange(1, len(members) + 1) ** 0.8))
+        self.minutes = slot_minutes()
+        self.labels = np.array([format_slot(datetime(2000, 1, 1) + timedelta(minutes=int(m))) for m in self.minutes])
+        self.dates, counts = daily_order_counts(rng, count, days, self.now.astype('datetime64[D]'))
+        self.day_of_order = np.repeat(np.arange(len(self.dates)), counts)
+        # UTC offset of each day at noon; no slot falls in the night-time DST switch
+        self.utc_offsets = np.array([
+            int(SERVICE_TIMEZONE.utcoffset(datetime.fromisoformat(str(day)) + timedelta(hours=12)).total_seconds())
+            for day in self.dates
+        ]).astype('timedelta64[s]')
+        self.count = count
+
+    def batches(self, batch_size=BATCH_SIZE):
+        for start in range(0, self.count, batch_size):
+            yield self.batch(self.day_of_order[start:start + batch_size])
+
+    def _merchants_for(self, towns):
+        rng = self.rng
+        chosen = rng.integers(0, len(self.merchants['id']), len(towns))
+        local = rng.random(len(towns)) < 0.8
+        for town, (members, weights) in self.town_merchants.items():
+            rows = np.flatnonzero(local & (towns == town))
+            chosen[rows] = members[rng.choice(len(members), size=len(rows), p=weights)]
+        return chosen
+
+    def _statuses(self, slots):
+        """Status codes from how far each slot is from now."""
+        rng = self.rng
+        hours = (slots - self.now) / np.timedelta64(1, 'h')
+        draw = rng.random(len(slots))
+        past = np.where(draw < 0.92, 3, 4)
+        # Within the hour around the slot orders are being prepared and delivered
+        current = np.select([draw < 0.15, draw < 0.40, draw < 0.90, draw < 0.95], [0, 1, 2, 3], 4)
+        upcoming = np.select([draw < 0.93, draw < 0.95], [0, 1], 4)
+        return np.select([hours < -2, hours < 1], [past, current], upcoming).astype(np.int8)
+
+    def batch(self, days):
+        rng = self.rng
+        n = len(days)
+        slot_minutes_ = rng.choice(len(self.minutes), size=n, p=slot_weights(self.minutes))
+        dates = self.dates[days].astype('datetime64[us]')
+        slots = dates + self.minutes[slot_minutes_].astype('timedelta64[m]')
+        customers = rng.choice(len(self.customer_ids), size=n, p=self.customer_weights)
+        merchant_rows = self._merchants_for(self.customer_towns[customers])
+        types = self.type_codes[merchant_rows]
+        specs = [MERCHANT_TYPES[type_] for type_ in self.merchant_types]
+        mu = np.array([spec[2][0] for spec in specs])[types]
+        sigma = np.array([spec[2][1] for spec in specs])[types]
+        lead_hours = rng.exponential(np.array([spec[3] for spec in specs])[types]) + 0.25
+        created = slots - (lead_hours * 3_600_000_000).astype('timedelta64[us]')
+        # Nobody books a slot that was already over
+        created = np.minimum(created, self.now)
+        statuses = self._statuses(slots)
+
+        online = rng.random(n) < 0.75
+        draw = rng.random(n)
+        paid_online = np.select([draw < 0.97, draw < 0.98], [1, 2], 0)
+        payment = np.where(online, paid_online, np.where(statuses == 3, 1, 0))
+        payment = np.where(online & (statuses == 4), np.where(draw < 0.6, 3, 1), payment).astype(np.int8)
+
+        # Times of each history step: placed, preparing, on the way, delivered; cancellations replace step 1
+        step_times = np.empty((n, 4), dtype='datetime64[us]')
+        step_times[:, 0] = created
+        prepare = slots - rng.integers(20, 60, n).astype('timedelta64[m]')
+        step_times[:, 1] = np.maximum(prepare, created)
+        step_times[:, 2] = np.maximum(slots - rng.integers(5, 15, n).astype('timedelta64[m]'), step_times[:, 1])
+        step_times[:, 3] = slots + rng.integers(10, 45, n).astype('timedelta64[m]')
+        cancelled = statuses == 4
+        step_times[cancelled, 1] = created[cancelled] + (
+            (slots[cancelled] - created[cancelled]) * rng.random(cancelled.sum())).astype('timedelta64[us]')
+        steps = np.array([len(HISTORIES[STATUS_CODES[code]]) for code in range(len(STATUS_CODES))])[statuses]
+        updated = step_times[np.arange(n), steps - 1]
+
+        drivers = np.full(n, None, dtype=object)
+        if len(self.driver_ids):
+            assigned = (statuses >= 1) & (statuses <= 3)
+            drivers[assigned] = self.driver_ids[rng.integers(0, len(self.driver_ids), assigned.sum())]
+        order_ids = ulids('ORD', created, self.id_rng)
+        user_ids = self.customer_ids[customers]
+        totals = np.round(rng.lognormal(mu, sigma), 2)
+        orders = {
+            'id': order_ids,
+            'user_id': user_ids,
+            'merchant_id': self.merchants['id'][merchant_rows],
+            'service': self.merchant_types[types],
+            'date': dates,
+            'time': self.labels[slot_minutes_],
+            'address': self.customer_addresses[customers],
+            'status': np.array(STATUS_CODES)[statuses],
+            'payment_status': np.array(PAYMENT_CODES)[payment],
+            'payment_method': np.where(online, 'Online', 'In-Person'),
+            'total_amount': totals,
+            'driver_id': drivers,
+            'updated_at': updated,
+            'scheduled_at': slots - self.utc_offsets[days],
+        }
+        return orders, self._events(orders, statuses, steps, step_times, user_ids, drivers)
+
+    def _events(self, orders, statuses, steps, step_times, user_ids, drivers):
+        """One order_events row per transition, as lifecycle.record_created / transition write them."""
+        rows = np.repeat(np.arange(len(statuses)), steps)
+        position = np.arange(len(rows)) - np.repeat(np.cumsum(steps) - steps, steps)
+        paths = np.full((len(STATUS_CODES), 4), -1, dtype=np.int8)
+        for code, status in enumerate(STATUS_CODES):
+            paths[code, :len(HISTORIES[status])] = HISTORIES[status]
+        to_status = paths[statuses[rows], position]
+        from_status = np.where(position > 0, paths[statuses[rows], np.maximum(position - 1, 0)], -1)
+        names = np.array(STATUS_CODES + (None,), dtype=object)
+        # Customers place and cancel their orders; drivers move them along
+        actors = np.where((position == 0) | (to_status == 4), user_ids[rows], drivers[rows])
+        return {
+            'order_id': orders['id'][rows],
+            'from_status': names[from_status],
+            'to_status': names[to_status].astype(str),
+            'actor_id': actors,
+            'created_at': step_times[rows, position],
+        }
+
+
+class TableWriter:
+    """Writes column batches to one table: COPY on Postgres, executemany on SQLite, Core inserts elsewhere."""
+
+    def __init__(self, engine, table):
+        self.engine = engine
+        self.table = table
+        self.dialect = engine.dialect.name
+        self.rows = 0
+
+    def _values(self, name, values):
+        column = self.table.c[name]
+        if np.issubdtype(values.dtype, np.datetime64):
+            utc = isinstance(column.type, UTCDateTime)
+            if self.dialect in ('sqlite', 'postgresql'):
+                # The text SQLAlchemy's SQLite DateTime stores ("YYYY-MM-DD HH:MM:SS.ffffff"); Postgres parses it too
+                text_values = np.datetime_as_string(values, unit='us')
+                codes = text_values.view(np.uint32).reshape(len(values), -1).copy()
+                codes[:, 10] = ord(' ')
+                text_values = codes.view(text_values.dtype).ravel()
+                if utc and self.dialect == 'postgresql':
+                    text_values = np.char.add(text_values, '+00:00')
+                return text_values.tolist()
+            values = values.astype('datetime64[us]').tolist()
+            return [value.replace(tzinfo=timezone.utc) for value in values] if utc else values
+        return values.tolist()
+
+    def write(self, columns):
+        names = list(columns)
+        if not len(columns[names[0]]):
+            return 0
+        values = [self._values(name, np.asarray(columns[name])) for name in names]
+        rows = list(zip(*values))
+        with db.session_scope() as session:
+            if db.copy_rows(session, self.table.name, names, rows):
+                pass
+            elif self.dialect == 'sqlite':
+                session.connection().exec_driver_sql(
+                    f"INSERT INTO {self.table.name} ({', '.join(names)}) VALUES ({', '.join('?' * len(names))})", rows)
+            else:
+                session.execute(insert(self.table), [dict(zip(names, row)) for row in rows])
+        self.rows += len(rows)
+        return len(rows)
+
+
+def _existing_keys(session, column, keys):
+    """The keys already in the table, checked in chunks that fit a bound parameter list."""
+    found = set()
+    for start in range(0, len(keys), 5000):
+        found.update(session.scalars(select(column).where(column.in_(keys[start:start + 5000]))))
+    return found
+
+
+class deferred_indexes:
+    """Drops a table's secondary indexes for a bulk load and builds them again afterwards."""
+
+    def __init__(self, engine, *tables):
+        self.engine = engine
+        self.indexes = [index for table in tables for index in table.indexes]
+
+    def __enter__(self):
+        with self.engine.begin() as conn:
+            for index in self.indexes:
+                index.drop(conn, checkfirst=True)
+        return self
+
+    def __exit__(self, *exc):
+        with self.engine.begin() as conn:
+            for index in self.indexes:
+                index.create(conn, checkfirst=True)
+        return False
+
+
+def generate(engine, users=100_000, merchants=2_000, orders=1_000_000, days=365, seed=24, id_salt=0,
+             batch_size=BATCH_SIZE, defer_indexes=True, now=None, progress=print):
+    """Generate and load everything into engine's database (schema created if needed); returns row counts."""
+    db.bind_engine(engine)
+    db.ensure_schema(engine, Base.metadata)
+    rng = np.random.default_rng(seed)
+    # A stream of its own, so the salt changes the IDs and nothing else
+    id_rng = np.random.default_rng([seed, 1, id_salt])
+    now = now or datetime.now(SERVICE_TIMEZONE)
+    started = time.perf_counter()
+    counts = {}
+
+    def report(table, rows):
+        counts[table] = counts.get(table, 0) + rows
+        elapsed = time.perf_counter() - started
+        progress(f"{table}: {counts[table]:,} rows ({elapsed:.0f} s)")
+
+    user_columns, homes = generate_users(rng, users, now.replace(tzinfo=None), id_rng)
+    report('users', TableWriter(engine, User.__table__).write(user_columns))
+    with db.session_scope() as session:
+        first_merchant = (session.scalar(select(func.max(Merchant.id))) or 0) + 1
+    merchant_columns, merchant_towns = generate_merchants(rng, merchants, first_merchant)
+    report('merchants', TableWriter(engine, Merchant.__table__).write(merchant_columns))
+    with db.session_scope() as session:
+        # The ids were given explicitly, so the next merchant the app or an import inserts would reuse one
+        db.sync_id_sequence(session, Merchant.__tablename__)
+        # Bulk rows skip the ORM events, so tell the maps, catalog and spatial index by hand
+        bump_data_version(session, 'merchants')
+
+    geocodes = generate_geocodes(user_columns, homes, rng, now.replace(tzinfo=None))
+    with db.session_scope() as session:
+        known = _existing_keys(session, GeocodeCache.address, geocodes['address'].tolist())
+    if known:
+        keep = ~np.isin(geocodes['address'], list(known))
+        geocodes = {name: values[keep] for name, values in geocodes.items()}
+    report('geocode_cache', TableWriter(engine, GeocodeCache.__table__).write(geocodes))
+
+    customers = user_columns['type'] == 'customer'
+    _, partners = load_catalog_file()
+    subscriptions = generate_subscriptions(rng, user_columns['id'][customers], list(partners),
+                                           now.replace(tzinfo=None), id_rng)
+    if subscriptions is not None:
+        report('subscriptions', TableWriter(engine, Subscription.__table__).write(subscriptions))
+
+    if orders and customers.any() and merchants:
+        generator = OrderGenerator(
+            rng, orders, days, now,
+            customers=(user_columns['id'][customers], homes[0][customers], user_columns['address'][customers]),
+            drivers=user_columns['id'][user_columns['type'] == 'driver'],
+            merchants=merchant_columns, merchant_towns=merchant_towns, id_rng=id_rng)
+        order_writer = TableWriter(engine, Order.__table__)
+        event_writer = TableWriter(engine, OrderStatusChange.__table__)
+        tables = (Order.__table__, OrderStatusChange.__table__)
+        with deferred_indexes(engine, *tables) if defer_indexes else nullcontext():
+            for order_batch, event_batch in generator.batches(batch_size):
+                order_writer.write(order_batch)
+                event_writer.write(event_batch)
+                report('orders', len(order_batch['id']))
+            if defer_indexes:
+                progress("building indexes")
+        counts['order_events'] = event_writer.rows
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+    counts['seconds'] = round(time.perf_counter() - started, 1)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic users, merchants, orders, subscriptions and geocodes.")
+    parser.add_argument('--database-url', default=None, help="defaults to DATABASE_URL")
+    parser.add_argument('--users', type=int, default=100_000)
+    parser.add_argument('--merchants', type=int, default=2_000)
+    parser.add_argument('--orders', type=int, default=1_000_000)
+    parser.add_argument('--days', type=int, default=365, help="days of order history before today")
+    parser.add_argument('--seed', type=int, default=24)
+    parser.add_argument('--id-salt', type=int, default=0,
+                        help="vary the IDs (and emails) of a run that reuses a seed on the same database")
+    parser.add_argument('--now', type=datetime.fromisoformat, default=None,
+                        help=f"ISO time the data is relative to (default: the current time, {SERVICE_TIMEZONE.key} if no offset)")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--keep-indexes', action='store_true',
+                        help="load with the orders indexes in place instead of building them afterwards")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    url = args.database_url or os.getenv('DATABASE_URL')
+    if not url:
+        parser.error("no database: pass --database-url or set DATABASE_URL")
+    now = args.now
+    if now is not None:
+        now = now.replace(tzinfo=SERVICE_TIMEZONE) if now.tzinfo is None else now.astimezone(SERVICE_TIMEZONE)
+    engine = db.make_engine(url)
+    try:
+        counts = generate(engine, users=args.users, merchants=args.merchants, orders=args.orders, days=args.days,
+                          seed=args.seed, id_salt=args.id_salt, batch_size=args.batch_size,
+                          defer_indexes=not args.keep_indexes, now=now)
+    except IntegrityError as e:
+        sys.exit(f"Rows collide with an earlier run's (pass another --id-salt to add to it): {e.orig}")
+    print(json.dumps(counts))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""Engine setup, session lifecycle and connection pool metrics."""
+import csv
+import io
+import logging
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+logger = logging.getLogger(__name__)
+
+# Unbound until bind_engine() is called by the app (or a script / benchmark)
+Session = sessionmaker()
+
+# One session per thread; Streamlit runs every rerun of a browser session on its own script thread
+ScopedSession = scoped_session(Session)
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.checked_out = 0
+        self.peak_checked_out = 0
+
+    def on_connect(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def on_checkin(self, dbapi_connection, connection_record):
+        with self._lock:
+            self.checkins += 1
+            self.checked_out = max(self.checked_out - 1, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+            }
+
+
+_pool_metrics = {}
+
+
+def make_engine(url, **kwargs):
+    options = {'echo': False}
+    if not url.startswith('sqlite'):
+        options.update(pool_size=5, max_overflow=10, pool_timeout=30, pool_pre_ping=True)
+    options.update(kwargs)
+    engine = create_engine(url, **options)
+    metrics = PoolMetrics()
+    event.listen(engine, 'connect', metrics.on_connect)
+    event.listen(engine, 'checkout', metrics.on_checkout)
+    event.listen(engine, 'checkin', metrics.on_checkin)
+    _pool_metrics[engine] = metrics
+    return engine
+
+
+def ensure_schema(engine, metadata):
+    """create_all plus the additive migrations it skips: new nullable columns and indexes on existing tables.
+
+    Indexes named in metadata.info['superseded_indexes'] are dropped where they still exist.
+    """
+    metadata.create_all(engine, checkfirst=True)
+    existing = inspect(engine)
+    superseded = set(metadata.info.get('superseded_indexes', ()))
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            for index in existing.get_indexes(table.name):
+                if index['name'] in superseded:
+                    logger.info(f"Dropping index {index['name']}")
+                    conn.execute(text(f'DROP INDEX {index["name"]}'))
+            present = {column['name'] for column in existing.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in present:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    logger.info(f"Adding column {table.name}.{column.name}")
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def copy_rows(session, table_name, columns, rows):
+    """Bulk load rows with Postgres COPY through the session's connection; False on other databases."""
+    connection = session.connection()
+    if connection.dialect.name != 'postgresql':
+        return False
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(['\\N' if value is None else value for value in row])
+    buffer.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert(
+            f"COPY {table_name} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+    finally:
+        cursor.close()
+    return True
+
+
+def sync_id_sequence(session, table_name, column='id'):
+    """Move a Postgres serial column's sequence past rows loaded with explicit ids; a no-op elsewhere."""
+    if session.get_bind().dialect.name != 'postgresql':
+        return
+    session.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{table_name}', '{column}'), max({column})) FROM {table_name}"))
+
+
+def bind_engine(engine):
+    Session.configure(bind=engine)
+
+
+def pool_metrics(engine):
+    metrics = _pool_metrics.get(engine)
+    stats = metrics.snapshot() if metrics else {}
+    stats['pool_status'] = engine.pool.status()
+    return stats
+
+
+@contextmanager
+def session_scope():
+    """Unit of work for scripts and worker threads: commit on success, rollback on error."""
+    session = Session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+@contextmanager
+def rerun_scope():
+    """Session for a single Streamlit rerun; its connection goes back to the pool when the rerun ends."""
+    session = ScopedSession()
+    try:
+        yield session
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        ScopedSession.remove()
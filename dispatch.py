@@ -0,0 +1,99 @@
+"""Driver dispatch: rank pending orders for a driver (claims go through orders.claim_order).
+
+The pending orders are loaded once into arrays (pickup coordinates, scheduled time) and shared
+by every driver until an order is created or claimed. Ranking a driver is then a vectorized
+haversine over all candidates plus an argpartition for the top k, with no per-order Python loop.
+"""
+import os
+from dataclasses import dataclass
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select
+
+from lifecycle import PENDING
+from models import Merchant, Order
+from orders import order_cache
+from scheduling import slot_timestamp
+from spatial import haversine_matrix_km
+
+DISPATCH_MAX_ORDERS = int(os.getenv("DISPATCH_MAX_ORDERS", "20000"))
+# Average driving speed used to turn pickup distance into minutes
+DRIVER_SPEED_KMH = float(os.getenv("DRIVER_SPEED_KMH", "30"))
+# Minutes of travel a driver would trade for picking up an order one minute closer to its slot
+SLACK_WEIGHT = float(os.getenv("DISPATCH_SLACK_WEIGHT", "0.25"))
+# Slack beyond this counts the same, so among orders that aren't due soon the closest one wins
+SLACK_CAP_MINUTES = float(os.getenv("DISPATCH_SLACK_CAP_MINUTES", "120"))
+
+
+@dataclass(frozen=True)
+class RankedOrder:
+    order_id: str
+    pickup_km: float
+    minutes_to_slot: float
+    score: float
+
+
+class DispatchBoard:
+    def __init__(self, order_ids, pickup_lats, pickup_lons, scheduled):
+        self.order_ids = list(order_ids)
+        # Degrees; NaN where the order has no merchant to pick up from
+        self.pickup_lats = np.asarray(pickup_lats, dtype=np.float64)
+        self.pickup_lons = np.asarray(pickup_lons, dtype=np.float64)
+        self.scheduled = np.asarray([ts.timestamp() for ts in scheduled], dtype=np.float64)
+
+    @classmethod
+    def load(cls, session, limit=DISPATCH_MAX_ORDERS):
+        stmt = (
+            select(Order.id, Merchant.latitude, Merchant.longitude, Order.scheduled_at, Order.date, Order.time)
+            .outerjoin(Merchant, Order.merchant_id == Merchant.id)
+            .where(Order.status == PENDING)
+            .order_by(Order.scheduled_at)
+            .limit(limit)
+        )
+        rows = session.execute(stmt).all()
+        return cls(
+            [row.id for row in rows],
+            [np.nan if row.latitude is None else row.latitude for row in rows],
+            [np.nan if row.longitude is None else row.longitude for row in rows],
+            [row.scheduled_at or slot_timestamp(row.date, row.time) for row in rows],
+        )
+
+    def __len__(self):
+        return len(self.order_ids)
+
+    def scores(self, lat, lon, now):
+        """(score, pickup_km, minutes_to_slot) arrays for a driver at lat/lon; lower score is better.
+
+        Score is the drive to the pickup in minutes plus a penalty for the slack left after
+        getting there (capped at SLACK_CAP_MINUTES), so a nearby order due soon beats a nearby
+        order due tomorrow. Orders already past their slot carry no slack penalty.
+        """
+        pickup_km = haversine_matrix_km([lat], [lon], self.pickup_lats, self.pickup_lons)[0]
+        travel_minutes = pickup_km / DRIVER_SPEED_KMH * 60
+        minutes_to_slot = (self.scheduled - now.timestamp()) / 60
+        score = travel_minutes + SLACK_WEIGHT * np.clip(minutes_to_slot - travel_minutes, 0, SLACK_CAP_MINUTES)
+        # Orders without a pickup location rank after every order that has one
+        score = np.where(np.isnan(score), np.inf, score)
+        return score, pickup_km, minutes_to_slot
+
+    def rank(self, lat, lon, k=20, now=None, max_km=None):
+        """The driver's best k orders, best first."""
+        if not self.order_ids:
+            return []
+        score, pickup_km, minutes_to_slot = self.scores(lat, lon, now or datetime.now())
+        if max_km is not None:
+            score = np.where(pickup_km <= max_km, score, np.inf)
+        k = min(k, len(score))
+        top = np.argpartition(score, k - 1)[:k]
+        top = top[np.argsort(score[top], kind='stable')]
+        return [
+            RankedOrder(self.order_ids[i], float(pickup_km[i]), float(minutes_to_slot[i]), float(score[i]))
+            for i in top
+            if max_km is None or np.isfinite(score[i])
+        ]
+
+
+def cached_dispatch_board(session):
+    """The shared board; invalidated together with the pending-orders listing."""
+    return order_cache.get_or_load(('dispatch', PENDING), lambda: DispatchBoard.load(session))
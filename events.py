@@ -0,0 +1,237 @@
+"""Order status events: an in-process bus fed by one database listener per server process.
+
+Writers record status changes on their session with publish_order_event(). On Postgres the event
+travels as a NOTIFY in the writer's transaction, so it is delivered only if the transaction
+commits, and it reaches every server process's LISTEN thread. Other databases have no
+notifications, so one thread per process polls the order_events table instead, and a local commit
+wakes it right away. Browser sessions only compare in-memory topic versions and go to the
+database only when something they show has changed.
+"""
+import json
+import logging
+import os
+import select
+import threading
+from dataclasses import asdict, dataclass
+
+import sqlalchemy.orm
+from sqlalchemy import event, func, select as sql_select, text
+
+from models import Order, OrderStatusChange
+
+logger = logging.getLogger(__name__)
+
+NOTIFY_CHANNEL = 'order_events'
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", "0.5"))
+RECONNECT_SECONDS = 5
+
+
+@dataclass(frozen=True)
+class OrderEvent:
+    order_id: str
+    user_id: str
+    status: str
+    previous_status: str = None
+
+    def topics(self):
+        return (('user', self.user_id), ('status', self.status)) + (
+            (('status', self.previous_status),) if self.previous_status else ())
+
+
+class EventBus:
+    """Per-topic versions that watchers compare or wait on; subscribers are called on the publishing thread."""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._versions = {}
+        self._callbacks = []
+
+    def publish(self, order_event):
+        with self._condition:
+            self._sequence += 1
+            for topic in order_event.topics():
+                self._versions[topic] = self._sequence
+            callbacks = list(self._callbacks)
+            self._condition.notify_all()
+        for callback in callbacks:
+            try:
+                callback(order_event)
+            except Exception:
+                logger.exception("Order event subscriber failed")
+
+    def subscribe(self, callback):
+        with self._condition:
+            self._callbacks.append(callback)
+        return lambda: self._callbacks.remove(callback)
+
+    def version(self, *topics):
+        """Sequence number of the latest event on any of the topics (0 if none yet)."""
+        return max((self._versions.get(topic, 0) for topic in topics), default=0)
+
+    def wait(self, topics, after, timeout=None):
+        """Block until a topic moves past version `after`; returns the new version (or `after` on timeout)."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.version(*topics) > after, timeout)
+            return self.version(*topics)
+
+
+order_events = EventBus()
+
+
+def publish_order_event(session, order_id, user_id, status, previous_status=None, recorded=True):
+    """Record a status change in session's transaction; it is published once the transaction commits.
+
+    recorded=False is for changes with no order_events row (payment updates): a polling listener
+    can't see those, so without Postgres they reach this process's watchers only.
+    """
+    order_event = OrderEvent(order_id, user_id, status, previous_status)
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                        {'channel': NOTIFY_CHANNEL, 'payload': json.dumps(asdict(order_event))})
+    elif not recorded:
+        session.info.setdefault('local_order_events', []).append(order_event)
+        return
+    session.info.setdefault('order_events', []).append(order_event)
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_commit')
+def _after_commit(session):
+    for order_event in session.info.pop('local_order_events', ()):
+        order_events.publish(order_event)
+    pending = session.info.pop('order_events', None)
+    if not pending:
+        return
+    if _listener is None:
+        # No listener in this process (scripts, benchmarks): deliver to local subscribers only
+        for order_event in pending:
+            order_events.publish(order_event)
+    else:
+        _listener.wake()
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop('order_events', None)
+    session.info.pop('local_order_events', None)
+
+
+def _decode_order_event(payload):
+    return OrderEvent(**json.loads(payload))
+
+class PostgresListener(threading.Thread):
+    """Publishes every NOTIFY on channel to bus, decoded by decode(payload)."""
+
+    def __init__(self, engine, bus, channel=NOTIFY_CHANNEL, decode=_decode_order_event):
+        super().__init__(name=f'{channel}-listen', daemon=True)
+        self.engine = engine
+        self.bus = bus
+        self.channel = channel
+        self.decode = decode
+        self._stopping = threading.Event()
+
+    def wake(self):
+        pass  # NOTIFY arrives on its own
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception(f"{self.channel} listener lost its connection; reconnecting")
+                self._stopping.wait(RECONNECT_SECONDS)
+
+    def _listen(self):
+        connection = self.engine.raw_connection()
+        try:
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f"LISTEN {self.channel}")
+            while not self._stopping.is_set():
+                if select.select([dbapi_connection], [], [], 1.0) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    self.bus.publish(self.decode(notify.payload))
+        finally:
+            connection.invalidate()
+
+
+class PollingListener(threading.Thread):
+    """Publishes rows appended to order_events since the last poll.
+
+    Ids are a safe cursor here because SQLite serializes writers, so a lower id never becomes
+    visible after a higher one; Postgres, where that isn't true, uses LISTEN/NOTIFY instead.
+    """
+
+    def __init__(self, engine, bus, interval=EVENT_POLL_INTERVAL):
+        super().__init__(name='order-events-poll', daemon=True)
+        self.engine = engine
+        self.bus = bus
+        self.interval = interval
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        with engine.connect() as conn:
+            self._cursor = conn.execute(sql_select(func.max(OrderStatusChange.id))).scalar() or 0
+        self.polls = 0
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def run(self):
+        while not self._stopping.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Order event poll failed")
+                self._stopping.wait(RECONNECT_SECONDS)
+
+    def poll(self):
+        stmt = (
+            sql_select(OrderStatusChange.id, OrderStatusChange.order_id, Order.user_id,
+                       OrderStatusChange.to_status, OrderStatusChange.from_status)
+            .join(Order, Order.id == OrderStatusChange.order_id)
+            .where(OrderStatusChange.id > self._cursor)
+            .order_by(OrderStatusChange.id)
+        )
+        with self.engine.connect() as conn:
+            rows = conn.execute(stmt).all()
+        self.polls += 1
+        for change_id, order_id, user_id, status, previous_status in rows:
+            self._cursor = change_id
+            self.bus.publish(OrderEvent(order_id, user_id, status, previous_status))
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def start(engine, bus=order_events):
+    """Start this process's listener (idempotent); returns it."""
+    global _listener
+    with _listener_lock:
+        if _listener is None or not _listener.is_alive():
+            listener_class = PostgresListener if engine.dialect.name == 'postgresql' else PollingListener
+            _listener = listener_class(engine, bus)
+            _listener.start()
+        return _listener
+
+
+def stop():
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener.join(timeout=5)
+            _listener = None
@@ -0,0 +1,126 @@
+"""Two-tier geocode cache: normalized address keys, in-memory LRU over the geocode_cache table, negative caching."""
+import os
+import re
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import db
+from cache import TTLCache
+from models import GeocodeCache
+
+Location = namedtuple('Location', ['latitude', 'longitude'])
+
+GEOCODE_TTL = timedelta(days=int(os.getenv("GEOCODE_TTL_DAYS", "30")))
+# Addresses the geocoder couldn't resolve are retried after this long
+GEOCODE_NEGATIVE_TTL = timedelta(seconds=int(os.getenv("GEOCODE_NEGATIVE_TTL", "600")))
+GEOCODE_MEMORY_SIZE = int(os.getenv("GEOCODE_MEMORY_SIZE", "10000"))
+
+# USPS Publication 28 abbreviations for the suffixes, directionals and unit designators we see most
+USPS_ABBREVIATIONS = {
+    'alley': 'aly', 'avenue': 'ave', 'av': 'ave', 'boulevard': 'blvd', 'boul': 'blvd', 'circle': 'cir',
+    'court': 'ct', 'cove': 'cv', 'crossing': 'xing', 'drive': 'dr', 'expressway': 'expy', 'freeway': 'fwy',
+    'highway': 'hwy', 'lane': 'ln', 'parkway': 'pkwy', 'place': 'pl', 'plaza': 'plz', 'road': 'rd',
+    'route': 'rte', 'square': 'sq', 'street': 'st', 'str': 'st', 'terrace': 'ter', 'trail': 'trl',
+    'turnpike': 'tpke', 'north': 'n', 'south': 's', 'east': 'e', 'west': 'w', 'northeast': 'ne',
+    'northwest': 'nw', 'southeast': 'se', 'southwest': 'sw', 'apartment': 'apt', 'building': 'bldg',
+    'floor': 'fl', 'suite': 'ste', 'room': 'rm', 'maryland': 'md',
+}
+
+_TOKEN = re.compile(r"[a-z0-9#]+")
+
+# Returned by get(): a cached "no such address" result, or nothing cached at all
+NOT_FOUND = object()
+MISS = object()
+
+
+def normalize_address(address):
+    """Canonical cache key: case, punctuation and whitespace folded, USPS abbreviations applied per comma part."""
+    parts = []
+    for part in address.lower().split(','):
+        tokens = [USPS_ABBREVIATIONS.get(token, token) for token in _TOKEN.findall(part.replace('.', ''))]
+        if tokens:
+            parts.append(' '.join(tokens))
+    return ', '.join(parts)
+
+
+class TwoTierGeocodeCache:
+    def __init__(self, memory_size=GEOCODE_MEMORY_SIZE, ttl=GEOCODE_TTL, negative_ttl=GEOCODE_NEGATIVE_TTL,
+                 now=datetime.now):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._now = now
+        self._memory = TTLCache(maxsize=memory_size, ttl=ttl.total_seconds())
+        self._lock = threading.Lock()
+        self.db_hits = 0
+        self.db_misses = 0
+
+    key = staticmethod(normalize_address)
+
+    def get(self, address):
+        """Location, NOT_FOUND for a cached negative result, or MISS."""
+        key = normalize_address(address)
+        value = self._memory.get(key, MISS)
+        if value is not MISS:
+            return value
+        value, age = MISS, None
+        with db.session_scope() as session:
+            row = session.get(GeocodeCache, key)
+            if row:
+                age = self._now() - (row.updated_at or datetime.min)
+                value = self._from_row(row, age)
+        with self._lock:
+            if value is MISS:
+                self.db_misses += 1
+            else:
+                self.db_hits += 1
+        if value is not MISS:
+            self._remember(key, value, row_age=age)
+        return value
+
+    def put(self, address, location):
+        """Store a Location, or None for an address that couldn't be geocoded."""
+        key = normalize_address(address)
+        with db.session_scope() as session:
+            session.merge(GeocodeCache(
+                address=key,
+                latitude=location.latitude if location else None,
+                longitude=location.longitude if location else None,
+                updated_at=self._now()
+            ))
+        self._remember(key, location or NOT_FOUND)
+
+    def preload(self, session, limit=None):
+        """Bulk-load the freshest rows into memory; returns how many were loaded."""
+        query = session.query(GeocodeCache.address, GeocodeCache.latitude, GeocodeCache.longitude,
+                              GeocodeCache.updated_at).filter(
+            GeocodeCache.latitude.isnot(None), GeocodeCache.updated_at > self._now() - self.ttl
+        ).order_by(GeocodeCache.updated_at.desc()).limit(limit or self._memory.maxsize)
+        loaded = 0
+        for address, latitude, longitude, updated_at in query:
+            self._remember(normalize_address(address), Location(latitude, longitude),
+                           row_age=self._now() - updated_at)
+            loaded += 1
+        return loaded
+
+    def _from_row(self, row, age):
+        if row.latitude is None:
+            return NOT_FOUND if age < self.negative_ttl else MISS
+        return Location(row.latitude, row.longitude) if age < self.ttl else MISS
+
+    def _remember(self, key, value, row_age=timedelta(0)):
+        ttl = self.negative_ttl if value is NOT_FOUND else self.ttl
+        self._memory.set(key, value, ttl=max((ttl - row_age).total_seconds(), 0.0))
+
+    def stats(self):
+        memory = self._memory.stats()
+        lookups = memory['hits'] + memory['misses']
+        hits = memory['hits'] + self.db_hits
+        return {
+            'memory_size': memory['size'],
+            'memory_hits': memory['hits'],
+            'db_hits': self.db_hits,
+            'misses': self.db_misses,
+            'hit_ratio': hits / lookups if lookups else 0.0,
+        }
+
@@ -0,0 +1,174 @@
+"""Geocoding service: bounded worker pool, Nominatim rate limit, request coalescing in front of the geocode cache."""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from geopy.exc import GeocoderServiceError, GeocoderTimedOut
+from geopy.geocoders import Nominatim
+
+import instrumentation
+from geocode_cache import MISS, NOT_FOUND, Location, TwoTierGeocodeCache
+
+logger = logging.getLogger(__name__)
+
+# Nominatim's usage policy allows at most one request per second
+NOMINATIM_RATE = 1.0
+
+
+class GeocodingUnavailable(Exception):
+    """The upstream geocoder failed (timeouts, errors); unlike a lookup that found nothing, it isn't cached."""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Reserve a token (possibly going negative) under the lock, then wait outside it
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            self._sleep(wait)
+
+
+class GeocodingService:
+    def __init__(self, geocoder=None, max_workers=4, rate=NOMINATIM_RATE, max_retries=3, backoff=1.0, cache=None):
+        self._geocoder = geocoder
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='geocode')
+        self._limiter = TokenBucket(rate)
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self.cache = cache or TwoTierGeocodeCache()
+        self._inflight = {}  # normalized address -> Future, so concurrent requests share one lookup
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+
+    @property
+    def geocoder(self):
+        if self._geocoder is None:
+            self._geocoder = Nominatim(user_agent="local_butler_app", timeout=5)
+        return self._geocoder
+
+    def cached(self, address):
+        """Cache-only lookup on the caller's thread: a Location, NOT_FOUND or MISS."""
+        try:
+            return self.cache.get(address)
+        except Exception as e:
+            logger.error(f"Geocode cache error: {e}")
+            return MISS
+
+    def submit(self, address):
+        """Future resolving to a Location, or None when the address can't be geocoded.
+
+        The future raises GeocodingUnavailable when the upstream geocoder failed; the next request retries.
+        """
+        key = self.cache.key(address)
+        with self._lock:
+            self.requests += 1
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._executor.submit(self._resolve, address)
+            self._inflight[key] = future
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future
+
+    def geocode(self, address, timeout=None):
+        return self.submit(address).result(timeout)
+
+    def poll(self, address):
+        """Non-blocking: the Location if cached or already resolved, otherwise None while the lookup runs."""
+        cached = self.cached(address)
+        if cached is NOT_FOUND:
+            return None
+        if cached is not MISS:
+            return cached
+        return _settled(self.submit(address))
+
+    def poll_many(self, addresses):
+        """poll() for many addresses at once, every lookup queued before any is read: {address: Location or None}."""
+        results, futures = {}, {}
+        for address in dict.fromkeys(addresses):
+            cached = self.cached(address)
+            if cached is MISS:
+                futures[address] = self.submit(address)
+            else:
+                results[address] = None if cached is NOT_FOUND else cached
+        for address, future in futures.items():
+            results[address] = _settled(future)
+        return results
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def _resolve(self, address):
+        cached = self.cached(address)
+        if cached is NOT_FOUND:
+            return None
+        if cached is not MISS:
+            return cached
+        location = self._geocode_upstream(address)
+        try:
+            # Failures are cached too (with the short negative TTL) so bad addresses don't hammer Nominatim
+            self.cache.put(address, location)
+        except Exception as e:
+            logger.error(f"Geocode cache write error: {e}")
+        return location
+
+    def _geocode_upstream(self, address):
+        for attempt in range(self._max_retries):
+            if attempt:
+                # Back off only after a failure; the first attempt goes out as soon as the rate limit allows
+                time.sleep(self._backoff * (2 ** (attempt - 1)))
+            self._limiter.acquire()
+            with self._lock:
+                self.upstream_calls += 1
+            try:
+                with instrumentation.span("nominatim geocode"):
+                    result = self.geocoder.geocode(address)
+            except (GeocoderTimedOut, GeocoderServiceError) as e:
+                logger.warning(f"Geocoding attempt {attempt + 1} failed for {address}: {e}")
+                continue
+            except Exception as e:
+                logger.error(f"Geocoding error: {e}")
+                raise GeocodingUnavailable(str(e)) from e
+            return Location(result.latitude, result.longitude) if result else None
+        raise GeocodingUnavailable(f"no answer for {address} after {self._max_retries} attempts")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _settled(future):
+    """A finished lookup's Location; None while it runs, when nothing was found or when the upstream failed."""
+    if not future.done() or future.exception() is not None:
+        return None
+    return future.result()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_geocoding_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = GeocodingService()
+        return _service
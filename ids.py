@@ -0,0 +1,86 @@
+"""Collision-free, time-ordered IDs for orders and subscriptions.
+
+The default generator produces ULIDs: a 48-bit millisecond timestamp followed by 80 random bits,
+Crockford base32 encoded (26 characters). Within a process IDs are strictly increasing (the random
+part is incremented when the clock hasn't moved), across processes 80 random bits per millisecond
+make collisions practically impossible without any coordination, and because new keys sort after
+old ones they append to the right edge of the primary key index instead of splitting random pages.
+"""
+import os
+import threading
+import time
+import uuid
+
+_CROCKFORD = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+_RANDOM_BITS = 80
+_RANDOM_MASK = (1 << _RANDOM_BITS) - 1
+
+
+def encode_crockford(value, length):
+    chars = []
+    for _ in range(length):
+        value, digit = divmod(value, 32)
+        chars.append(_CROCKFORD[digit])
+    return ''.join(reversed(chars))
+
+
+class UlidGenerator:
+    def __init__(self, clock=time.time_ns, randbits=None):
+        self._clock = clock
+        self._randbits = randbits or (lambda bits: int.from_bytes(os.urandom(bits // 8), 'big'))
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._last_random = 0
+        if hasattr(os, 'register_at_fork'):
+            # A forked child must not continue the parent's sequence within the same millisecond
+            os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._last_ms = -1
+
+    def __call__(self):
+        with self._lock:
+            now_ms = self._clock() // 1_000_000
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._last_random = self._randbits(_RANDOM_BITS)
+            else:
+                # Same millisecond, or the clock stepped back: keep the last timestamp and count up
+                self._last_random = (self._last_random + 1) & _RANDOM_MASK
+                if self._last_random == 0:
+                    self._last_ms += 1
+            return encode_crockford((self._last_ms << _RANDOM_BITS) | self._last_random, 26)
+
+
+class Uuid4Generator:
+    """Random, unordered; only for deployments that can't use time-ordered keys."""
+
+    def __call__(self):
+        return uuid.uuid4().hex.upper()
+
+
+GENERATORS = {
+    'ulid': UlidGenerator,
+    'uuid4': Uuid4Generator,
+}
+
+_generator = GENERATORS[os.getenv('ID_GENERATOR', 'ulid')]()
+
+
+def set_id_generator(generator):
+    """Swap the generator (any zero-argument callable returning a unique string)."""
+    global _generator
+    _generator = generator
+
+
+def new_id(prefix):
+    return f"{prefix}-{_generator()}"
+
+
+def new_order_id():
+    return new_id('ORD')
+
+
+def new_subscription_id():
+    return new_id('SUB')
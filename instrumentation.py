@@ -0,0 +1,421 @@
+"""Per-rerun instrumentation: SQL statement counts and timings, named spans, and their export.
+
+Off unless INSTRUMENTATION=1. When off nothing is attached to the engine, and span() and rerun()
+return a shared no-op context manager. When on:
+
+- before/after_cursor_execute listeners time every statement the engine runs;
+- rerun() gathers the statements and spans of one Streamlit rerun (all on its script thread) and
+  logs them as one JSON line on this module's logger, at WARNING past SLOW_RERUN_SECONDS;
+- all of it, including work on worker threads such as geocoding and Stripe calls, goes into
+  process-wide counters and histograms. These are served in the Prometheus text format on
+  METRICS_PORT and/or written to METRICS_FILE for node_exporter's textfile collector.
+"""
+import bisect
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sqlalchemy import event
+
+import db
+
+logger = logging.getLogger(__name__)
+
+INSTRUMENTATION = os.getenv("INSTRUMENTATION", "0") == "1"
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0: no endpoint
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_FILE_SECONDS = float(os.getenv("METRICS_FILE_SECONDS", "15"))
+SLOW_RERUN_SECONDS = float(os.getenv("SLOW_RERUN_SECONDS", "1.0"))
+# Prometheus' default latency buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Slowest statements kept per rerun for the log line and the debug panel
+SLOWEST_KEPT = 5
+# Statements outside a rerun: worker threads, fragments, bootstrap
+BACKGROUND = 'background'
+
+_NOOP = nullcontext()
+_enabled = INSTRUMENTATION
+_local = threading.local()
+
+
+def is_enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    items = (*labels, *extra.items())
+    return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in items) + '}' if items else ''
+
+
+class Registry:
+    """Process-wide counters and histograms, keyed by (metric, labels) with labels as ((name, value), ...)."""
+
+    HELP = {
+        'localbutler_rerun_seconds': ('histogram', "Wall time of a Streamlit rerun of main()."),
+        'localbutler_rerun_sql_statements_total': ('counter', "SQL statements run by reruns."),
+        'localbutler_sql_seconds': ('histogram', "Time per SQL statement, by rerun page or background."),
+        'localbutler_span_seconds': ('histogram', "Time spent in an instrumented span."),
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._collectors = []
+
+    def observe(self, metric, labels, value):
+        key = (metric, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def observe_many(self, metric, labels, values):
+        key = (metric, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            for value in values:
+                histogram.observe(value)
+
+    def inc(self, metric, labels, amount=1):
+        key = (metric, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def add_collector(self, collect):
+        """collect() -> [(metric, labels, value)] of gauges read at export time."""
+        self._collectors.append(collect)
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        with self._lock:
+            histograms = {key: (list(h.counts), h.sum) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+        gauges = []
+        for collect in self._collectors:
+            try:
+                gauges.extend(collect())
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e}")
+        lines, described = [], set()
+
+        def describe(metric, kind):
+            if metric not in described:
+                described.add(metric)
+                kind, text = self.HELP.get(metric, (kind, None))
+                if text:
+                    lines.append(f"# HELP {metric} {text}")
+                lines.append(f"# TYPE {metric} {kind}")
+
+        for (metric, labels), (counts, total) in sorted(histograms.items()):
+            describe(metric, 'histogram')
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, '+Inf'), counts):
+                cumulative += count
+                lines.append(f"{metric}_bucket{_labels(labels, le=bound)} {cumulative}")
+            lines.append(f"{metric}_sum{_labels(labels)} {total}")
+            lines.append(f"{metric}_count{_labels(labels)} {cumulative}")
+        for (metric, labels), value in sorted(counters.items()):
+            describe(metric, 'counter')
+            lines.append(f"{metric}{_labels(labels)} {value}")
+        for metric, labels, value in sorted(gauges):
+            describe(metric, 'gauge')
+            lines.append(f"{metric}{_labels(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+class RerunStats:
+    """What one rerun spent: wall time, SQL statements and named spans."""
+
+    def __init__(self, label=None):
+        self.label = label
+        self.started = time.perf_counter()
+        self.seconds = None
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.sql_durations = []
+        self.spans = {}  # name -> [count, seconds]
+        self.span_durations = []  # (name, seconds)
+        self._slowest = []  # min-heap of (seconds, statement)
+
+    @property
+    def page(self):
+        return self.label or 'unknown'
+
+    def add_statement(self, statement, seconds):
+        self.queries += 1
+        self.sql_seconds += seconds
+        self.sql_durations.append(seconds)
+        if len(self._slowest) < SLOWEST_KEPT:
+            heapq.heappush(self._slowest, (seconds, statement))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, statement))
+
+    def add_span(self, name, seconds):
+        self.span_durations.append((name, seconds))
+        totals = self.spans.get(name)
+        if totals is None:
+            self.spans[name] = [1, seconds]
+        else:
+            totals[0] += 1
+            totals[1] += seconds
+
+    def slowest(self):
+        """[(seconds, statement)], slowest first."""
+        return sorted(self._slowest, reverse=True)
+
+    def elapsed(self):
+        return self.seconds if self.seconds is not None else time.perf_counter() - self.started
+
+    def summary(self):
+        return {
+            'event': 'rerun',
+            'page': self.page,
+            'ms': round(self.elapsed() * 1000, 1),
+            'queries': self.queries,
+            'sql_ms': round(self.sql_seconds * 1000, 1),
+            'spans': {name: {'count': count, 'ms': round(seconds * 1000, 1)}
+                      for name, (count, seconds) in self.spans.items()},
+            'slowest_sql': [{'ms': round(seconds * 1000, 1), 'sql': ' '.join(statement.split())[:200]}
+                            for seconds, statement in self.slowest()],
+        }
+
+
+def current_rerun():
+    """The RerunStats being gathered on this thread, or None."""
+    return getattr(_local, 'rerun', None)
+
+
+class _Rerun:
+    def __init__(self, label):
+        self._label = label
+
+    def __enter__(self):
+        self.previous = current_rerun()
+        self.stats = RerunStats()
+        _local.rerun = self.stats
+        return self.stats
+
+    def __exit__(self, *exc):
+        stats = self.stats
+        _local.rerun = self.previous
+        stats.seconds = time.perf_counter() - stats.started
+        try:
+            stats.label = self._label() if callable(self._label) else self._label
+        except Exception:
+            pass
+        labels = (('page', stats.page),)
+        registry.observe('localbutler_rerun_seconds', labels, stats.seconds)
+        registry.inc('localbutler_rerun_sql_statements_total', labels, stats.queries)
+        # Held until now because the page is only known at the end of the rerun; one lock for the lot
+        registry.observe_many('localbutler_sql_seconds', labels, stats.sql_durations)
+        for name in stats.spans:
+            registry.observe_many('localbutler_span_seconds', (('span', name),),
+                                  [seconds for span_name, seconds in stats.span_durations if span_name == name])
+        level = logging.WARNING if stats.seconds >= SLOW_RERUN_SECONDS else logging.INFO
+        if logger.isEnabledFor(level):
+            logger.log(level, json.dumps(stats.summary(), ensure_ascii=False))
+        return False
+
+
+def rerun(label=None):
+    """Gathers one rerun's statements and spans; as-target is its RerunStats, or None when disabled.
+
+    label is the page name, or a callable returning it when the rerun ends (a rerun can switch pages).
+    """
+    return _Rerun(label) if _enabled else _NOOP
+
+
+class _Span:
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.started
+        stats = current_rerun()
+        if stats is not None:
+            stats.add_span(self.name, elapsed)
+        else:
+            registry.observe('localbutler_span_seconds', (('span', self.name),), elapsed)
+        return False
+
+
+def span(name):
+    """Times the enclosed block under name, in the current rerun (if any) and in the process metrics."""
+    return _Span(name) if _enabled else _NOOP
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._instrumentation_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_instrumentation_started', None)
+    if started is None:
+        return  # instrumented while the statement was running
+    elapsed = time.perf_counter() - started
+    stats = current_rerun()
+    if stats is not None:
+        stats.add_statement(statement, elapsed)
+    else:
+        registry.observe('localbutler_sql_seconds', (('page', BACKGROUND),), elapsed)
+
+
+_instrumented = set()
+_instrumented_lock = threading.Lock()
+
+
+def instrument(engine):
+    """Attach the statement timers to engine when instrumentation is enabled; safe to call repeatedly."""
+    if not _enabled:
+        return False
+    with _instrumented_lock:
+        if engine in _instrumented:
+            return True
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        _instrumented.add(engine)
+    return True
+
+
+def uninstrument(engine):
+    with _instrumented_lock:
+        if engine not in _instrumented:
+            return
+        event.remove(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.remove(engine, 'after_cursor_execute', _after_cursor_execute)
+        _instrumented.discard(engine)
+
+
+def _pool_gauges():
+    gauges = []
+    for engine in list(_instrumented):
+        stats = db.pool_metrics(engine)
+        labels = (('database', engine.url.database or engine.url.host or ''),)
+        gauges.extend((f"localbutler_db_pool_{name}", labels, stats[name])
+                      for name in ('connects', 'checkouts', 'checked_out', 'peak_checked_out') if name in stats)
+    return gauges
+
+
+registry.add_collector(_pool_gauges)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def write_metrics_file(path=None):
+    """Replace path with the current metrics in one rename, so a collector never reads half a file."""
+    path = path or METRICS_FILE
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, 'w', encoding='utf-8') as f:
+        f.write(registry.render())
+    os.replace(temporary, path)
+
+
+class MetricsFileWriter(threading.Thread):
+    def __init__(self, path=None, interval=METRICS_FILE_SECONDS):
+        super().__init__(name='metrics-file', daemon=True)
+        self.path = path or METRICS_FILE
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                write_metrics_file(self.path)
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {self.path}: {e}")
+
+
+_metrics_server = None
+_file_writer = None
+_workers_lock = threading.Lock()
+
+
+def start():
+    """Start this process's metrics exporters, if instrumentation is on and any are configured."""
+    global _metrics_server, _file_writer
+    if not _enabled:
+        return
+    with _workers_lock:
+        if METRICS_PORT and _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer(('', METRICS_PORT), MetricsHandler)
+            except OSError as e:
+                # Another server process on this host already serves the endpoint
+                logger.info(f"Metrics endpoint not started here: {e}")
+            else:
+                threading.Thread(target=_metrics_server.serve_forever, name='metrics', daemon=True).start()
+        if METRICS_FILE and (_file_writer is None or not _file_writer.is_alive()):
+            _file_writer = MetricsFileWriter()
+            _file_writer.start()
+
+
+def stop():
+    global _metrics_server, _file_writer
+    with _workers_lock:
+        if _metrics_server is not None:
+            _metrics_server.shutdown()
+            _metrics_server.server_close()
+            _metrics_server = None
+        if _file_writer is not None:
+            _file_writer.stop()
+            _file_writer = None
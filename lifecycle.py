@@ -0,0 +1,118 @@
+"""Order lifecycle: the allowed status transitions, applied with compare-and-set and recorded in order_events."""
+from sqlalchemy import exists, insert, select, update
+
+from events import publish_order_event
+from models import Order, OrderStatusChange
+
+PENDING = 'Pending'
+PREPARING = 'Preparing'
+ON_THE_WAY = 'On the way'
+DELIVERED = 'Delivered'
+CANCELLED = 'Cancelled'
+
+# The tracker's happy path, in order
+PROGRESS_STATUSES = (PENDING, PREPARING, ON_THE_WAY, DELIVERED)
+STATUSES = PROGRESS_STATUSES + (CANCELLED,)
+ACTIVE_STATUSES = (PENDING, PREPARING, ON_THE_WAY)
+
+TRANSITIONS = {
+    PENDING: (PREPARING, CANCELLED),
+    PREPARING: (ON_THE_WAY, CANCELLED),
+    ON_THE_WAY: (DELIVERED,),
+    DELIVERED: (),
+    CANCELLED: (),
+}
+
+# A concurrent writer can only move an order forward a few times, so a few CAS attempts always settle
+CAS_ATTEMPTS = 3
+
+
+class OrderNotFound(LookupError):
+    pass
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+class StatusConflict(Exception):
+    """The order's status changed underneath the caller (another driver or tab got there first)."""
+
+
+def next_statuses(status):
+    return TRANSITIONS.get(status, ())
+
+
+def transition(session, order_id, to_status, actor_id=None, expected=None, values=None):
+    """Move an order to to_status in the caller's transaction and return the status it had.
+
+    The UPDATE only applies if the status is still the one that was validated, so two concurrent
+    transitions of one order can't both succeed. With `expected`, the order must be in exactly
+    that status (StatusConflict otherwise). The caller commits or rolls back.
+    """
+    if to_status not in TRANSITIONS:
+        raise InvalidTransition(f"Unknown status {to_status!r}")
+    for _ in range(CAS_ATTEMPTS):
+        row = session.execute(select(Order.status, Order.user_id).where(Order.id == order_id)).first()
+        if row is None:
+            raise OrderNotFound(order_id)
+        if expected is not None and row.status != expected:
+            raise StatusConflict(f"Order {order_id} is {row.status}, not {expected}")
+        if to_status not in next_statuses(row.status):
+            raise InvalidTransition(f"Order {order_id} can't go from {row.status} to {to_status}")
+        result = session.execute(
+            update(Order)
+            .where(Order.id == order_id, Order.status == row.status)
+            .values(status=to_status, **(values or {}))
+            .execution_options(synchronize_session='fetch')
+        )
+        if result.rowcount == 1:
+            break
+    else:
+        raise StatusConflict(f"Order {order_id} kept changing status")
+    session.add(OrderStatusChange(order_id=order_id, from_status=row.status, to_status=to_status, actor_id=actor_id))
+    publish_order_event(session, order_id, row.user_id, to_status, row.status)
+    return row.status
+
+
+def record_created(session, order_id, user_id, actor_id=None):
+    session.add(OrderStatusChange(order_id=order_id, from_status=None, to_status=PENDING, actor_id=actor_id))
+    publish_order_event(session, order_id, user_id, PENDING)
+
+
+def current_status(session, order_id):
+    """Status according to the history (one index probe for the latest change)."""
+    return session.execute(
+        select(OrderStatusChange.to_status)
+        .where(OrderStatusChange.order_id == order_id)
+        .order_by(OrderStatusChange.id.desc())
+        .limit(1)
+    ).scalar()
+
+
+def status_histories(session, order_ids):
+    """{order_id: [(from_status, to_status, created_at), ...]} oldest first, in one query."""
+    histories = {order_id: [] for order_id in order_ids}
+    if not order_ids:
+        return histories
+    stmt = (
+        select(OrderStatusChange.order_id, OrderStatusChange.from_status, OrderStatusChange.to_status,
+               OrderStatusChange.created_at)
+        .where(OrderStatusChange.order_id.in_(order_ids))
+        .order_by(OrderStatusChange.order_id, OrderStatusChange.id)
+    )
+    for order_id, from_status, to_status, created_at in session.execute(stmt):
+        histories[order_id].append((from_status, to_status, created_at))
+    return histories
+
+
+def backfill_status_history(session):
+    """Give orders from before order_events existed a creation entry at their current status."""
+    result = session.execute(
+        insert(OrderStatusChange).from_select(
+            ['order_id', 'to_status', 'created_at'],
+            select(Order.id, Order.status, Order.date).where(
+                ~exists().where(OrderStatusChange.order_id == Order.id))
+        )
+    )
+    return result.rowcount
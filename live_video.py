@@ -0,0 +1,166 @@
+"""LIVE SHOP frame pipeline: a text overlay drawn in place on the decoded frame, within a per-frame time budget.
+
+The label is rendered once into a small mask. Each frame then only touches the pixels under that
+mask, written straight into the frame's planes (Y, U and V for the yuv420p frames WebRTC delivers),
+so there is no copy out to a BGR array and back. When the callback runs over its share of the
+frame interval, the pipeline first sends the previous labelled frame again in place of every other
+frame (so the label never flickers) and then halves the output resolution, and steps back once it
+is comfortably within budget again.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import av
+import cv2
+import numpy as np
+
+LIVE_VIDEO_FPS = 15
+# Part of the frame interval the callback may use; decoding and encoding need the rest
+LIVE_VIDEO_BUDGET_SHARE = float(os.getenv("LIVE_VIDEO_BUDGET_SHARE", "0.25"))
+LIVE_VIDEO_ADAPT = os.getenv("LIVE_VIDEO_ADAPT", "1") == "1"
+
+# Adaptation levels
+FULL, SKIP_ALTERNATE, HALF_RESOLUTION = 0, 1, 2
+LEVEL_NAMES = ('full', 'skip alternate frames', 'half resolution')
+
+
+def _plane_array(plane, channels=1):
+    """Writable (height, width[, channels]) view of a frame plane, without its row padding."""
+    rows = np.frombuffer(plane, np.uint8).reshape(plane.height, plane.line_size)
+    view = rows[:, :plane.width * channels]
+    return view.reshape(plane.height, plane.width, channels) if channels > 1 else view
+
+
+def _yuv_color(bgr):
+    # Converted by the same code path as the frames themselves, so the label keeps its colour exactly
+    patch = av.VideoFrame.from_ndarray(np.full((2, 2, 3), bgr, np.uint8), format='bgr24').reformat(format='yuv420p')
+    return tuple(int(_plane_array(plane)[0, 0]) for plane in patch.planes)
+
+
+def _with_timing(converted, frame):
+    converted.pts = frame.pts
+    if frame.time_base is not None:
+        converted.time_base = frame.time_base
+    return converted
+
+
+class TextOverlay:
+    """A label pre-rendered into a mask; apply() draws it onto a frame in place."""
+
+    def __init__(self, text, origin=(10, 30), color=(0, 255, 0), font_scale=0.7, thickness=2,
+                 font=cv2.FONT_HERSHEY_SIMPLEX):
+        (width, height), baseline = cv2.getTextSize(text, font, font_scale, thickness)
+        # Box around the glyphs, grown to even coordinates so it maps exactly onto the 2x2 chroma grid
+        left = max(origin[0] - thickness, 0) & ~1
+        top = max(origin[1] - height - thickness, 0) & ~1
+        right = (origin[0] + width + thickness + 1) & ~1
+        bottom = (origin[1] + baseline + thickness + 1) & ~1
+        canvas = np.zeros((bottom - top, right - left), np.uint8)
+        cv2.putText(canvas, text, (origin[0] - left, origin[1] - top), font, font_scale, 255, thickness)
+        self.text = text
+        self.left, self.top = left, top
+        self.mask = canvas > 0
+        # A chroma sample covers 2x2 pixels; colour it if any of them is part of the label
+        self.chroma_mask = self.mask.reshape(self.mask.shape[0] // 2, 2, self.mask.shape[1] // 2, 2).any(axis=(1, 3))
+        self.bgr = np.array(color, np.uint8)
+        self.yuv = _yuv_color(color)
+
+    def _draw(self, image, mask, left, top, value):
+        height = min(mask.shape[0], image.shape[0] - top)
+        width = min(mask.shape[1], image.shape[1] - left)
+        if height > 0 and width > 0:
+            np.copyto(image[top:top + height, left:left + width], value, where=mask[:height, :width, ...])
+
+    def apply(self, frame):
+        """Draw onto frame and return the frame to send (the same object unless it had to be converted)."""
+        if frame.format.name == 'yuv420p':
+            # The decoder may still reference this buffer; make_writable copies it only in that case
+            frame.make_writable()
+            luma, u, v = (_plane_array(plane) for plane in frame.planes)
+            self._draw(luma, self.mask, self.left, self.top, self.yuv[0])
+            self._draw(u, self.chroma_mask, self.left // 2, self.top // 2, self.yuv[1])
+            self._draw(v, self.chroma_mask, self.left // 2, self.top // 2, self.yuv[2])
+            return frame
+        if frame.format.name == 'bgr24':
+            frame.make_writable()
+            image = _plane_array(frame.planes[0], channels=3)
+        else:
+            image = frame.to_ndarray(format='bgr24')
+        self._draw(image, self.mask[..., None], self.left, self.top, self.bgr)
+        if frame.format.name == 'bgr24':
+            return frame
+        return _with_timing(av.VideoFrame.from_numpy_buffer(image, format='bgr24'), frame)
+
+
+class FramePipeline:
+    """video_frame_callback for webrtc_streamer: overlay, adaptation and per-frame timings."""
+
+    def __init__(self, overlay, fps=LIVE_VIDEO_FPS, budget_share=LIVE_VIDEO_BUDGET_SHARE, adapt=LIVE_VIDEO_ADAPT,
+                 window=300, settle_frames=None):
+        self.overlay = overlay
+        self.budget = budget_share / fps
+        self.adapt = adapt
+        # Frames between level changes, so the average reflects the current level before the next decision
+        self.settle_frames = settle_frames or 2 * fps
+        self.level = FULL
+        self._durations = deque(maxlen=window)
+        self._average = 0.0
+        self._since_change = 0
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.skipped = 0
+        self._last = None  # the last frame sent with the overlay
+
+    def __call__(self, frame):
+        started = time.perf_counter()
+        if self.level >= HALF_RESOLUTION:
+            out = _with_timing(frame.reformat(width=frame.width // 2 & ~1, height=frame.height // 2 & ~1), frame)
+        else:
+            out = frame
+        last = self._last
+        skip = (self.level >= SKIP_ALTERNATE and self.frames % 2 and last is not None
+                and (last.width, last.height) == (out.width, out.height))
+        if skip:
+            # Shown for two frame intervals, rather than a frame without the label in between
+            out = _with_timing(last, frame)
+        else:
+            out = self._last = self.overlay.apply(out)
+        self._record(time.perf_counter() - started, skip)
+        return out
+
+    def _record(self, elapsed, skipped):
+        with self._lock:
+            self.frames += 1
+            self.skipped += bool(skipped)
+            self._durations.append(elapsed)
+            self._average = elapsed if self.frames == 1 else 0.9 * self._average + 0.1 * elapsed
+            self._since_change += 1
+            if not self.adapt or self._since_change < self.settle_frames:
+                return
+            if self._average > self.budget and self.level < HALF_RESOLUTION:
+                self.level += 1
+                self._since_change = 0
+            elif self._average < self.budget / 4 and self.level > FULL:
+                self.level -= 1
+                self._since_change = 0
+
+    def stats(self):
+        with self._lock:
+            durations = np.array(self._durations) * 1000
+            frames, skipped, level, average = self.frames, self.skipped, self.level, self._average
+        return {
+            'frames': frames,
+            'skipped': skipped,
+            'level': LEVEL_NAMES[level],
+            'avg_ms': average * 1000,
+            'p50_ms': float(np.percentile(durations, 50)) if len(durations) else 0.0,
+            'p95_ms': float(np.percentile(durations, 95)) if len(durations) else 0.0,
+            'max_ms': float(durations.max()) if len(durations) else 0.0,
+            'budget_ms': self.budget * 1000,
+        }
+
+
+def label_pipeline(text, **options):
+    return FramePipeline(TextOverlay(text), **options)
@@ -0,0 +1,107 @@
+"""Map rendering: merchant maps cached per merchant-set version and clustered for large sets, plus driver runs."""
+import html
+import os
+
+import folium
+from folium.plugins import FastMarkerCluster
+
+from cache import TTLCache
+from models import Merchant, get_data_version
+from spatial import geohash_cell_center, geohash_encode, merchant_index
+
+MAP_CENTER = [39.1054, -76.7285]
+# Above this many merchants markers are clustered and drawn in the browser instead of one Marker each
+MAP_CLUSTER_THRESHOLD = int(os.getenv("MAP_CLUSTER_THRESHOLD", "100"))
+# Maps around an address show at most this many of the nearest merchants
+MAP_NEARBY_LIMIT = 500
+# Geohash precision of the area a map around an address is shared by (6: about 1.2 x 0.6 km)
+MAP_AREA_PRECISION = 6
+
+# Keyed on (service_type, merchants version, area); LRU keeps the number of rendered maps bounded
+map_html_cache = TTLCache(maxsize=32, ttl=24 * 3600)
+# Route maps only help the driver who re-plans the same run, so they get a small cache of their own
+# instead of evicting the merchant maps warmed at startup
+route_map_cache = TTLCache(maxsize=8, ttl=600)
+
+_CLUSTER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(
+        "<b>" + row[2] + "</b><br>Type: " + row[3] +
+        "<br>Website: <a href='" + row[4] + "' target='_blank'>Visit</a>",
+        {maxWidth: 300}
+    );
+    return marker;
+}
+"""
+
+
+def build_map_html(merchants, cluster_threshold=None, center=None):
+    """Render (name, type, latitude, longitude, website) rows to standalone map HTML."""
+    if cluster_threshold is None:
+        cluster_threshold = MAP_CLUSTER_THRESHOLD
+    m = folium.Map(location=center or MAP_CENTER, zoom_start=13 if center else 12)
+    if len(merchants) > cluster_threshold:
+        data = [
+            [lat, lon, html.escape(name), html.escape(type_), html.escape(website or '', quote=True)]
+            for name, type_, lat, lon, website in merchants
+        ]
+        FastMarkerCluster(data, callback=_CLUSTER_CALLBACK).add_to(m)
+    else:
+        for name, type_, lat, lon, website in merchants:
+            popup_html = f"""
+            <b>{html.escape(name)}</b><br>
+            Type: {html.escape(type_)}<br>
+            Website: <a href='{html.escape(website or '', quote=True)}' target='_blank'>Visit</a>
+            """
+            folium.Marker([lat, lon], popup=folium.Popup(popup_html, max_width=300)).add_to(m)
+    return m.get_root().render()
+
+
+def get_map_html(cache_key, load_merchants, center=None):
+    """Cached map HTML for a merchant set; load_merchants() is only called on a miss."""
+    def render():
+        merchants = load_merchants()
+        return build_map_html(merchants, center=center) if merchants else None
+    return map_html_cache.get_or_load(cache_key, render)
+
+
+def merchant_map_html(session, service_type=None, near=None):
+    """Map of merchants (optionally of one type, optionally nearest to a location); None if there are none."""
+    # Maps around an address are shared by everyone in the same ~1 km geohash cell, so they are built
+    # around the cell's center: the cached HTML must not give away the address of whoever asked first
+    area = geohash_encode(near.latitude, near.longitude, MAP_AREA_PRECISION) if near else None
+    center = list(geohash_cell_center(near.latitude, near.longitude, MAP_AREA_PRECISION)) if near else None
+
+    def load_merchants():
+        query = session.query(Merchant.name, Merchant.type, Merchant.latitude, Merchant.longitude, Merchant.website)
+        if service_type:
+            query = query.filter_by(type=service_type)
+        if near:
+            merchant_index.ensure_fresh(session)
+            nearby = merchant_index.nearest(*center, k=MAP_NEARBY_LIMIT, type_=service_type)
+            query = query.filter(Merchant.id.in_([merchant_id for merchant_id, _ in nearby]))
+        return [tuple(row) for row in query.all()]
+    cache_key = (service_type, get_data_version(session, 'merchants'), area)
+    return get_map_html(cache_key, load_merchants, center=center)
+
+
+def route_map_html(stops, start=None):
+    """Map of a multi-stop run: numbered pickup/drop-off markers joined by the driving order."""
+    def render():
+        points = ([start] if start else []) + [(stop.latitude, stop.longitude) for stop in stops]
+        m = folium.Map(location=points[0], zoom_start=13)
+        if start:
+            folium.Marker(start, tooltip="You", icon=folium.Icon(color='gray', icon='user')).add_to(m)
+        for number, stop in enumerate(stops, 1):
+            color = 'blue' if stop.kind == 'pickup' else 'green'
+            folium.Marker(
+                [stop.latitude, stop.longitude],
+                tooltip=f"{number}. {'Pick up at' if stop.kind == 'pickup' else 'Drop off at'} {html.escape(stop.label)}",
+                icon=folium.Icon(color=color, icon='shopping-cart' if stop.kind == 'pickup' else 'home')
+            ).add_to(m)
+        folium.PolyLine(points, weight=4, opacity=0.8).add_to(m)
+        m.fit_bounds([[min(lat for lat, _ in points), min(lon for _, lon in points)],
+                      [max(lat for lat, _ in points), max(lon for _, lon in points)]])
+        return m.get_root().render()
+    return route_map_cache.get_or_load((tuple(stops), tuple(start) if start else None), render)
@@ -0,0 +1,199 @@
+"""Bulk merchant onboarding from CSV or JSONL.
+
+    python merchant_import.py merchants.csv [--checkpoint merchants.ckpt] [--chunk-size 500]
+
+Records need name, type and either an address or both latitude and longitude (website is
+optional). Names already in the merchants table or earlier in the file are skipped, rows without
+coordinates are geocoded through the shared rate-limited geocoding service and its cache, and rows
+are inserted in chunks. A checkpoint file records progress so an interrupted import resumes where
+it stopped; rows whose address could not be geocoded are written to a rejects file (JSONL, so it
+can be imported again once the addresses are fixed or the geocoder is reachable).
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from contextlib import nullcontext
+from itertools import islice
+
+from dotenv import load_dotenv
+
+import db
+from geocoding import GeocodingService, GeocodingUnavailable, get_geocoding_service
+from models import Base, Merchant, bump_data_version
+from spatial import geohash_encode
+
+logger = logging.getLogger(__name__)
+
+MERCHANT_COLUMNS = ('name', 'type', 'latitude', 'longitude', 'website', 'geohash')
+
+
+def read_records(path):
+    """Stream merchant records from a .csv or .jsonl file without loading it into memory."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(f)
+
+
+def _coordinate(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except ValueError:
+        return None
+
+
+def load_checkpoint(path, source):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('source') == os.path.abspath(source):
+            return checkpoint.get('records_done', 0)
+    return 0
+
+
+def save_checkpoint(path, source, records_done):
+    if not path:
+        return
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'source': os.path.abspath(source), 'records_done': records_done}, f)
+    os.replace(tmp_path, path)
+
+
+def _insert_chunk(session, rows):
+    values = [tuple(row[column] for column in MERCHANT_COLUMNS) for row in rows]
+    if not db.copy_rows(session, Merchant.__tablename__, MERCHANT_COLUMNS, values):
+        session.bulk_insert_mappings(Merchant, rows)
+    # Bulk inserts skip flush events, so bump the version that maps and spatial indexes watch by hand
+    bump_data_version(session, 'merchants')
+    session.commit()
+
+
+def _has_location(record):
+    if (record.get('address') or '').strip():
+        return True
+    return _coordinate(record.get('latitude')) is not None and _coordinate(record.get('longitude')) is not None
+
+
+def import_merchants(path, chunk_size=500, checkpoint=None, geocoder=None, rejects=None, progress=print):
+    """Import merchants from path; returns counters for read/inserted/duplicate/invalid/ungeocoded rows.
+
+    Ungeocoded records are appended to the rejects file (if given), as the checkpoint moves past them.
+    """
+    geocoder = geocoder or get_geocoding_service()
+    stats = {'read': 0, 'inserted': 0, 'duplicates': 0, 'invalid': 0, 'ungeocoded': 0}
+    done = load_checkpoint(checkpoint, path)
+    records = islice(read_records(path), done, None)
+    stats['read'] = done
+    started = time.perf_counter()
+
+    with db.session_scope() as session:
+        # One set-based query for dedupe instead of a lookup per record
+        known_names = {name for (name,) in session.query(Merchant.name)}
+
+    # A resumed import adds to the rejects of the run it continues
+    with open(rejects, 'a' if done else 'w', encoding='utf-8') if rejects else nullcontext() as rejects_file:
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            stats['read'] += len(chunk)
+
+            candidates = []
+            for record in chunk:
+                name = (record.get('name') or '').strip()
+                if not name or not record.get('type') or not _has_location(record):
+                    stats['invalid'] += 1
+                    continue
+                if name in known_names:
+                    stats['duplicates'] += 1
+                    continue
+                known_names.add(name)
+                candidates.append((name, record))
+
+            # Queue every geocode in the chunk at once; the service applies the rate limit and cache
+            futures = {
+                name: geocoder.submit(record['address'])
+                for name, record in candidates
+                if _coordinate(record.get('latitude')) is None or _coordinate(record.get('longitude')) is None
+            }
+            rows = []
+            for name, record in candidates:
+                if name in futures:
+                    try:
+                        location = futures[name].result()
+                    except GeocodingUnavailable as e:
+                        logger.warning(f"Geocoding {name} failed: {e}")
+                        location = None
+                    if not location:
+                        stats['ungeocoded'] += 1
+                        if rejects_file:
+                            rejects_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+                        continue
+                    latitude, longitude = location.latitude, location.longitude
+                else:
+                    latitude, longitude = _coordinate(record['latitude']), _coordinate(record['longitude'])
+                rows.append({
+                    'name': name,
+                    'type': record['type'].strip(),
+                    'latitude': latitude,
+                    'longitude': longitude,
+                    'website': record.get('website') or None,
+                    'geohash': geohash_encode(latitude, longitude),
+                })
+
+            if rejects_file:
+                # Before the checkpoint passes them, so a crash can't lose a reject
+                rejects_file.flush()
+                os.fsync(rejects_file.fileno())
+            if rows:
+                with db.session_scope() as session:
+                    _insert_chunk(session, rows)
+            stats['inserted'] += len(rows)
+            save_checkpoint(checkpoint, path, stats['read'])
+
+            elapsed = time.perf_counter() - started
+            progress(f"{stats['read']} read, {stats['inserted']} inserted, {stats['duplicates']} duplicates, "
+                     f"{stats['ungeocoded']} not geocoded, {stats['invalid']} invalid "
+                     f"({(stats['read'] - done) / elapsed:.0f} records/s)")
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk import merchants from a CSV or JSONL file.")
+    parser.add_argument('path', help="merchants .csv or .jsonl (name, type, address[, website, latitude, longitude])")
+    parser.add_argument('--database-url', default=None, help="defaults to DATABASE_URL")
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--checkpoint', default=None, help="progress file for resuming (default: <path>.ckpt)")
+    parser.add_argument('--rejects', default=None,
+                        help="JSONL file for rows that could not be geocoded (default: <path>.rejects.jsonl)")
+    parser.add_argument('--geocode-rate', type=float, default=None,
+                        help="upstream geocoder requests/second (default: Nominatim's 1/s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv()
+    url = args.database_url or os.getenv('DATABASE_URL')
+    if not url:
+        parser.error("no database: pass --database-url or set DATABASE_URL")
+    engine = db.make_engine(url)
+    db.bind_engine(engine)
+    db.ensure_schema(engine, Base.metadata)
+
+    geocoder = GeocodingService(rate=args.geocode_rate) if args.geocode_rate else None
+    stats = import_merchants(args.path, chunk_size=args.chunk_size,
+                             checkpoint=args.checkpoint or f"{args.path}.ckpt", geocoder=geocoder,
+                             rejects=args.rejects or f"{args.path}.rejects.jsonl")
+    print(json.dumps(stats))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,207 @@
+from datetime import datetime, timezone
+
+import sqlalchemy
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, Float, ForeignKey, CheckConstraint, Index, event
+from sqlalchemy.orm import relationship
+from sqlalchemy.types import TypeDecorator
+
+from spatial import geohash_encode
+
+# SQLAlchemy models
+Base = sqlalchemy.orm.declarative_base()
+# Indexes replaced by wider ones; db.ensure_schema drops them from existing databases
+Base.metadata.info['superseded_indexes'] = ('ix_orders_status_date',)
+
+class UTCDateTime(TypeDecorator):
+    """timestamptz on Postgres; elsewhere UTC wall time. Takes and returns timezone-aware datetimes."""
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        if value.tzinfo is None:
+            raise ValueError(f"{value!r} has no timezone")
+        value = value.astimezone(timezone.utc)
+        # SQLite stores no offset, so every value is kept in UTC and compares correctly as text
+        return value if dialect.name == 'postgresql' else value.replace(tzinfo=None)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+
+class User(Base):
+    __tablename__ = 'users'
+    id = Column(String, primary_key=True)
+    name = Column(String, nullable=False)
+    email = Column(String, unique=True, nullable=False)
+    type = Column(String, nullable=False)
+    address = Column(String)
+
+class Merchant(Base):
+    __tablename__ = 'merchants'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    # Per-type maps and provider lists
+    type = Column(String, nullable=False, index=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+    website = Column(String)
+    # Kept in sync with latitude/longitude; indexed for prefix (bounding box) prefilters
+    geohash = Column(String(12), index=True)
+
+@event.listens_for(Merchant, 'before_insert')
+@event.listens_for(Merchant, 'before_update')
+def _set_merchant_geohash(mapper, connection, merchant):
+    if merchant.latitude is not None and merchant.longitude is not None:
+        merchant.geohash = geohash_encode(merchant.latitude, merchant.longitude)
+
+class Order(Base):
+    __tablename__ = 'orders'
+    id = Column(String, primary_key=True)
+    user_id = Column(String, ForeignKey('users.id'))
+    merchant_id = Column(Integer, ForeignKey('merchants.id'), nullable=True, index=True)
+    service = Column(String)
+    date = Column(DateTime, nullable=False)
+    time = Column(String, nullable=False)
+    address = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    payment_status = Column(String, default="Pending")
+    payment_method = Column(String, default="Online")
+    total_amount = Column(Float, default=0.0)
+    driver_id = Column(String, ForeignKey('users.id'), nullable=True, index=True)
+    # Stripe Checkout Session for online payments, set once payments.CheckoutService has created it
+    checkout_session_id = Column(String, nullable=True, index=True)
+    # Bumped by every write
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, index=True)
+    # Start of the delivery slot, from date + time (see scheduling.slot_timestamp); NULL only until backfilled
+    scheduled_at = Column(UTCDateTime, nullable=True)
+    user = relationship("User", foreign_keys=[user_id])
+    merchant = relationship("Merchant")
+    driver = relationship("User", foreign_keys=[driver_id])
+    # Listings are keyset-paged on (date, id): "a user's orders, newest first" reads the first index
+    # backwards, "orders in status X, oldest first" the second forwards. id breaks ties within a date.
+    __table_args__ = (
+        Index('ix_orders_user_id_date_id', 'user_id', 'date', 'id'),
+        Index('ix_orders_status_date_id', 'status', 'date', 'id'),
+        # "Pending orders due in the next 30 minutes", "active orders by delivery time"
+        Index('ix_orders_status_scheduled_at', 'status', 'scheduled_at', 'id'),
+        Index('ix_orders_scheduled_at', 'scheduled_at'),
+    )
+
+# Append-only status history; orders.status holds the current status and is moved with it by lifecycle.transition
+class OrderStatusChange(Base):
+    __tablename__ = 'order_events'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    order_id = Column(String, ForeignKey('orders.id'), nullable=False)
+    from_status = Column(String)
+    to_status = Column(String, nullable=False)
+    actor_id = Column(String)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    __table_args__ = (
+        # Latest change per order (current status, history) and "entered status X between t1 and t2"
+        Index('ix_order_events_order_id_id', 'order_id', 'id'),
+        Index('ix_order_events_to_status_created_at', 'to_status', 'created_at'),
+    )
+
+@event.listens_for(OrderStatusChange, 'before_update')
+@event.listens_for(OrderStatusChange, 'before_delete')
+def _order_events_append_only(mapper, connection, change):
+    raise sqlalchemy.exc.InvalidRequestError("order_events is append-only")
+
+class Subscription(Base):
+    __tablename__ = 'subscriptions'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(String, ForeignKey('users.id'))
+    partner_name = Column(String, nullable=False)
+    subscription_id = Column(String, nullable=False)
+    status = Column(String, default="Active")
+    user = relationship("User")
+
+# LIVE SHOP chat; a room is one live session with one store. Append-only, like order_events
+class ChatMessage(Base):
+    __tablename__ = 'chat_messages'
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    store = Column(String, nullable=False)
+    session_id = Column(String, nullable=False)
+    sender_id = Column(String, nullable=False)
+    sender_role = Column(String, nullable=False)
+    body = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.now)
+    __table_args__ = (
+        # Ids are handed out in insert order, so they double as the room's timeline and the paging cursor
+        Index('ix_chat_messages_room', 'store', 'session_id', 'id'),
+    )
+
+@event.listens_for(ChatMessage, 'before_update')
+@event.listens_for(ChatMessage, 'before_delete')
+def _chat_messages_append_only(mapper, connection, message):
+    raise sqlalchemy.exc.InvalidRequestError("chat_messages is append-only")
+
+# Merchant users who staff a store's LIVE SHOP; store is the catalog name, as in chat_messages.store
+class StoreAssociate(Base):
+    __tablename__ = 'store_associates'
+    user_id = Column(String, ForeignKey('users.id'), primary_key=True)
+    store = Column(String, primary_key=True)
+
+class GeocodeCache(Base):
+    __tablename__ = 'geocode_cache'
+    address = Column(String, primary_key=True)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    updated_at = Column(DateTime, default=datetime.now)
+
+# Delivery slot bookings; the check constraint is the final guard against overbooking
+class ScheduleSlot(Base):
+    __tablename__ = 'schedule_slots'
+    slot_start = Column(DateTime, primary_key=True)
+    capacity = Column(Integer, nullable=False)
+    booked = Column(Integer, nullable=False, default=0)
+    __table_args__ = (
+        CheckConstraint('booked >= 0 AND booked <= capacity', name='ck_schedule_slots_capacity'),
+    )
+
+# Change counters for data that is cached in memory (e.g. rendered maps keyed on the merchant set)
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+def get_data_version(session, name):
+    # A query rather than session.get, so a bump made in this session is never read from a stale identity map
+    version = session.execute(sqlalchemy.select(DataVersion.version).where(DataVersion.name == name)).scalar()
+    return version or 0
+
+def bump_data_version(session, name):
+    # One upsert, so concurrent first bumps don't both insert the row, and the increment happens in SQL
+    # so concurrent writers don't lose bumps
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        # No portable upsert; here only the very first bump of a name can still race
+        bumped = session.execute(sqlalchemy.update(DataVersion).where(DataVersion.name == name)
+                                 .values(version=DataVersion.version + 1))
+        if not bumped.rowcount:
+            session.execute(sqlalchemy.insert(DataVersion).values(name=name, version=1))
+        return
+    stmt = insert(DataVersion).values(name=name, version=1)
+    session.execute(stmt.on_conflict_do_update(index_elements=[DataVersion.name],
+                                               set_={'version': DataVersion.version + 1}))
+
+@event.listens_for(sqlalchemy.orm.Session, 'before_flush')
+def _track_merchant_changes(session, flush_context, instances):
+    changed = [obj for objs in (session.new, session.dirty, session.deleted) for obj in objs
+               if isinstance(obj, Merchant)]
+    if not changed:
+        return
+    bump_data_version(session, 'merchants')
+    # Deletes and moves can't be applied incrementally by in-memory spatial indexes
+    state = sqlalchemy.inspect
+    if any(obj in session.deleted or (obj in session.dirty and (
+            state(obj).attrs.latitude.history.has_changes() or state(obj).attrs.longitude.history.has_changes()))
+           for obj in changed):
+        bump_data_version(session, 'merchant_locations')
@@ -0,0 +1,259 @@
+"""Order persistence shared by the Streamlit pages and the load test."""
+import os
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.orm import joinedload
+
+from cache import TTLCache
+from events import order_events
+from lifecycle import ACTIVE_STATUSES, CANCELLED, PENDING, PREPARING, OrderNotFound, StatusConflict, record_created, transition
+from models import Merchant, Order
+from scheduling import get_schedule, local_slot_start, scheduled_at, service_time, slot_timestamp
+
+# Listing reads are served from here; the writes below invalidate the keys they affect
+ORDER_CACHE_TTL = float(os.getenv("ORDER_CACHE_TTL", "30"))
+order_cache = TTLCache(maxsize=4096, ttl=ORDER_CACHE_TTL)
+ORDER_PAGE_SIZE = 50
+
+# Read model for order listings: one flat row per order with its merchant, fetched in a single query
+@dataclass(frozen=True)
+class OrderRow:
+    id: str
+    user_id: str
+    merchant_id: int
+    merchant_name: str
+    service: str
+    date: datetime
+    time: str
+    address: str
+    status: str
+    payment_status: str
+    payment_method: str
+    total_amount: float
+    scheduled_at: datetime
+
+
+@dataclass(frozen=True)
+class OrderPage:
+    rows: tuple
+    # (date, id) of the last row; pass it as `after` for the next page. None on the last page.
+    next_cursor: tuple = None
+
+
+ORDER_ROW_COLUMNS = (
+    Order.id,
+    Order.user_id,
+    Order.merchant_id,
+    Merchant.name.label('merchant_name'),
+    Order.service,
+    Order.date,
+    Order.time,
+    Order.address,
+    Order.status,
+    Order.payment_status,
+    Order.payment_method,
+    Order.total_amount,
+    Order.scheduled_at,
+)
+
+
+def create_order(session, order_id, user_id, merchant_id, service, date, time, address,
+                 payment_method, total_amount, slot_start=None, schedule=None):
+    """Insert a pending order; with slot_start, the slot is reserved in the same transaction.
+
+    Raises scheduling.SlotUnavailable (after rolling back) when the slot filled up in the meantime.
+    """
+    if slot_start is not None:
+        try:
+            (schedule or get_schedule()).reserve(session, slot_start)
+        except Exception:
+            session.rollback()
+            raise
+    order = Order(
+        id=order_id,
+        user_id=user_id,
+        merchant_id=merchant_id,
+        service=service,
+        date=date,
+        time=time,
+        scheduled_at=service_time(slot_start) if slot_start else slot_timestamp(date, time),
+        address=address,
+        status=PENDING,
+        payment_status='Pending',
+        payment_method=payment_method,
+        total_amount=total_amount
+    )
+    session.add(order)
+    record_created(session, order_id, user_id, actor_id=user_id)
+    session.commit()
+    invalidate_order_listings(user_id=user_id, statuses=[PENDING])
+    return order
+
+
+def update_order_status(session, order_id, status, actor_id=None):
+    """Apply a lifecycle transition and commit; None if the order doesn't exist.
+
+    Raises lifecycle.InvalidTransition or lifecycle.StatusConflict (after rolling back).
+    """
+    try:
+        previous_status = transition(session, order_id, status, actor_id=actor_id)
+    except OrderNotFound:
+        session.rollback()
+        return None
+    except Exception:
+        session.rollback()
+        raise
+    session.commit()
+    order = session.get(Order, order_id)
+    invalidate_order_listings(user_id=order.user_id, statuses=[previous_status, status])
+    return order
+
+
+def cancel_order(session, order_id, actor_id=None, schedule=None):
+    """Cancel an order and free its delivery slot; same return value and errors as update_order_status."""
+    try:
+        previous_status = transition(session, order_id, CANCELLED, actor_id=actor_id)
+        order = session.get(Order, order_id)
+        slot_start = local_slot_start(order.scheduled_at) if order.scheduled_at else scheduled_at(order.date, order.time)
+        (schedule or get_schedule()).release(session, slot_start)
+    except OrderNotFound:
+        session.rollback()
+        return None
+    except Exception:
+        session.rollback()
+        raise
+    session.commit()
+    invalidate_order_listings(user_id=order.user_id, statuses=[previous_status, CANCELLED])
+    return order
+
+
+def claim_order(session, order_id, driver_id, status=PREPARING):
+    """Give a pending order to a driver; False if it is gone or another driver claimed it first."""
+    try:
+        transition(session, order_id, status, actor_id=driver_id, expected=PENDING, values={'driver_id': driver_id})
+    except (OrderNotFound, StatusConflict):
+        session.rollback()
+        return False
+    session.commit()
+    user_id = session.execute(select(Order.user_id).where(Order.id == order_id)).scalar()
+    invalidate_order_listings(user_id=user_id, statuses=[PENDING, status])
+    return True
+
+
+def _with_relations(query):
+    return query.options(joinedload(Order.merchant), joinedload(Order.user))
+
+
+def get_orders_for_user(session, user_id, limit=ORDER_PAGE_SIZE):
+    return (_with_relations(session.query(Order)).filter_by(user_id=user_id)
+            .order_by(Order.date.desc(), Order.id.desc()).limit(limit).all())
+
+
+def get_orders_by_status(session, status, limit=ORDER_PAGE_SIZE):
+    return (_with_relations(session.query(Order)).filter_by(status=status)
+            .order_by(Order.date, Order.id).limit(limit).all())
+
+
+def _order_rows(session, *criteria, limit=ORDER_PAGE_SIZE, order_by=()):
+    stmt = (
+        select(*ORDER_ROW_COLUMNS)
+        .outerjoin(Merchant, Order.merchant_id == Merchant.id)
+        .where(*criteria)
+        .order_by(*order_by)
+        .limit(limit)
+    )
+    return [OrderRow(**row._mapping) for row in session.execute(stmt)]
+
+
+def _order_page(session, *criteria, after=None, limit=ORDER_PAGE_SIZE, newest_first=False):
+    """One page of a listing ordered by (date, id), starting after the cursor `after`.
+
+    Seeking past the cursor instead of OFFSET makes every page a short range scan on an index
+    ending in (date, id), however deep into the listing it is.
+    """
+    keys = tuple_(Order.date, Order.id)
+    if after is not None:
+        criteria += ((keys < tuple_(*after)) if newest_first else (keys > tuple_(*after)),)
+    order_by = (Order.date.desc(), Order.id.desc()) if newest_first else (Order.date, Order.id)
+    # One extra row tells whether there is a next page
+    rows = _order_rows(session, *criteria, limit=limit + 1, order_by=order_by)
+    if len(rows) <= limit:
+        return OrderPage(tuple(rows))
+    rows = rows[:limit]
+    return OrderPage(tuple(rows), (rows[-1].date, rows[-1].id))
+
+
+def get_order_page_for_user(session, user_id, after=None, limit=ORDER_PAGE_SIZE):
+    """The user's orders, newest first (ix_orders_user_id_date_id)."""
+    return _order_page(session, Order.user_id == user_id, after=after, limit=limit, newest_first=True)
+
+
+def get_order_page_by_status(session, status, after=None, limit=ORDER_PAGE_SIZE):
+    """Orders in a status, oldest first (ix_orders_status_date_id)."""
+    return _order_page(session, Order.status == status, after=after, limit=limit)
+
+
+def get_order_rows_for_user(session, user_id, limit=ORDER_PAGE_SIZE):
+    return list(get_order_page_for_user(session, user_id, limit=limit).rows)
+
+
+def get_order_rows_by_status(session, status, limit=ORDER_PAGE_SIZE):
+    return list(get_order_page_by_status(session, status, limit=limit).rows)
+
+
+def get_order_rows_for_driver(session, driver_id, statuses=ACTIVE_STATUSES, limit=ORDER_PAGE_SIZE):
+    return _order_rows(session, Order.driver_id == driver_id, Order.status.in_(statuses), limit=limit,
+                       order_by=(Order.date,))
+
+
+def get_order_rows_due(session, start, end, statuses=(PENDING,), limit=ORDER_PAGE_SIZE):
+    """Orders in the given statuses whose slot starts in [start, end), soonest first.
+
+    start/end are timezone-aware; scheduling.due_window() builds the usual "next N minutes".
+    """
+    return _order_rows(session, Order.status.in_(statuses), Order.scheduled_at >= start, Order.scheduled_at < end,
+                       limit=limit, order_by=(Order.scheduled_at, Order.id))
+
+
+def count_orders_due(session, start, end, statuses=(PENDING,)):
+    return session.execute(
+        select(func.count()).select_from(Order)
+        .where(Order.status.in_(statuses), Order.scheduled_at >= start, Order.scheduled_at < end)
+    ).scalar()
+
+
+def get_order_rows_by_ids(session, order_ids):
+    """Rows for the given orders, in the given order (ids that no longer exist are dropped)."""
+    if not order_ids:
+        return []
+    rows = {row.id: row for row in _order_rows(session, Order.id.in_(order_ids), limit=len(order_ids))}
+    return [rows[order_id] for order_id in order_ids if order_id in rows]
+
+
+def invalidate_order_listings(user_id=None, statuses=()):
+    keys = [('status', status) for status in statuses]
+    if PENDING in statuses:
+        keys.append(('dispatch', 'Pending'))
+    if user_id:
+        keys.append(('user', user_id))
+    order_cache.invalidate(*keys)
+
+
+def _invalidate_on_event(order_event):
+    # Changes committed by other server processes reach this process's cache through the event bus
+    statuses = [order_event.status] + ([order_event.previous_status] if order_event.previous_status else [])
+    invalidate_order_listings(user_id=order_event.user_id, statuses=statuses)
+
+
+order_events.subscribe(_invalidate_on_event)
+
+
+def cached_order_page_for_user(session, user_id):
+    # Only first pages are cached; later pages are cheap seeks and change under every write anyway
+    return order_cache.get_or_load(('user', user_id), lambda: get_order_page_for_user(session, user_id))
+
+
+def cached_order_page_by_status(session, status):
+    return order_cache.get_or_load(('status', status), lambda: get_order_page_by_status(session, status))
@@ -0,0 +1,337 @@
+"""Stripe payments off the request path: checkout sessions from a worker pool, payment status from webhooks.
+
+Checkout sessions are created with an idempotency key derived from the order ID, so a retried
+click, a retried request after a network error or two server processes working on the same order
+all get the same session back from Stripe. Stripe replays a stored error response for a key too,
+so a retry the user asks for after Stripe refused the request goes out under a new key.
+
+Stripe's checkout.session.* webhooks move Order.payment_status, and a reconciliation job re-reads
+recent sessions in case a webhook was missed. Both write through apply_payment_updates(), one UPDATE per status for a whole batch.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import stripe
+from sqlalchemy import update
+
+import db
+import instrumentation
+from events import publish_order_event
+from models import Order
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_PENDING = 'Pending'
+PAID = 'Paid'
+PAYMENT_FAILED = 'Failed'
+PAYMENT_EXPIRED = 'Expired'
+
+# Payment status -> the statuses an order may move to it from; a late or replayed event never undoes a payment
+PAYMENT_TRANSITIONS = {
+    PAID: (PAYMENT_PENDING, PAYMENT_FAILED, PAYMENT_EXPIRED),
+    PAYMENT_FAILED: (PAYMENT_PENDING,),
+    PAYMENT_EXPIRED: (PAYMENT_PENDING,),
+}
+
+CHECKOUT_WORKERS = int(os.getenv("CHECKOUT_WORKERS", "8"))
+CHECKOUT_SUCCESS_URL = os.getenv("CHECKOUT_SUCCESS_URL", "https://your-app.streamlit.app/success")
+CHECKOUT_CANCEL_URL = os.getenv("CHECKOUT_CANCEL_URL", "https://your-app.streamlit.app/cancel")
+STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+STRIPE_WEBHOOK_PORT = int(os.getenv("STRIPE_WEBHOOK_PORT", "8502"))
+PAYMENT_RECONCILE_SECONDS = float(os.getenv("PAYMENT_RECONCILE_SECONDS", "300"))
+# Unpaid checkout sessions expire after 24 hours, so older ones can't change any more
+RECONCILE_LOOKBACK = timedelta(hours=25)
+UPDATE_CHUNK = 500
+
+# The app imports this module on first use and leaves the key to it
+if STRIPE_SECRET_KEY:
+    stripe.api_key = STRIPE_SECRET_KEY
+
+# Safe to retry with the same idempotency key; anything else is a real rejection
+RETRYABLE_ERRORS = (stripe.APIConnectionError, stripe.RateLimitError)
+
+
+def idempotency_key(order_id, attempt=0):
+    return f"checkout-{order_id}" if not attempt else f"checkout-{order_id}-{attempt}"
+
+
+def retry_attempt(attempt, error):
+    """The attempt for a user's retry after error: the same after a transport failure, which Stripe may
+    have acted on, and a new one (so a new idempotency key) after an error response it would replay."""
+    return attempt if isinstance(error, RETRYABLE_ERRORS) else attempt + 1
+
+
+def checkout_params(order_id, amount, service_type):
+    return {
+        'payment_method_types': ['card'],
+        'line_items': [{
+            'price_data': {
+                'currency': 'usd',
+                'product_data': {
+                    'name': f"Local Butler {service_type} - Order {order_id}"
+                },
+                'unit_amount': int(round(amount * 100)),
+            },
+            'quantity': 1,
+        }],
+        'mode': 'payment',
+        # Maps webhook events and listed sessions back to the order
+        'client_reference_id': order_id,
+        'metadata': {'order_id': order_id},
+        'success_url': CHECKOUT_SUCCESS_URL,
+        'cancel_url': CHECKOUT_CANCEL_URL,
+    }
+
+
+class CheckoutService:
+    """Creates checkout sessions on a bounded worker pool; concurrent requests for one order share a call."""
+
+    def __init__(self, create=None, max_workers=CHECKOUT_WORKERS, max_retries=3, backoff=0.5):
+        self._create = create
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='checkout')
+        self._max_retries = max_retries
+        self._backoff = backoff
+        self._inflight = {}  # (order_id, attempt) -> Future
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+
+    @property
+    def create(self):
+        return self._create or stripe.checkout.Session.create
+
+    def submit(self, order_id, amount, service_type, attempt=0):
+        """Future resolving to the order's Checkout Session; raises stripe.StripeError if Stripe refuses.
+
+        attempt picks the idempotency key; see retry_attempt() for retries after a failure.
+        """
+        key = (order_id, attempt)
+        with self._lock:
+            self.requests += 1
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._executor.submit(self._checkout, order_id, amount, service_type, attempt)
+            self._inflight[key] = future
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future
+
+    def _forget(self, key, future):
+        with self._lock:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    def _checkout(self, order_id, amount, service_type, attempt):
+        checkout_session = self._create_upstream(order_id, checkout_params(order_id, amount, service_type), attempt)
+        try:
+            with db.session_scope() as session:
+                session.execute(
+                    update(Order).where(Order.id == order_id)
+                    .values(checkout_session_id=checkout_session.id)
+                    .execution_options(synchronize_session=False)
+                )
+        except Exception as e:
+            # The session is usable without it; webhooks and reconciliation find the order by client_reference_id
+            logger.error(f"Could not record checkout session for {order_id}: {e}")
+        return checkout_session
+
+    def _create_upstream(self, order_id, params, attempt=0):
+        for attempt in range(self._max_retries):
+            if attempt:
+                time.sleep(self._backoff * (2 ** (attempt - 1)))
+            with self._lock:
+                self.upstream_calls += 1
+            try:
+                with instrumentation.span("stripe checkout create"):
+                    return self.create(**params, idempotency_key=idempotency_key(order_id, attempt))
+            except RETRYABLE_ERRORS as e:
+                if attempt == self._max_retries - 1:
+                    raise
+                logger.warning(f"Checkout attempt {attempt + 1} failed for {order_id}: {e}")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_checkout_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = CheckoutService()
+        return _service
+
+
+def _field(stripe_object, name):
+    # Stripe objects support `in` and [] but not dict.get()
+    return stripe_object[name] if name in stripe_object else None
+
+
+def checkout_payment_status(checkout_session):
+    """The payment status a Checkout Session implies, or None while the customer hasn't finished."""
+    if _field(checkout_session, 'payment_status') in ('paid', 'no_payment_required'):
+        return PAID
+    if _field(checkout_session, 'status') == 'expired':
+        return PAYMENT_EXPIRED
+    return None
+
+
+def payment_update_from_event(stripe_event):
+    """(order_id, payment status) for a checkout.session.* webhook event, or None if it changes nothing."""
+    if not stripe_event['type'].startswith('checkout.session.'):
+        return None
+    checkout_session = stripe_event['data']['object']
+    order_id = _field(checkout_session, 'client_reference_id')
+    if stripe_event['type'] == 'checkout.session.async_payment_failed':
+        status = PAYMENT_FAILED
+    else:
+        status = checkout_payment_status(checkout_session)
+    return (order_id, status) if order_id and status else None
+
+
+def apply_payment_updates(session, updates):
+    """Apply {order_id: payment status} with one UPDATE per status and chunk; returns the ids that changed.
+
+    Orders already past the new status (see PAYMENT_TRANSITIONS) are left alone, so replayed and
+    out-of-order events are harmless. The caller commits.
+    """
+    by_status = {}
+    for order_id, status in updates.items():
+        by_status.setdefault(status, []).append(order_id)
+    changed = []
+    for status, order_ids in by_status.items():
+        for start in range(0, len(order_ids), UPDATE_CHUNK):
+            rows = session.execute(
+                update(Order)
+                .where(Order.id.in_(order_ids[start:start + UPDATE_CHUNK]),
+                       Order.payment_status.in_(PAYMENT_TRANSITIONS[status]))
+                .values(payment_status=status)
+                .returning(Order.id, Order.user_id, Order.status)
+                .execution_options(synchronize_session=False)
+            ).all()
+            for order_id, user_id, order_status in rows:
+                publish_order_event(session, order_id, user_id, order_status, recorded=False)
+            changed += [row.id for row in rows]
+    return changed
+
+
+def handle_webhook(payload, sig_header, secret=None):
+    """Verify and apply one Stripe webhook delivery; returns the changed order ids.
+
+    Raises ValueError or stripe.SignatureVerificationError for payloads that aren't from Stripe.
+    """
+    stripe_event = stripe.Webhook.construct_event(payload, sig_header, secret or STRIPE_WEBHOOK_SECRET)
+    payment_update = payment_update_from_event(stripe_event)
+    if payment_update is None:
+        return []
+    with db.session_scope() as session:
+        return apply_payment_updates(session, dict([payment_update]))
+
+
+def reconcile(session, list_sessions=None, now=None):
+    """Apply the outcome of every checkout session created within RECONCILE_LOOKBACK; returns changed ids."""
+    list_sessions = list_sessions or stripe.checkout.Session.list
+    since = int(((now or datetime.now()) - RECONCILE_LOOKBACK).timestamp())
+    updates = {}
+    with instrumentation.span("stripe list sessions"):
+        for checkout_session in list_sessions(created={'gte': since}, limit=100).auto_paging_iter():
+            order_id = _field(checkout_session, 'client_reference_id')
+            status = checkout_payment_status(checkout_session)
+            if order_id and status:
+                updates[order_id] = status
+    return apply_payment_updates(session, updates)
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if self.path != '/stripe/webhook':
+            self.send_error(404)
+            return
+        payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            changed = handle_webhook(payload, self.headers.get('Stripe-Signature'))
+        except (ValueError, stripe.SignatureVerificationError) as e:
+            logger.warning(f"Rejected Stripe webhook: {e}")
+            self.send_error(400)
+            return
+        except Exception:
+            # A 5xx makes Stripe redeliver later
+            logger.exception("Stripe webhook failed")
+            self.send_error(500)
+            return
+        body = json.dumps({'updated': len(changed)}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class PaymentReconciler(threading.Thread):
+    def __init__(self, interval=PAYMENT_RECONCILE_SECONDS, list_sessions=None):
+        super().__init__(name='payment-reconcile', daemon=True)
+        self.interval = interval
+        self.list_sessions = list_sessions
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                with db.session_scope() as session:
+                    changed = reconcile(session, self.list_sessions)
+                if changed:
+                    logger.info(f"Payment reconciliation updated {len(changed)} orders")
+            except Exception:
+                logger.exception("Payment reconciliation failed")
+
+
+_reconciler = None
+_webhook_server = None
+_workers_lock = threading.Lock()
+
+
+def start():
+    """Start this process's reconciler, and the webhook endpoint when a signing secret is configured."""
+    global _reconciler, _webhook_server
+    with _workers_lock:
+        if stripe.api_key and (_reconciler is None or not _reconciler.is_alive()):
+            _reconciler = PaymentReconciler()
+            _reconciler.start()
+        if STRIPE_WEBHOOK_SECRET and _webhook_server is None:
+            try:
+                _webhook_server = ThreadingHTTPServer(('', STRIPE_WEBHOOK_PORT), WebhookHandler)
+            except OSError as e:
+                # Another server process on this host already serves the endpoint
+                logger.info(f"Stripe webhook endpoint not started here: {e}")
+            else:
+                threading.Thread(target=_webhook_server.serve_forever, name='stripe-webhook', daemon=True).start()
+
+
+def stop():
+    global _reconciler, _webhook_server
+    with _workers_lock:
+        if _reconciler is not None:
+            _reconciler.stop()
+            _reconciler = None
+        if _webhook_server is not None:
+            _webhook_server.shutdown()
+            _webhook_server.server_close()
+            _webhook_server = None
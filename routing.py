@@ -0,0 +1,206 @@
+"""Multi-stop runs: batch compatible pending orders and order their stops.
+
+Orders are compatible when their pickups are close (usually the same merchant), their drop-offs
+are close and their slots overlap. A run visits every pickup first and then every drop-off, so
+no drop-off comes before its pickup. Each leg is ordered with nearest neighbour followed by
+2-opt over a distance matrix built once for the run.
+"""
+import os
+from dataclasses import dataclass
+from datetime import timedelta
+
+import numpy as np
+from sqlalchemy import select
+
+from models import Merchant, Order
+from scheduling import slot_timestamp
+from spatial import haversine_matrix_km
+
+ROUTE_MAX_ORDERS = int(os.getenv("ROUTE_MAX_ORDERS", "4"))
+ROUTE_PICKUP_RADIUS_KM = float(os.getenv("ROUTE_PICKUP_RADIUS_KM", "1.0"))
+ROUTE_DROP_RADIUS_KM = float(os.getenv("ROUTE_DROP_RADIUS_KM", "3.0"))
+ROUTE_SLOT_WINDOW = timedelta(minutes=int(os.getenv("ROUTE_SLOT_WINDOW_MINUTES", "30")))
+
+
+@dataclass(frozen=True)
+class RouteOrder:
+    order_id: str
+    merchant_id: int
+    merchant_name: str
+    pickup: tuple
+    drop: tuple
+    address: str
+    slot: object
+
+
+@dataclass(frozen=True)
+class Stop:
+    kind: str
+    label: str
+    latitude: float
+    longitude: float
+    order_ids: tuple
+
+
+@dataclass(frozen=True)
+class Run:
+    orders: tuple
+    stops: tuple
+    distance_km: float
+    # The same orders driven one after another (pickup, drop, next pickup, ...) in slot order
+    solo_distance_km: float
+
+    @property
+    def order_ids(self):
+        return tuple(order.order_id for order in self.orders)
+
+    @property
+    def savings_km(self):
+        return self.solo_distance_km - self.distance_km
+
+
+def path_length(path, dist):
+    path = np.asarray(path)
+    return float(dist[path[:-1], path[1:]].sum()) if len(path) > 1 else 0.0
+
+
+def nearest_neighbor(dist, start=0):
+    """Open path from start, always moving to the closest unvisited node."""
+    n = dist.shape[0]
+    visited = np.zeros(n, dtype=bool)
+    path = [start]
+    visited[start] = True
+    for _ in range(n - 1):
+        candidates = np.where(visited, np.inf, dist[path[-1]])
+        path.append(int(np.argmin(candidates)))
+        visited[path[-1]] = True
+    return path
+
+
+def two_opt(path, dist):
+    """Reverse segments while that shortens the open path; the first node stays first."""
+    n = len(path)
+    if n < 3:
+        return list(path)
+    # A dummy end node at distance 0 from everything makes the open end an ordinary edge
+    size = dist.shape[0]
+    padded = np.zeros((size + 1, size + 1))
+    padded[:size, :size] = dist
+    p = np.array(list(path) + [size])
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 1):
+            j = np.arange(i + 1, n)
+            delta = (padded[p[i - 1], p[j]] + padded[p[i], p[j + 1]]
+                     - padded[p[i - 1], p[i]] - padded[p[j], p[j + 1]])
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                p[i:j[best] + 1] = p[i:j[best] + 1][::-1].copy()
+                improved = True
+    return p[:-1].tolist()
+
+
+def solve_path(dist, start=0):
+    return two_opt(nearest_neighbor(dist, start), dist)
+
+
+def _ordered_leg(origin, points):
+    """Indexes into points in visiting order, starting from origin (lat, lon)."""
+    coords = np.array([origin] + list(points))
+    path = solve_path(haversine_matrix_km(coords[:, 0], coords[:, 1]))
+    return [i - 1 for i in path[1:]]
+
+
+def _distance_along(points):
+    coords = np.array(points)
+    if len(coords) < 2:
+        return 0.0
+    return float(np.diagonal(haversine_matrix_km(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])).sum())
+
+
+def plan_run(orders, start=None):
+    """A Run over orders, starting at start (lat, lon) or else at the earliest order's pickup."""
+    orders = sorted(orders, key=lambda order: order.slot)
+    pickups = {}
+    for order in orders:
+        pickups.setdefault(order.merchant_id, []).append(order)
+    pickup_groups = list(pickups.values())
+    origin = start or orders[0].pickup
+    pickup_order = _ordered_leg(origin, [group[0].pickup for group in pickup_groups])
+    stops = [
+        Stop('pickup', pickup_groups[i][0].merchant_name, *pickup_groups[i][0].pickup,
+             tuple(order.order_id for order in pickup_groups[i]))
+        for i in pickup_order
+    ]
+    drop_order = _ordered_leg((stops[-1].latitude, stops[-1].longitude), [order.drop for order in orders])
+    stops += [Stop('drop', orders[i].address, *orders[i].drop, (orders[i].order_id,)) for i in drop_order]
+
+    lead = [start] if start else []
+    distance = _distance_along(lead + [(stop.latitude, stop.longitude) for stop in stops])
+    solo = _distance_along(lead + [point for order in orders for point in (order.pickup, order.drop)])
+    return Run(tuple(orders), tuple(stops), distance, solo)
+
+
+def batch_orders(orders, max_orders=ROUTE_MAX_ORDERS, pickup_radius_km=ROUTE_PICKUP_RADIUS_KM,
+                 drop_radius_km=ROUTE_DROP_RADIUS_KM, slot_window=ROUTE_SLOT_WINDOW):
+    """Greedy batching in slot order: each unbatched order takes its closest compatible later orders."""
+    orders = sorted(orders, key=lambda order: order.slot)
+    if not orders:
+        return []
+    pickup = np.array([order.pickup for order in orders], dtype=np.float64)
+    drop = np.array([order.drop for order in orders], dtype=np.float64)
+    slots = np.array([order.slot.timestamp() for order in orders])
+    free = np.ones(len(orders), dtype=bool)
+    batches = []
+    for i in range(len(orders)):
+        if not free[i]:
+            continue
+        free[i] = False
+        batch = [orders[i]]
+        # Sorted by slot, so the orders within the window are one contiguous range after i
+        end = int(np.searchsorted(slots, slots[i] + slot_window.total_seconds(), side='right'))
+        candidates = i + 1 + np.flatnonzero(free[i + 1:end])
+        if max_orders > 1 and len(candidates):
+            pickup_km = haversine_matrix_km(pickup[i:i + 1, 0], pickup[i:i + 1, 1],
+                                            pickup[candidates, 0], pickup[candidates, 1])[0]
+            drop_km = haversine_matrix_km(drop[i:i + 1, 0], drop[i:i + 1, 1],
+                                          drop[candidates, 0], drop[candidates, 1])[0]
+            fits = (pickup_km <= pickup_radius_km) & (drop_km <= drop_radius_km)
+            chosen = candidates[fits][np.argsort((pickup_km + drop_km)[fits], kind='stable')][:max_orders - 1]
+            free[chosen] = False
+            batch += [orders[j] for j in chosen]
+        batches.append(batch)
+    return batches
+
+
+def plan_runs(orders, start=None, **batch_options):
+    """Runs for all orders (single-order runs included), shortest distance per order first."""
+    runs = [plan_run(batch, start) for batch in batch_orders(orders, **batch_options)]
+    return sorted(runs, key=lambda run: run.distance_km / len(run.orders))
+
+
+def load_route_orders(session, order_ids, geocoder):
+    """RouteOrders for the given orders whose pickup and drop-off are located; the rest are skipped.
+
+    Drop-off addresses are looked up without blocking (geocoder.poll_many), so addresses still being
+    geocoded join a later plan.
+    """
+    if not order_ids:
+        return []
+    stmt = (
+        select(Order.id, Order.merchant_id, Merchant.name, Merchant.latitude, Merchant.longitude,
+               Order.address, Order.scheduled_at, Order.date, Order.time)
+        .join(Merchant, Order.merchant_id == Merchant.id)
+        .where(Order.id.in_(order_ids))
+    )
+    rows = session.execute(stmt).all()
+    drops = geocoder.poll_many(row.address for row in rows)
+    orders = []
+    for row in rows:
+        drop = drops[row.address]
+        if drop:
+            orders.append(RouteOrder(row.id, row.merchant_id, row.name, (row.latitude, row.longitude),
+                                     (drop.latitude, drop.longitude), row.address,
+                                     row.scheduled_at or slot_timestamp(row.date, row.time)))
+    return orders
@@ -0,0 +1,287 @@
+"""Delivery slot scheduling backed by the butler schedule CSV.
+
+Each CSV row is one butler-slot (Date, Time, User, Service); a row with a User is already taken.
+Dates the CSV covers use their own rows, later dates repeat the CSV's capacity for the same
+weekday. Remaining capacity for a rolling window of days is kept in a date x slot array so the
+picker and "next free slots" never touch the database; reservations are made atomically in the
+schedule_slots table (conditional UPDATE plus a CHECK constraint) inside the order transaction.
+"""
+import csv
+import logging
+import os
+import re
+import threading
+import time as _time
+from collections import Counter
+from datetime import date, datetime, time, timedelta, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+
+import numpy as np
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy import insert as sqlalchemy_insert
+from sqlalchemy.exc import IntegrityError
+
+from models import Order, ScheduleSlot
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            "Schedule 06-24-07-25 - Schedule 06-24-07-25.csv.csv")
+SCHEDULE_HORIZON_DAYS = int(os.getenv("SCHEDULE_HORIZON_DAYS", "60"))
+# Bookings made by other server processes show up in the picker after at most this long
+SCHEDULE_REFRESH_SECONDS = 5.0
+# Slot labels and the schedule CSV are wall-clock times here ("EST" in the labels means Eastern time)
+SERVICE_TIMEZONE = ZoneInfo(os.getenv("SERVICE_TIMEZONE", "America/New_York"))
+BACKFILL_BATCH_SIZE = 5000
+
+_SLOT_LABEL = re.compile(r"\s*(?P<hour>\d{1,2}):(?P<minute>\d{2})(?::\d{2})?\s*(?P<meridiem>[AaPp][Mm])?")
+
+
+class SlotUnavailable(Exception):
+    pass
+
+
+def format_slot(slot_start):
+    return slot_start.strftime("%I:%M %p EST")
+
+
+@lru_cache(maxsize=1024)
+def parse_slot_time(text):
+    """Inverse of format_slot; also accepts the old picker's 24-hour labels such as "13:00 PM EST"."""
+    match = _SLOT_LABEL.match(text or '')
+    if not match:
+        return None
+    hour, minute, meridiem = int(match['hour']), int(match['minute']), (match['meridiem'] or '').upper()
+    if meridiem == 'PM' and hour < 12:
+        hour += 12
+    elif meridiem == 'AM' and hour == 12:
+        hour = 0
+    return time(hour, minute) if hour < 24 and minute < 60 else None
+
+
+def scheduled_at(date, time_label):
+    """An order's slot start from its date and time label, or the start of the day if unparseable."""
+    slot = parse_slot_time(time_label)
+    return datetime.combine(date.date() if isinstance(date, datetime) else date, slot or datetime.min.time())
+
+
+def service_now():
+    """The current wall-clock time in SERVICE_TIMEZONE, naive like slot starts; today is service_now().date()."""
+    return datetime.now(SERVICE_TIMEZONE).replace(tzinfo=None)
+
+
+def service_time(slot_start):
+    """A naive service-time slot start (as in schedule_slots and the picker) as an aware instant."""
+    return slot_start.replace(tzinfo=SERVICE_TIMEZONE)
+
+
+def slot_timestamp(date, time_label):
+    """scheduled_at() as an aware instant; what Order.scheduled_at holds."""
+    return service_time(scheduled_at(date, time_label))
+
+
+def local_slot_start(timestamp):
+    """The naive service-time slot start (as in schedule_slots) for an aware timestamp."""
+    return timestamp.astimezone(SERVICE_TIMEZONE).replace(tzinfo=None)
+
+
+def due_window(minutes, now=None):
+    """(start, end) aware instants covering the next `minutes` from now."""
+    start = now or datetime.now(timezone.utc)
+    return start, start + timedelta(minutes=minutes)
+
+
+def backfill_scheduled_at(session, batch_size=BACKFILL_BATCH_SIZE):
+    """Fill Order.scheduled_at from date + time for orders written before the column existed.
+
+    Walks the orders table in primary-key order from the first order missing it, one committed
+    batch at a time, so a large backfill neither holds one long transaction nor re-reads rows it
+    has done. (Selecting "scheduled_at IS NULL" per batch would rescan the remaining NULLs each
+    time.) Returns the number of orders filled.
+    """
+    first = session.execute(select(func.min(Order.id)).where(Order.scheduled_at.is_(None))).scalar()
+    if first is None:
+        return 0
+    stmt = update(Order).where(Order.id == bindparam('order_id')).values(scheduled_at=bindparam('timestamp'))
+    batch = select(Order.id, Order.date, Order.time, Order.scheduled_at).order_by(Order.id).limit(batch_size)
+    rows = session.execute(batch.where(Order.id >= first)).all()
+    filled = 0
+    while rows:
+        missing = [{'order_id': row.id, 'timestamp': slot_timestamp(row.date, row.time)}
+                   for row in rows if row.scheduled_at is None]
+        if missing:
+            session.connection().execute(stmt, missing)
+            session.commit()
+            filled += len(missing)
+        rows = session.execute(batch.where(Order.id > rows[-1].id)).all()
+    session.commit()
+    if filled:
+        logger.info(f"Backfilled scheduled_at for {filled} orders")
+    return filled
+
+
+def read_slot_rows(path=SCHEDULE_CSV):
+    """(date, time, taken) for every butler-slot row in the schedule CSV."""
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            if not row.get('Date') or not row.get('Time'):
+                continue
+            day = date.fromisoformat(row['Date'].strip())
+            slot = datetime.strptime(row['Time'].strip(), "%H:%M:%S").time()
+            yield day, slot, bool((row.get('User') or '').strip())
+
+
+class SlotSchedule:
+    def __init__(self, rows, start_date=None, horizon_days=SCHEDULE_HORIZON_DAYS):
+        rows = list(rows)
+        self.start_date = start_date or service_now().date()
+        self.slot_times = sorted({slot for _, slot, _ in rows})
+        self._slot_index = {slot: i for i, slot in enumerate(self.slot_times)}
+        per_date = Counter((day, slot) for day, slot, _ in rows)
+        taken = Counter((day, slot) for day, slot, is_taken in rows if is_taken)
+        weekday = {}
+        for (day, slot), count in per_date.items():
+            weekday[day.weekday(), slot] = max(weekday.get((day.weekday(), slot), 0), count)
+
+        shape = (horizon_days, len(self.slot_times))
+        self.capacity = np.zeros(shape, dtype=np.int32)
+        self.booked = np.zeros(shape, dtype=np.int32)
+        for d in range(horizon_days):
+            day = self.start_date + timedelta(days=d)
+            for slot, s in self._slot_index.items():
+                if (day, slot) in per_date:
+                    self.capacity[d, s] = per_date[day, slot]
+                    self.booked[d, s] = taken[day, slot]
+                else:
+                    self.capacity[d, s] = weekday.get((day.weekday(), slot), 0)
+        self._lock = threading.Lock()
+        self._refreshed_at = 0.0
+
+    @classmethod
+    def from_csv(cls, path=SCHEDULE_CSV, **kwargs):
+        return cls(read_slot_rows(path), **kwargs)
+
+    def _position(self, slot_start):
+        d = (slot_start.date() - self.start_date).days
+        s = self._slot_index.get(slot_start.time())
+        if s is None or not 0 <= d < self.capacity.shape[0]:
+            return None
+        return d, s
+
+    def _slot_start(self, d, s):
+        return datetime.combine(self.start_date + timedelta(days=int(d)), self.slot_times[int(s)])
+
+    def capacity_for(self, slot_start):
+        position = self._position(slot_start)
+        return int(self.capacity[position]) if position else 0
+
+    def remaining(self, slot_start):
+        position = self._position(slot_start)
+        return int(self.capacity[position] - self.booked[position]) if position else 0
+
+    def available_slots(self, day, now=None):
+        """Slot start times on a day that still have capacity (and haven't started yet)."""
+        return [slot for slot in self.next_free_slots(datetime.combine(day, time.min), n=None, now=now)
+                if slot.date() == day]
+
+    def next_free_slots(self, after, n=5, now=None):
+        """The next n slots starting at or after `after` with capacity left: one pass over the array."""
+        after = max(after, now or service_now())
+        d = (after.date() - self.start_date).days
+        if d >= self.capacity.shape[0]:
+            return []
+        d = max(d, 0)
+        first = 0
+        if d == (after.date() - self.start_date).days:
+            first = int(np.searchsorted(np.array([t.hour * 60 + t.minute for t in self.slot_times]),
+                                        after.hour * 60 + after.minute + (after.second > 0)))
+        free = (self.capacity - self.booked).ravel()[d * len(self.slot_times) + first:] > 0
+        hits = np.flatnonzero(free)
+        if n is not None:
+            hits = hits[:n]
+        offset = d * len(self.slot_times) + first
+        return [self._slot_start(*divmod(int(i) + offset, len(self.slot_times))) for i in hits]
+
+    def refresh(self, session, force=False):
+        """Pull booked counts for the window from the database (rate limited unless forced)."""
+        if not force and _time.monotonic() - self._refreshed_at < SCHEDULE_REFRESH_SECONDS:
+            return
+        window_end = datetime.combine(self.start_date + timedelta(days=self.capacity.shape[0]), time.min)
+        rows = session.query(ScheduleSlot.slot_start, ScheduleSlot.booked).filter(
+            ScheduleSlot.slot_start >= datetime.combine(self.start_date, time.min),
+            ScheduleSlot.slot_start < window_end).all()
+        with self._lock:
+            for slot_start, booked in rows:
+                position = self._position(slot_start)
+                if position:
+                    self.booked[position] = booked
+            self._refreshed_at = _time.monotonic()
+
+    def reserve(self, session, slot_start):
+        """Take one unit of a slot's capacity in the caller's transaction; raises SlotUnavailable.
+
+        The caller commits (together with the order) or rolls back. Concurrent bookings of the
+        same slot serialize on its row, and the conditional UPDATE never lets booked pass capacity.
+        """
+        capacity = self.capacity_for(slot_start)
+        if capacity <= 0:
+            raise SlotUnavailable(f"{format_slot(slot_start)} on {slot_start.date()} is not a delivery slot")
+        if session.get(ScheduleSlot, slot_start) is None:
+            self._create_slot_row(session, slot_start, capacity)
+        result = session.execute(
+            update(ScheduleSlot)
+            .where(ScheduleSlot.slot_start == slot_start, ScheduleSlot.booked < ScheduleSlot.capacity)
+            .values(booked=ScheduleSlot.booked + 1)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            raise SlotUnavailable(f"{format_slot(slot_start)} on {slot_start.date()} is fully booked")
+        with self._lock:
+            position = self._position(slot_start)
+            self.booked[position] = min(self.booked[position] + 1, self.capacity[position])
+
+    def _create_slot_row(self, session, slot_start, capacity):
+        # INSERT ... ON CONFLICT DO NOTHING: a request that loses the race to create the row just books
+        # it, and nothing needs a SAVEPOINT (which pysqlite doesn't isolate without extra event hooks)
+        booked = int(self.booked[self._position(slot_start)])
+        values = {'slot_start': slot_start, 'capacity': capacity, 'booked': booked}
+        dialect = session.get_bind().dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            try:
+                with session.begin_nested():
+                    session.execute(sqlalchemy_insert(ScheduleSlot).values(**values))
+            except IntegrityError:
+                pass  # another request created the row first
+            return
+        session.execute(insert(ScheduleSlot).values(**values).on_conflict_do_nothing(index_elements=['slot_start']))
+
+    def release(self, session, slot_start):
+        """Give back one unit of a slot's capacity in the caller's transaction (e.g. on cancellation)."""
+        result = session.execute(
+            update(ScheduleSlot)
+            .where(ScheduleSlot.slot_start == slot_start, ScheduleSlot.booked > 0)
+            .values(booked=ScheduleSlot.booked - 1)
+            .execution_options(synchronize_session=False)
+        )
+        position = self._position(slot_start)
+        if result.rowcount == 1 and position:
+            with self._lock:
+                self.booked[position] = max(self.booked[position] - 1, 0)
+
+
+_schedule = None
+_schedule_lock = threading.Lock()
+
+
+def get_schedule():
+    """Process-wide schedule whose window starts today (rebuilt when the date rolls over)."""
+    global _schedule
+    with _schedule_lock:
+        if _schedule is None or _schedule.start_date != service_now().date():
+            _schedule = SlotSchedule.from_csv()
+        return _schedule
@@ -0,0 +1,315 @@
+"""Spatial lookups over merchants: geohash encoding, a KD-tree and a process-wide nearest-merchant index."""
+import heapq
+import math
+import threading
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+_GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_encode(latitude, longitude, precision=9):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        rng, coord = (lon_range, longitude) if even else (lat_range, latitude)
+        mid = (rng[0] + rng[1]) / 2
+        value <<= 1
+        if coord >= mid:
+            value |= 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+_GEOHASH_CODES = np.frombuffer(_GEOHASH_BASE32.encode(), dtype=np.uint8)
+
+
+def geohash_encode_array(latitudes, longitudes, precision=9):
+    """geohash_encode over arrays of coordinates (for bulk loads); returns an array of str."""
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    # Which half each bisection step picks is just the binary expansion of the scaled coordinate
+    lon_cells = np.clip(np.floor((longitudes + 180.0) / 360.0 * (1 << lon_bits)), 0, (1 << lon_bits) - 1).astype(np.int64)
+    lat_cells = np.clip(np.floor((latitudes + 90.0) / 180.0 * (1 << lat_bits)), 0, (1 << lat_bits) - 1).astype(np.int64)
+    code = np.zeros(latitudes.shape, dtype=np.int64)
+    for i in range(bits):
+        # Bits alternate, longitude first
+        cells, width = (lon_cells, lon_bits) if i % 2 == 0 else (lat_cells, lat_bits)
+        code = (code << 1) | ((cells >> (width - 1 - i // 2)) & 1)
+    chars = np.empty((latitudes.size, precision), dtype=np.uint8)
+    for position in range(precision - 1, -1, -1):
+        chars[:, position] = _GEOHASH_CODES[code.ravel() & 31]
+        code = code >> 5
+    return chars.view(f'S{precision}').ravel().astype(str)
+
+
+def geohash_cell_size(precision):
+    """(lat_degrees, lon_degrees) covered by one geohash cell of the given precision."""
+    total_bits = precision * 5
+    lon_bits = (total_bits + 1) // 2
+    lat_bits = total_bits // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+
+def geohash_cell_center(latitude, longitude, precision):
+    """(latitude, longitude) of the center of the geohash cell containing a point."""
+    lat_size, lon_size = geohash_cell_size(precision)
+    return ((math.floor((latitude + 90.0) / lat_size) + 0.5) * lat_size - 90.0,
+            (math.floor((longitude + 180.0) / lon_size) + 0.5) * lon_size - 180.0)
+
+
+def geohash_prefixes_for_radius(latitude, longitude, radius_km, max_cells=16):
+    """Geohash prefixes whose cells cover the bounding box of a circle; used to prefilter merchants in SQL."""
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    lon_delta = lat_delta / max(math.cos(math.radians(latitude)), 1e-6)
+    for precision in range(9, 0, -1):
+        cell_lat, cell_lon = geohash_cell_size(precision)
+        rows = int((2 * lat_delta) // cell_lat) + 2
+        cols = int((2 * lon_delta) // cell_lon) + 2
+        if rows * cols <= max_cells or precision == 1:
+            break
+    prefixes = set()
+    lat = latitude - lat_delta
+    while lat <= latitude + lat_delta + cell_lat:
+        lon = longitude - lon_delta
+        while lon <= longitude + lon_delta + cell_lon:
+            prefixes.add(geohash_encode(max(min(lat, 90.0), -90.0), ((lon + 180.0) % 360.0) - 180.0, precision))
+            lon += cell_lon
+        lat += cell_lat
+    return sorted(prefixes)
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def haversine_matrix_km(latitudes, longitudes, other_latitudes=None, other_longitudes=None):
+    """Great-circle distances (km) from each point to each other point (default: pairwise), in degrees."""
+    if other_latitudes is None:
+        other_latitudes, other_longitudes = latitudes, longitudes
+    phi1 = np.radians(np.asarray(latitudes, dtype=np.float64))[:, None]
+    lmb1 = np.radians(np.asarray(longitudes, dtype=np.float64))[:, None]
+    phi2 = np.radians(np.asarray(other_latitudes, dtype=np.float64))[None, :]
+    lmb2 = np.radians(np.asarray(other_longitudes, dtype=np.float64))[None, :]
+    a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin((lmb2 - lmb1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _unit_vector(latitude, longitude):
+    phi, lmb = math.radians(latitude), math.radians(longitude)
+    return math.cos(phi) * math.cos(lmb), math.cos(phi) * math.sin(lmb), math.sin(phi)
+
+
+# Chord length on the unit sphere is monotonic in great-circle distance, so the tree works in 3D
+def _km_to_chord2(km):
+    return (2 * math.sin(min(km / EARTH_RADIUS_KM, math.pi) / 2)) ** 2
+
+
+def _chord2_to_km(chord2):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(chord2) / 2))
+
+
+class KDTree:
+    """Static, balanced 3D KD-tree stored implicitly: the median of every index range is its node."""
+
+    def __init__(self, ids, latitudes, longitudes):
+        lat = np.radians(np.asarray(latitudes, dtype=float))
+        lon = np.radians(np.asarray(longitudes, dtype=float))
+        points = np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+        order = np.arange(len(points))
+        self._arrange(points, order, 0, len(points), 0)
+        self.ids = [ids[i] for i in order.tolist()]
+        self.xs, self.ys, self.zs = (points[order, axis].tolist() for axis in range(3))
+
+    @staticmethod
+    def _arrange(points, order, lo, hi, depth):
+        stack = [(lo, hi, depth)]
+        while stack:
+            lo, hi, depth = stack.pop()
+            if hi - lo <= 1:
+                continue
+            mid = (lo + hi) // 2
+            segment = order[lo:hi]
+            part = np.argpartition(points[segment, depth % 3], mid - lo)
+            order[lo:hi] = segment[part]
+            stack.append((lo, mid, depth + 1))
+            stack.append((mid + 1, hi, depth + 1))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def query(self, latitude, longitude, k=None, max_km=None, predicate=None):
+        """Up to k (id, chord²) pairs within max_km, nearest first; predicate(id) filters candidates."""
+        qx, qy, qz = _unit_vector(latitude, longitude)
+        limit = _km_to_chord2(max_km) if max_km is not None else float('inf')
+        xs, ys, zs, ids = self.xs, self.ys, self.zs, self.ids
+        heap = []  # max-heap on chord² via negation when k is set, plain list otherwise
+
+        def search(lo, hi, depth):
+            if lo >= hi:
+                return
+            mid = (lo + hi) >> 1
+            dx, dy, dz = qx - xs[mid], qy - ys[mid], qz - zs[mid]
+            d2 = dx * dx + dy * dy + dz * dz
+            bound = -heap[0][0] if k is not None and len(heap) >= k else limit
+            if d2 <= bound and (predicate is None or predicate(ids[mid])):
+                if k is None:
+                    heap.append((d2, ids[mid]))
+                elif len(heap) < k:
+                    heapq.heappush(heap, (-d2, ids[mid]))
+                else:
+                    heapq.heapreplace(heap, (-d2, ids[mid]))
+            diff = (dx, dy, dz)[depth % 3]
+            if diff < 0:
+                search(lo, mid, depth + 1)
+                far = (mid + 1, hi)
+            else:
+                search(mid + 1, hi, depth + 1)
+                far = (lo, mid)
+            bound = -heap[0][0] if k is not None and len(heap) >= k else limit
+            if diff * diff <= bound:
+                search(far[0], far[1], depth + 1)
+
+        search(0, len(ids), 0)
+        if k is None:
+            return [(item_id, d2) for d2, item_id in sorted(heap)]
+        return [(item_id, -neg_d2) for neg_d2, item_id in sorted(heap, reverse=True)]
+
+
+class MerchantIndex:
+    """Nearest-merchant lookups for this process.
+
+    New merchants go to a small unindexed buffer that is scanned linearly and folded into a
+    rebuilt tree once it outgrows sqrt(n); deletes or moved coordinates force a full reload.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Serializes ensure_fresh, so two sessions can't apply the same new rows or interleave a reload
+        self._refresh_lock = threading.Lock()
+        self._tree = KDTree([], [], [])
+        self._pending = []  # (id, latitude, longitude) not yet in the tree
+        self._points = {}  # id -> (latitude, longitude, type)
+        self.max_id = 0
+        self.versions = None
+
+    def __len__(self):
+        return len(self._points)
+
+    def rebuild(self, rows):
+        """rows: iterable of (id, type, latitude, longitude)."""
+        points = {merchant_id: (lat, lon, type_) for merchant_id, type_, lat, lon in rows}
+        ids = list(points)
+        tree = KDTree(ids, [points[i][0] for i in ids], [points[i][1] for i in ids])
+        with self._lock:
+            self._tree, self._pending, self._points = tree, [], points
+            self.max_id = max(ids, default=0)
+
+    def add(self, merchant_id, type_, latitude, longitude):
+        with self._lock:
+            self._points[merchant_id] = (latitude, longitude, type_)
+            self._pending.append((merchant_id, latitude, longitude))
+            self.max_id = max(self.max_id, merchant_id)
+            if len(self._pending) > max(64, int(math.sqrt(len(self._points)))):
+                ids = list(self._points)
+                self._tree = KDTree(ids, [self._points[i][0] for i in ids], [self._points[i][1] for i in ids])
+                self._pending = []
+
+    @staticmethod
+    def _matcher(points, type_):
+        if type_ is None:
+            return None
+        return lambda merchant_id: points[merchant_id][2] == type_
+
+    def _search(self, latitude, longitude, k, max_km, type_):
+        # One consistent snapshot: a rebuild in between must not pair the old tree with the new points
+        with self._lock:
+            tree, pending, points = self._tree, list(self._pending), self._points
+        predicate = self._matcher(points, type_)
+        found = tree.query(latitude, longitude, k=k, max_km=max_km, predicate=predicate)
+        results = [(merchant_id, _chord2_to_km(d2)) for merchant_id, d2 in found]
+        for merchant_id, lat, lon in pending:
+            if predicate is None or predicate(merchant_id):
+                distance = haversine_km(latitude, longitude, lat, lon)
+                if max_km is None or distance <= max_km:
+                    results.append((merchant_id, distance))
+        if pending:
+            results.sort(key=lambda item: item[1])
+        return results if k is None else results[:k]
+
+    def nearest(self, latitude, longitude, k=10, max_km=None, type_=None):
+        """[(merchant_id, distance_km)] for the k merchants closest to a point, nearest first."""
+        return self._search(latitude, longitude, k, max_km, type_)
+
+    def within(self, latitude, longitude, radius_km, type_=None):
+        """[(merchant_id, distance_km)] for every merchant within radius_km, nearest first."""
+        return self._search(latitude, longitude, None, radius_km, type_)
+
+    def ensure_fresh(self, session):
+        """Sync with the merchants table: append new rows, or reload if merchants were moved or deleted."""
+        from models import DataVersion, Merchant
+
+        with self._refresh_lock:
+            rows = session.query(DataVersion.name, DataVersion.version).filter(
+                DataVersion.name.in_(('merchants', 'merchant_locations'))).all()
+            versions = dict(rows)
+            if versions == self.versions:
+                return
+            columns = (Merchant.id, Merchant.type, Merchant.latitude, Merchant.longitude)
+            moved = self.versions is None or versions.get('merchant_locations') != self.versions.get('merchant_locations')
+            if moved:
+                self.rebuild(session.query(*columns).all())
+            else:
+                for row in session.query(*columns).filter(Merchant.id > self.max_id).order_by(Merchant.id):
+                    self.add(*row)
+            self.versions = versions
+
+
+def merchants_near_sql(session, latitude, longitude, radius_km, type_=None):
+    """Index-assisted SQL lookup: geohash prefix ranges prefilter, exact haversine distance filters."""
+    from sqlalchemy import and_, or_
+    from models import Merchant
+
+    prefixes = geohash_prefixes_for_radius(latitude, longitude, radius_km)
+    query = session.query(Merchant).filter(or_(*(
+        and_(Merchant.geohash >= prefix, Merchant.geohash < prefix + '~') for prefix in prefixes)))
+    if type_:
+        query = query.filter(Merchant.type == type_)
+    results = []
+    for merchant in query:
+        distance = haversine_km(latitude, longitude, merchant.latitude, merchant.longitude)
+        if distance <= radius_km:
+            results.append((merchant, distance))
+    results.sort(key=lambda item: item[1])
+    return results
+
+
+def backfill_geohashes(session):
+    from models import Merchant
+
+    for merchant in session.query(Merchant).filter(Merchant.geohash.is_(None)):
+        merchant.geohash = geohash_encode(merchant.latitude, merchant.longitude)
+    session.commit()
+
+
+# Shared by every session in this server process
+merchant_index = MerchantIndex()